@@ -0,0 +1,87 @@
+"""
+Wait estimates for the generation backlog, from recent completion rates.
+"""
+
+import time
+from collections import deque
+
+COMPLETION_WINDOW_SECONDS = 600
+
+
+class CompletionRate:
+    """
+    Count finished generations over a sliding window to estimate throughput.
+    """
+
+    def __init__(self, window=COMPLETION_WINDOW_SECONDS):
+        """
+        Args:
+            window (float): Seconds of completions the rate is computed over.
+        """
+        self.window = window
+        self._finished = deque()
+
+    def record(self, now=None):
+        """
+        Count one finished generation.
+
+        Args:
+            now (float, optional): The current monotonic time, for testing.
+        """
+        now = time.monotonic() if now is None else now
+        self._finished.append(now)
+        self._evict(now)
+
+    def per_second(self, now=None):
+        """
+        Get the number of generations finished per second over the window.
+
+        Args:
+            now (float, optional): The current monotonic time, for testing.
+
+        Returns:
+            float: The rate, 0 if nothing finished recently.
+        """
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+        return len(self._finished) / self.window
+
+    def _evict(self, now):
+        while self._finished and now - self._finished[0] > self.window:
+            self._finished.popleft()
+
+
+def estimate_wait(ahead, rate):
+    """
+    Estimate how long the generations ahead of a new one take to finish.
+
+    Args:
+        ahead (int): The number of generations ahead.
+        rate (float): Generations finished per second recently.
+
+    Returns:
+        float or None: The estimate in seconds, or None without a recent rate.
+    """
+    if not ahead:
+        return 0
+    if not rate:
+        return None
+    return ahead / rate
+
+
+def format_wait(seconds):
+    """
+    Format a wait estimate for a reply.
+
+    Args:
+        seconds (float or None): The estimate from `estimate_wait`.
+
+    Returns:
+        str: The estimate in words.
+    """
+    if seconds is None:
+        return "unknown"
+    if seconds < 60:
+        return "less than a minute"
+    minutes = round(seconds / 60)
+    return f"about {minutes} minute{'s' if minutes != 1 else ''}"
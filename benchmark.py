@@ -0,0 +1,380 @@
+"""
+Load and throughput benchmark for the bot's command handlers.
+
+Drives thousands of concurrent /imagine, /memory and admin commands through
+the real handlers in bot.py against a real SQLite file, with the Vidu API
+replaced by a simulated backend whose latencies follow configurable
+distributions. Results are printed and saved as JSON so runs on different
+commits can be compared.
+
+Usage:
+    python benchmark.py --requests 2000 --concurrency 200
+    python benchmark.py --compare bench_results/<previous>.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import sqlite3
+import tempfile
+import subprocess
+import contextlib
+from collections import defaultdict
+from datetime import datetime, timezone
+
+BENCH_ADMIN_ID = 1
+BENCH_RESULTS_DIR = "bench_results"
+
+from vidu_simulator import parse_distribution
+
+# bot.py reads its configuration at import time
+os.environ.setdefault("ADMIN_ID", str(BENCH_ADMIN_ID))
+
+
+class SimulatedVidu:
+    """
+    Stand-in for vidu.py with the same blocking call signatures.
+
+    Calls sleep synchronously, like the real `requests` based client, so the
+    benchmark sees the same event loop blocking as production.
+    """
+
+    def __init__(self, submit_latency, status_latency, polls_to_finish, failure_rate):
+        self.submit_latency = submit_latency
+        self.status_latency = status_latency
+        self.polls_to_finish = polls_to_finish
+        self.failure_rate = failure_rate
+        self.calls = defaultdict(int)
+        self._remaining_polls = {}
+        self._next_id = 0
+
+    def reference_to_video(self, mock, api_key, model, images, prompt, **kwargs):
+        self.calls["reference_to_video"] += 1
+        time.sleep(self.submit_latency())
+        self._next_id += 1
+        task_id = f"bench-{self._next_id}"
+        self._remaining_polls[task_id] = max(1, round(self.polls_to_finish()))
+        return {"task_id": task_id, "state": "created"}
+
+    def get_generation_status(self, mock, api_key, task_id):
+        self.calls["get_generation_status"] += 1
+        time.sleep(self.status_latency())
+        remaining = self._remaining_polls.get(task_id, 1) - 1
+        self._remaining_polls[task_id] = remaining
+        if remaining > 0:
+            return {"state": "processing"}
+        if random.random() < self.failure_rate:
+            return {"state": "failed"}
+        return {
+            "state": "success",
+            "creations": [{"url": f"https://example.com/{task_id}.mp4"}],
+        }
+
+
+class FakeMessage:
+    def __init__(self, message_id, text):
+        self.message_id = message_id
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(("text", text))
+
+    async def reply_video(self, video, **kwargs):
+        self.replies.append(("video", video))
+
+    async def reply_media_group(self, media, **kwargs):
+        self.replies.append(("media_group", len(media)))
+
+    async def reply_document(self, document, **kwargs):
+        self.replies.append(("document", kwargs.get("filename")))
+
+
+class FakeEntity:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeUpdate:
+    def __init__(self, user_id, chat_id, message_id, text):
+        self.effective_user = FakeEntity(user_id)
+        self.effective_chat = FakeEntity(chat_id)
+        self.message = FakeMessage(message_id, text)
+
+
+class FakeBot:
+    username = "CurveBenchBot"
+
+
+class FakeContext:
+    def __init__(self, args):
+        self.args = args
+        self.bot = FakeBot()
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def seed_database(groups, users_per_group):
+    """
+    Create groups with references and generous limits, plus some history.
+    """
+    from services import (
+        init_db,
+        db_add_group,
+        db_add_reference,
+        db_set_group_limit,
+        db_set_user_limit,
+        db_add_memory,
+    )
+
+    init_db()
+    for group_id in range(1, groups + 1):
+        db_add_group(-group_id, f"Bench group {group_id}")
+        db_add_reference(-group_id, "https://example.com/reference.png")
+        db_set_group_limit(-group_id, 10**9)
+        db_set_user_limit(-group_id, 10**9)
+        for user_id in range(1, users_per_group + 1):
+            db_add_memory(
+                100 + user_id,
+                -group_id,
+                f"https://example.com/seed-{group_id}-{user_id}.mp4",
+                f"seed-{group_id}-{user_id}",
+                status="success",
+            )
+
+
+def build_workload(args, bot):
+    """
+    Build the list of (command name, handler, update, context) to run.
+    """
+    admin_commands = [
+        ("groups", bot.get_tracked_groups, []),
+        ("sgl", bot.set_group_limit, [str(10**9)]),
+        ("sul", bot.set_user_limit, [str(10**9)]),
+        ("dbstats", bot.db_stats, []),
+    ]
+    mix = {name: float(weight) for name, weight in args.mix}
+    names, weights = zip(*mix.items())
+
+    workload = []
+    for message_id in range(1, args.requests + 1):
+        group_id = -random.randint(1, args.groups)
+        user_id = 100 + random.randint(1, args.users)
+        kind = random.choices(names, weights)[0]
+        if kind == "imagine":
+            command, handler, cmd_args = (
+                "imagine",
+                bot.imagine,
+                ["a", "bench", "prompt"],
+            )
+        elif kind == "memory":
+            command, handler = "memory", bot.memory
+            cmd_args = random.choice([[], ["1"]])
+        else:
+            command, handler, cmd_args = random.choice(admin_commands)
+            user_id = BENCH_ADMIN_ID
+        text = " ".join([f"/{command}", *cmd_args])
+        update = FakeUpdate(user_id, group_id, message_id, text)
+        workload.append((command, handler, update, FakeContext(cmd_args)))
+    return workload
+
+
+async def run_workload(workload, concurrency, monitor):
+    latencies = defaultdict(list)
+    errors = defaultdict(lambda: defaultdict(int))
+    locked = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(command, handler, update, context):
+        nonlocal locked
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await handler(update, context)
+            except Exception as e:
+                if isinstance(e, sqlite3.OperationalError) and "locked" in str(e):
+                    locked += 1
+                errors[command][f"{type(e).__name__}: {e}"] += 1
+            latencies[command].append(time.perf_counter() - started)
+
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(run_one(*item) for item in workload))
+    elapsed = time.perf_counter() - started
+    await monitor.stop()
+    return latencies, errors, locked, elapsed
+
+
+def summarize(args, latencies, errors, locked, elapsed, monitor, vidu):
+    from services import query_stats
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    db_summary = query_stats.summary()
+    return {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ("compare",)
+        },
+        "requests": len(all_latencies),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(all_latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            command: {
+                "count": len(values),
+                "errors": sum(errors[command].values()),
+                "error_types": dict(errors[command]),
+                "p50": percentile(values, 0.50) * 1000,
+                "p99": percentile(values, 0.99) * 1000,
+                "max": max(values) * 1000,
+            }
+            for command, values in sorted(latencies.items())
+        },
+        "loop_lag_ms": {
+            "max": monitor.max_lag * 1000,
+            "stalls": monitor.stalls,
+            "top_sites": monitor.top_sites(5),
+        },
+        "db": {
+            "statements": sum(row["count"] for row in db_summary),
+            "total_ms": sum(row["total_ms"] for row in db_summary),
+            "locked_errors": locked,
+            "slowest": [
+                {key: row[key] for key in ("sql", "count", "p95_ms", "max_ms")}
+                for row in db_summary[:5]
+            ],
+        },
+        "vidu_calls": dict(vidu.calls),
+    }
+
+
+def print_report(result, baseline=None):
+    def delta(current, previous):
+        if not previous:
+            return ""
+        return f" ({(current - previous) / previous * 100:+.1f}%)"
+
+    base = baseline or {}
+    print(f"\nRevision {result['revision']}, {result['requests']} requests")
+    print(
+        f"Throughput: {result['throughput_rps']:.1f} req/s"
+        f"{delta(result['throughput_rps'], base.get('throughput_rps'))}"
+    )
+    print(f"{'command':<10}{'count':>8}{'errors':>8}{'p50 ms':>12}{'p99 ms':>12}")
+    for command, stats in result["latency_ms"].items():
+        previous = base.get("latency_ms", {}).get(command, {})
+        print(
+            f"{command:<10}{stats['count']:>8}{stats['errors']:>8}"
+            f"{stats['p50']:>12.1f}{stats['p99']:>12.1f}"
+            f"{delta(stats['p99'], previous.get('p99'))}"
+        )
+    lag = result["loop_lag_ms"]
+    print(f"\nEvent loop: max lag {lag['max']:.0f} ms, {lag['stalls']} stalls")
+    for site, count in lag["top_sites"]:
+        print(f"  {count:>5}  {site}")
+    db = result["db"]
+    print(
+        f"\nDatabase: {db['statements']} statements, {db['total_ms']:.0f} ms total, "
+        f"{db['locked_errors']} 'database is locked' errors"
+    )
+    for row in db["slowest"]:
+        print(f"  p95 {row['p95_ms']:.2f} ms  x{row['count']}  {row['sql'][:80]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's handlers.")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument(
+        "--mix",
+        type=lambda value: [item.split("=") for item in value.split(",")],
+        default="imagine=0.5,memory=0.4,admin=0.1",
+        help="Command mix as name=weight pairs (imagine, memory, admin).",
+    )
+    parser.add_argument("--submit-latency", default="lognormal:0.005:0.5")
+    parser.add_argument("--status-latency", default="lognormal:0.002:0.5")
+    parser.add_argument(
+        "--polls", default="uniform:1:4", help="Status polls until a task finishes."
+    )
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=BENCH_RESULTS_DIR)
+    parser.add_argument("--compare", help="Previous result file to compare against.")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="curvebot-bench-")
+    os.environ["DATABASE"] = os.path.join(workdir, "bench.db")
+
+    import logging
+
+    import bot
+    from diagnostics import LoopLagMonitor
+
+    logging.disable(logging.WARNING)
+
+    vidu = SimulatedVidu(
+        parse_distribution(args.submit_latency),
+        parse_distribution(args.status_latency),
+        parse_distribution(args.polls),
+        args.failure_rate,
+    )
+    bot.reference_to_video = vidu.reference_to_video
+    bot.get_generation_status = vidu.get_generation_status
+    bot.POLL_SLEEP_CYCLE_SECONDS = args.poll_interval
+    bot.MAX_POLLING_TIME_SECONDS = args.poll_interval * 20
+
+    seed_database(args.groups, args.users)
+    bot.query_stats.reset()
+    workload = build_workload(args, bot)
+    monitor = LoopLagMonitor(interval=0.01, threshold=0.05, report_interval=10**9)
+
+    # The handlers print debug output for every request
+    with contextlib.redirect_stdout(io.StringIO()):
+        latencies, errors, locked, elapsed = asyncio.run(
+            run_workload(workload, args.concurrency, monitor)
+        )
+    result = summarize(args, latencies, errors, locked, elapsed, monitor, vidu)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(
+        args.output,
+        f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{result['revision']}.json",
+    )
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nSaved results to {path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,43 +1,112 @@
+import io
 import os
+import re
 import argparse
 import asyncio
+import signal
 import logging
+import contextvars
 from datetime import datetime
-from telegram import Update
+from collections import Counter
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InputMediaVideo,
+)
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     ChatMemberHandler,
+    CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters,
 )
+from telegram.error import BadRequest, Forbidden
 import requests
+import httpx
 
 from dotenv import load_dotenv
 
-from utils import validate_and_extract_urls
+from utils import validate_and_extract_urls, parse_config_import, parse_bot_configs
+from diagnostics import LoopLagMonitor, Profiler
+from throttle import Throttle
+from backpressure import (
+    CompletionRate,
+    estimate_wait,
+    format_wait,
+    COMPLETION_WINDOW_SECONDS,
+)
+from references import (
+    ReferenceChecker,
+    ReferenceCache,
+    split_reference,
+    INLINE_REFERENCES,
+    REFERENCE_CACHE_DIR,
+)
 
 load_dotenv()
 
 from services import (
     init_db,
+    get_namespace,
+    set_namespace,
+    use_namespace,
     db_get_reference,
     db_add_reference,
     db_get_limits,
     db_get_usage,
-    db_update_usage,
     db_add_memory,
     db_get_memory,
     db_set_group_limit,
     db_set_user_limit,
+    db_get_quota_window,
+    db_set_quota_window,
+    QUOTA_WINDOWS,
     db_get_memory_by_id,
-    db_update_video_url,
+    db_complete_video,
+    db_update_status,
     db_add_group,
-    db_get_all_groups,
+    db_iter_groups,
+    db_import_config,
+    db_get_group_stats,
+    db_get_stats_overview,
+    db_get_month,
+    db_reserve_quota,
+    db_release_reservation,
+    db_get_memory_source,
+    db_get_profiles,
+    db_set_profile,
+    db_reset_profile,
+    db_rebalance_into_shards,
+    query_stats,
+    db_enqueue_job,
+    db_get_finished_jobs,
+    db_mark_job_delivered,
+    db_save_checkpoints,
+    db_get_checkpoints,
+    db_delete_checkpoint,
+    db_checkpoint_wal,
+    db_cancel_memory,
+    db_cancel_jobs,
+    db_claim_submission,
+    db_complete_submission,
+    db_release_submission,
+    db_get_memory_by_task,
+    db_count_outstanding_jobs,
+    db_count_finished_jobs,
 )
 
-from vidu import reference_to_video, get_generation_status
+from vidu import (
+    reference_to_video,
+    get_generation_status,
+    cancel_generation,
+    submission_rejected,
+)
+from maintenance import retention_loop, sweep_loop
 
 
 logging.basicConfig(
@@ -45,7 +114,8 @@ logging.basicConfig(
 )
 
 USE_MOCK_DATA = False
-ADMIN_IDs = [int(id) for id in os.getenv("ADMIN_ID").split(",")]
+USE_JOB_QUEUE = False
+ADMIN_IDs = [int(id) for id in os.getenv("ADMIN_ID", "").split(",") if id]
 API_KEY = os.getenv("VIDO_API_KEY")
 VIDU_API_URL = "https://api.vidu.com/imagine"
 MODEL = "vidu2.0"
@@ -55,6 +125,155 @@ DURATION = 4
 ENDING_PROMPT = "2d animation"
 POLL_SLEEP_CYCLE_SECONDS = 5
 MAX_POLLING_TIME_SECONDS = 60
+IMAGINE_MAX_PROMPTS = 10
+# Groups override these per tier with /sgp
+PROFILE_DEFAULTS = {
+    "standard": {
+        "model": MODEL,
+        "duration": DURATION,
+        "aspect_ratio": ASPECT_RATIO,
+        "resolution": RESOLUTION,
+    },
+    "draft": {
+        "model": "vidu2.0",
+        "duration": 4,
+        "aspect_ratio": ASPECT_RATIO,
+        "resolution": "360p",
+    },
+    "upscale": {
+        "model": MODEL,
+        "duration": DURATION,
+        "aspect_ratio": ASPECT_RATIO,
+        "resolution": "1080p",
+    },
+}
+PROFILE_CHOICES = {
+    "model": ("viduq1", "vidu2.0", "vidu1.5", "vidu1.0"),
+    "duration": ("4", "8"),
+    "aspect_ratio": ("16:9", "9:16", "1:1"),
+    "resolution": ("360p", "720p", "1080p"),
+}
+# Results that finish this close to the first one are sent as one media group
+MEDIA_GROUP_WAIT_SECONDS = 10
+# Concurrent Vidu requests over all handlers
+VIDU_CONCURRENCY = int(os.getenv("VIDU_CONCURRENCY", "8"))
+# Commands allowed at once, and refilled per second, per user and per group
+THROTTLE_USER_BURST = int(os.getenv("THROTTLE_USER_BURST", "5"))
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "0.2"))
+THROTTLE_GROUP_BURST = int(os.getenv("THROTTLE_GROUP_BURST", "20"))
+THROTTLE_GROUP_RATE = float(os.getenv("THROTTLE_GROUP_RATE", "1"))
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))
+LOOP_LAG_REPORT_SECONDS = int(os.getenv("LOOP_LAG_REPORT_SECONDS", "300"))
+PROFILE_MAX_SECONDS = 300
+DELIVERY_INTERVAL_SECONDS = 2
+# How limits are described in replies, per quota window
+QUOTA_WINDOW_NAMES = {
+    "month": ("monthly", "month"),
+    "24h": ("daily", "24 hours"),
+    "7d": ("weekly", "7 days"),
+    "30d": ("30-day", "30 days"),
+}
+CANCELLED_MESSAGE = "Video generation was cancelled."
+# Caps on generations queued or in progress; 0 means no cap
+MAX_OUTSTANDING_JOBS = int(os.getenv("MAX_OUTSTANDING_JOBS", "200"))
+MAX_OUTSTANDING_PER_GROUP = int(os.getenv("MAX_OUTSTANDING_PER_GROUP", "20"))
+# How long a SIGTERM waits for running generations before checkpointing them
+SHUTDOWN_DRAIN_SECONDS = int(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+DB_STATS_TOP_N = 10
+STATS_MONTHS = 6
+STATS_TOP_USERS = 5
+STATS_TOP_GROUPS = 10
+MEMORY_PAGE_SIZE = 5
+IMPORT_PREVIEW_LINES = 20
+REFERENCE_MAX_BYTES = 64 * 1024
+IMPORT_MAX_BYTES = 1024 * 1024
+# Telegram messages are limited to 4096 characters
+GROUPS_PAGE_MAX_CHARS = 4000
+# Keeps the callback data within Telegram's 64 byte limit
+GROUPS_PREFIX_MAX_BYTES = 32
+
+loop_monitor = LoopLagMonitor(
+    threshold=LOOP_LAG_THRESHOLD_MS / 1000, report_interval=LOOP_LAG_REPORT_SECONDS
+)
+profiler = Profiler()
+# Admins of the bot handling the current update, when serving BOTS_CONFIG
+bot_admin_ids = contextvars.ContextVar("bot_admin_ids", default=None)
+served_namespaces = [""]
+# Long-running loops started in post_init; Application.create_task would make
+# Application.stop() wait for them forever
+background_tasks = []
+vidu_semaphore = asyncio.Semaphore(VIDU_CONCURRENCY)
+reference_checker = ReferenceChecker()
+reference_cache = ReferenceCache(REFERENCE_CACHE_DIR)
+# Reference prefetches started when a reference changes
+reference_prefetches = set()
+# Handler and resume tasks running generations, drained on shutdown
+generation_tasks = set()
+# Vidu task ID -> what is needed to finish and deliver it after a restart
+tracked_tasks = {}
+# Vidu task ID -> event set when the user cancels the generation
+cancel_events = {}
+shutting_down = False
+# Generations started in this process per group, without the job queue
+outstanding = Counter()
+completion_rate = CompletionRate()
+user_throttle = Throttle(THROTTLE_USER_RATE, THROTTLE_USER_BURST)
+group_throttle = Throttle(THROTTLE_GROUP_RATE, THROTTLE_GROUP_BURST)
+
+
+async def throttle_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Reject commands and button presses over the per-user or per-group rate.
+
+    Runs before every other handler and only touches in-memory buckets, so
+    a burst of spam costs no database or API work. The first rejected
+    update gets a reply; the rest are dropped silently until the bucket
+    refills.
+
+    Args:
+        update (Update): The incoming update from the Telegram bot.
+        context (ContextTypes.DEFAULT_TYPE): The context for the update.
+
+    Raises:
+        ApplicationHandlerStop: If the update is over the limit.
+    """
+    query = update.callback_query
+    message = update.message
+    is_command = message and (message.text or message.caption or "").startswith("/")
+    if not (query or is_command) or not update.effective_user:
+        return
+    if is_admin(update.effective_user.id):
+        return
+
+    allowed, notify = user_throttle.check(update.effective_user.id)
+    if allowed and update.effective_chat and update.effective_chat.id < 0:
+        allowed, notify = group_throttle.check(update.effective_chat.id)
+    if allowed:
+        return
+
+    if notify:
+        text = "You're sending commands too fast. Please wait a moment."
+        if query:
+            await query.answer(text)
+        else:
+            await message.reply_text(text)
+    elif query:
+        await query.answer()
+    raise ApplicationHandlerStop
+
+
+def is_admin(user_id):
+    """
+    Check whether a user is an admin of the bot handling the current update.
+
+    Args:
+        user_id (int): The Telegram user ID.
+
+    Returns:
+        bool: True for admins.
+    """
+    admin_ids = bot_admin_ids.get()
+    return user_id in (ADMIN_IDs if admin_ids is None else admin_ids)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -63,20 +282,85 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 *Available user commands:*
 /start - Show this help message
 /imagine <prompt> - Generate a video based on the group's reference
-/memory <id:optional> - Show your last 5 generated videos or a specific video by ID
+Separate several prompts with new lines or | to generate them all at once
+Start with --draft for a quick, low quality preview
+/upscale <id> - Render one of your videos again at full quality
+/cancel <id> - Stop one of your videos that is still being generated
+/memory <id:optional> - Browse your generated videos or show a specific video by ID
 
 *Available admin commands:*
 /reference <value> or <file.txt> - Set a reference for the group
 File has to be a .txt file with a list of URLs, one URL per line
-/sgl <value> - Set a monthly limit for the group
-/sul <value> - Set a monthly limit for all users in the group
-/groups - Show all groups where the bot is added
+/import <dry:optional> - Send as a caption with a .csv or .json file to set limits and references for many groups at once
+/sgl <value> - Set a limit for the group
+/sul <value> - Set a limit for all users in the group
+/sqw <month|24h|7d|30d> - Set the window the group's limits apply to
+/sgp <tier> <key=value> - Change the group's generation settings, or show them
+/groups <name:optional> - Browse the groups where the bot is added
+/lag - Show event loop lag and the call sites blocking it
+/profile <seconds> - Profile all handlers for a time window
+/dbstats <reset:optional> - Show per-statement database timings
+/stats <group:optional> - Show usage, success rates and generation times
 
 *Note:* Use commands like `/start@{bot_username}` in group chats to explicitly target this bot.
 """
     await update.message.reply_text(commands, parse_mode="Markdown")
 
 
+async def check_reference_urls(urls):
+    """
+    Check that reference image URLs are reachable images.
+
+    Args:
+        urls (list): The URLs to check.
+
+    Returns:
+        str or None: One line per unusable URL with the reason, or None if
+        all can be used.
+    """
+    if USE_MOCK_DATA:
+        return None
+    failed = await reference_checker.check_all(urls)
+    if not failed:
+        return None
+    return "\n".join(f"{url}: {reason}" for url, reason in failed.items())
+
+
+def prefetch_reference(ref):
+    """
+    Fetch a newly set reference into the inline cache in the background.
+
+    Args:
+        ref (str): The stored reference.
+    """
+    if not INLINE_REFERENCES or USE_MOCK_DATA:
+        return
+    task = asyncio.create_task(reference_cache.prefetch(ref))
+    reference_prefetches.add(task)
+    task.add_done_callback(reference_prefetches.discard)
+
+
+async def reference_images(ref):
+    """
+    Get the images to send to Vidu for a reference.
+
+    With INLINE_REFERENCES the images are sent as Base64 from the reference
+    cache; if that fails, or without it, the reference is sent as URLs.
+
+    Args:
+        ref (str): The stored reference.
+
+    Returns:
+        list: The images.
+    """
+    if INLINE_REFERENCES and not USE_MOCK_DATA:
+        try:
+            return await reference_cache.images_for(ref)
+        except (httpx.HTTPError, OSError, ValueError) as e:
+            logging.warning(f"Inlining reference images failed: {e}")
+    return [ref]
+
+
 async def reference(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Handle the /reference command to set a reference for the group.
@@ -95,7 +379,7 @@ async def reference(update: Update, context: ContextTypes.DEFAULT_TYPE):
         /reference [group_id] <url1> <url2> ...
     """
 
-    if update.effective_user.id not in ADMIN_IDs:
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("You don't have permission to set a reference.")
         return
 
@@ -117,19 +401,30 @@ async def reference(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please provide at least one URL.")
         return
 
+    failed = await check_reference_urls(urls)
+    if failed:
+        await update.message.reply_text(f"Some images can't be used:\n{failed}")
+        return
+
     # Validate and join URLs
     ref = " ".join(urls)
     print(f"Group ID: {group_id}, Reference: {ref}")
     db_add_reference(group_id, ref)
+    prefetch_reference(ref)
 
     await update.message.reply_text(f"Reference for group {group_id} set to:\n{ref}")
 
 
 async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMIN_IDs:
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("You don't have permission to upload files.")
         return
 
+    caption = (update.message.caption or "").split()
+    if caption and caption[0].lower() == "/import":
+        await import_config(update, context, dry_run="dry" in caption[1:])
+        return
+
     if update.message.document and update.message.document.mime_type == "text/plain":
         print("Received a .txt file")
         document = update.message.document
@@ -155,25 +450,33 @@ async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE)
         print(f"cap_split: {cap_split}")
 
         if caption and command == "/reference":
-            file = await context.bot.get_file(document.file_id)
-            folder_path = "references"
-            if not os.path.exists(folder_path):
-                os.makedirs(folder_path)
-            file_path = f"{folder_path}/{group_id}_{document.file_name}"
-
-            # Download the file
-            await file.download_to_drive(file_path)
-
-            # Validate and extract URLs
-            urls = validate_and_extract_urls(file_path)
-            if urls is None:
-                await update.message.reply_text(
-                    "The file must contain a valid list of URLs."
-                )
+            data = await download_document(update, context, REFERENCE_MAX_BYTES)
+            if data is None:
+                return
+
+            # Validate and extract URLs, one line at a time
+            with io.TextIOWrapper(io.BytesIO(data), encoding="utf-8") as f:
+                try:
+                    urls, errors = validate_and_extract_urls(f)
+                except UnicodeDecodeError:
+                    urls, errors = [], ["the file must be UTF-8 encoded"]
+            if errors or not urls:
+                message = "The file must contain a valid list of URLs."
+                if errors:
+                    message += "\n" + "\n".join(errors[:IMPORT_PREVIEW_LINES])
+                if len(errors) > IMPORT_PREVIEW_LINES:
+                    message += f"\n...and {len(errors) - IMPORT_PREVIEW_LINES} more"
+                await update.message.reply_text(message)
+                return
+
+            failed = await check_reference_urls(urls)
+            if failed:
+                await update.message.reply_text(f"Some images can't be used:\n{failed}")
                 return
 
             # Save the URLs as a reference
             db_add_reference(group_id, ",".join(urls))
+            prefetch_reference(",".join(urls))
             await update.message.reply_text(
                 f"Reference set from uploaded file:\n{', '.join(urls)}"
             )
@@ -185,9 +488,104 @@ async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Please upload a valid .txt file.")
 
 
+async def download_document(update, context, max_bytes):
+    """
+    Download the uploaded document into memory, up to a size limit.
+
+    Args:
+        update (Update): The incoming update with the document.
+        context (ContextTypes.DEFAULT_TYPE): The context for the message.
+        max_bytes (int): The largest accepted file size.
+
+    Returns:
+        bytearray: The file contents, or None if the file is too large (the
+        user has been told).
+    """
+    document = update.message.document
+    too_large = f"The file is too large, the limit is {max_bytes // 1024} KB."
+    # Checked before downloading when Telegram reports the size
+    if document.file_size and document.file_size > max_bytes:
+        await update.message.reply_text(too_large)
+        return None
+    file = await context.bot.get_file(document.file_id)
+    data = await file.download_as_bytearray()
+    if len(data) > max_bytes:
+        await update.message.reply_text(too_large)
+        return None
+    return data
+
+
+async def import_config(update: Update, context: ContextTypes.DEFAULT_TYPE, dry_run):
+    """
+    Apply a CSV or JSON file of per-group limits and references in bulk.
+
+    The file is validated in one pass; if any row is invalid nothing is
+    applied. Otherwise all changes are written in one transaction, or only
+    listed when the caption is "/import dry".
+
+    Args:
+        update (Update): The incoming update with the uploaded document.
+        context (ContextTypes.DEFAULT_TYPE): The context for the message.
+        dry_run (bool): If True, only report the changes.
+    """
+    document = update.message.document
+    file_name = (document.file_name or "").lower()
+    if file_name.endswith(".json") or document.mime_type == "application/json":
+        file_format = "json"
+    elif file_name.endswith(".csv") or document.mime_type == "text/csv":
+        file_format = "csv"
+    else:
+        await update.message.reply_text("Please upload a .csv or .json file.")
+        return
+
+    data = await download_document(update, context, IMPORT_MAX_BYTES)
+    if data is None:
+        return
+    with io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", newline="") as f:
+        try:
+            entries, errors = parse_config_import(f, file_format)
+        except UnicodeDecodeError:
+            entries, errors = [], ["the file must be UTF-8 encoded"]
+
+    if not errors:
+        urls = {url for entry in entries for url in split_reference(entry["reference"])}
+        failed = await check_reference_urls(sorted(urls))
+        if failed:
+            errors = [f"reference images can't be used:\n{failed}"]
+
+    if errors:
+        message = f"Import rejected, {len(errors)} invalid entries:\n" + "\n".join(
+            errors[:IMPORT_PREVIEW_LINES]
+        )
+        if len(errors) > IMPORT_PREVIEW_LINES:
+            message += f"\n...and {len(errors) - IMPORT_PREVIEW_LINES} more"
+        await update.message.reply_text(message)
+        return
+    if not entries:
+        await update.message.reply_text("The file contains no groups.")
+        return
+
+    changes = await asyncio.to_thread(db_import_config, entries, dry_run)
+    if not dry_run:
+        for entry in entries:
+            if entry["reference"]:
+                prefetch_reference(entry["reference"])
+    groups = len({group_id for group_id, *_ in changes})
+    message = (
+        f"{'Dry run' if dry_run else 'Import complete'}: {len(entries)} groups read, "
+        f"{len(changes)} changes to {groups} groups"
+        f"{' (nothing was applied)' if dry_run else ''}.\n"
+    )
+    for group_id, field, old, new in changes[:IMPORT_PREVIEW_LINES]:
+        message += f"\n{group_id} {field}: {'unset' if old is None else old} -> {new}"
+    if len(changes) > IMPORT_PREVIEW_LINES:
+        message += f"\n...and {len(changes) - IMPORT_PREVIEW_LINES} more"
+    await update.message.reply_text(message)
+
+
 async def set_group_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Handle the /sgl command to set a monthly limit for the group.
+    Handle the /sgl command to set a limit for the group.
 
     Args:
         update (Update): The incoming update from the Telegram bot.
@@ -203,7 +601,7 @@ async def set_group_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Usage:
         /sgl [group_id] <value>
     """
-    if update.effective_user.id not in ADMIN_IDs:
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text(
             "You don't have permission to set group limits."
         )
@@ -226,14 +624,15 @@ async def set_group_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
     db_set_group_limit(group_id, group_limit)
+    period = QUOTA_WINDOW_NAMES[db_get_quota_window(group_id)][1]
     await update.message.reply_text(
-        f"Group limit for group {group_id} set to {group_limit} per month"
+        f"Group limit for group {group_id} set to {group_limit} per {period}"
     )
 
 
 async def set_user_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Handle the /sul command to set a monthly limit for individual users in the group.
+    Handle the /sul command to set a limit for individual users in the group.
 
     Args:
         update (Update): The incoming update from the Telegram bot.
@@ -249,7 +648,7 @@ async def set_user_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Usage:
         /sul [group_id] <value>
     """
-    if update.effective_user.id not in ADMIN_IDs:
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("You don't have permission to set user limits.")
         return
 
@@ -269,58 +668,385 @@ async def set_user_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
     db_set_user_limit(group_id, user_limit)
+    period = QUOTA_WINDOW_NAMES[db_get_quota_window(group_id)][1]
+    await update.message.reply_text(
+        f"User limit for group {group_id} set to {user_limit} per {period}"
+    )
+
+
+async def set_quota_window(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the /sqw command to choose the window the group's limits apply to.
+
+    Limits apply to the calendar month by default; rolling windows spread
+    the resets out instead of resetting every group on the 1st.
+
+    Usage:
+        /sqw [group_id] <month|24h|7d|30d>
+    """
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "You don't have permission to set quota windows."
+        )
+        return
+
+    usage = f"Usage: /sqw [group_id] <{'|'.join(QUOTA_WINDOWS)}>"
+    if len(context.args) == 2:
+        try:
+            group_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text(usage)
+            return
+        quota_window = context.args[1]
+    elif len(context.args) == 1:
+        group_id = update.effective_chat.id
+        quota_window = context.args[0]
+    else:
+        await update.message.reply_text(usage)
+        return
+    if quota_window not in QUOTA_WINDOWS:
+        await update.message.reply_text(usage)
+        return
+
+    db_set_quota_window(group_id, quota_window)
+    period = QUOTA_WINDOW_NAMES[quota_window][1]
     await update.message.reply_text(
-        f"User limit for group {group_id} set to {user_limit} per month"
+        f"Limits for group {group_id} now apply to the last {period}"
+        if quota_window != "month"
+        else f"Limits for group {group_id} now apply to the calendar month"
     )
 
 
+def split_prompts(text):
+    """
+    Split the text of an /imagine command into prompts.
+
+    Prompts are separated by newlines or "|".
+
+    Args:
+        text (str): The message text, including the command.
+
+    Returns:
+        list: The non-empty prompts.
+    """
+    parts = text.split(None, 1)
+    if len(parts) < 2:
+        return []
+    prompts = (prompt.strip() for prompt in re.split(r"[\n|]", parts[1]))
+    return [prompt for prompt in prompts if prompt]
+
+
 async def imagine(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if len(context.args) < 1:
-        await update.message.reply_text("Usage: /imagine <prompt>")
+    text = update.message.text or ""
+    tier = "standard"
+    parts = text.split(None, 2)
+    if len(parts) > 1 and parts[1].lower() == "--draft":
+        tier = "draft"
+        text = " ".join([parts[0], *parts[2:]])
+
+    prompts = split_prompts(text)
+    if not prompts:
+        await update.message.reply_text(
+            "Usage: /imagine [--draft] <prompt> | <prompt> ..."
+        )
+        return
+    if len(prompts) > IMAGINE_MAX_PROMPTS:
+        await update.message.reply_text(
+            f"You can generate up to {IMAGINE_MAX_PROMPTS} videos at once."
+        )
+        return
+
+    await start_generations(update, prompts, tier)
+
+
+async def upscale(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Re-render one of the user's videos with the group's upscale profile.
+
+    The stored prompt and seed are reused, so a draft can be iterated on
+    cheaply and only the final pick rendered at full quality.
+
+    Args:
+        update (Update): The incoming update from the Telegram bot.
+        context (ContextTypes.DEFAULT_TYPE): The context for the command, including arguments.
+
+    Usage:
+        /upscale <id>
+    """
+    try:
+        memory_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("Usage: /upscale <id>")
+        return
+
+    group_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    source = db_get_memory_source(user_id, group_id, memory_id)
+    if not source:
+        await update.message.reply_text(f"No memory found with ID {memory_id}.")
+        return
+    prompt, seed, _ = source
+    if not prompt:
+        await update.message.reply_text(
+            "This video was made before prompts were recorded and can't be upscaled."
+        )
         return
 
+    await start_generations(update, [prompt], "upscale", seed=seed)
+
+
+def get_profile(group_id, tier):
+    """
+    Get the generation settings of a group for a profile tier.
+
+    Args:
+        group_id (int): The ID of the group.
+        tier (str): "standard", "draft" or "upscale".
+
+    Returns:
+        dict: The model, duration, aspect_ratio and resolution to use.
+    """
+    return {**PROFILE_DEFAULTS[tier], **db_get_profiles(group_id).get(tier, {})}
+
+
+async def start_generations(update, prompts, tier, seed=None):
+    """
+    Check the limits, reserve quota and generate videos for the prompts.
+
+    Args:
+        update (Update): The update of the command.
+        prompts (list): The user's prompts.
+        tier (str): The profile tier to generate with.
+        seed (int, optional): The seed to render with, for re-renders.
+    """
+    if shutting_down:
+        await update.message.reply_text(
+            "The bot is restarting, please try again in a minute."
+        )
+        return
     group_id = update.effective_chat.id
     user_id = update.effective_user.id
     group_limit, user_limit = db_get_limits(group_id)
     group_usage, user_usage = db_get_usage(group_id, user_id)
+    window = QUOTA_WINDOW_NAMES[db_get_quota_window(group_id)][0]
 
     if group_limit is not None and group_usage >= group_limit:
-        await update.message.reply_text("Group has reached its monthly limit.")
+        await update.message.reply_text(f"Group has reached its {window} limit.")
         return
     if user_limit is not None and user_usage >= user_limit:
-        await update.message.reply_text("You have reached your monthly limit.")
+        await update.message.reply_text(f"You have reached your {window} limit.")
         return
     print(f"Group id: {group_id}")
     ref = db_get_reference(group_id)
     if not ref:
         await update.message.reply_text("No reference set for this group.")
         return
+    if await check_reference_urls(split_reference(ref)):
+        await update.message.reply_text(
+            "The group's reference images can't be loaded. Ask an admin to set a new /reference."
+        )
+        return
+    images = await reference_images(ref)
+
+    total, in_group = await outstanding_counts(group_id)
+    rate = await recent_completion_rate()
+    if MAX_OUTSTANDING_JOBS and total + len(prompts) > MAX_OUTSTANDING_JOBS:
+        wait = estimate_wait(total + len(prompts) - MAX_OUTSTANDING_JOBS, rate)
+        await update.message.reply_text(
+            f"Too many videos are being generated right now. Estimated wait "
+            f"for a free slot: {format_wait(wait)}. Please try again later."
+        )
+        return
+    if (
+        MAX_OUTSTANDING_PER_GROUP
+        and in_group + len(prompts) > MAX_OUTSTANDING_PER_GROUP
+    ):
+        await update.message.reply_text(
+            f"This group already has {in_group} videos in progress. "
+            "Please try again when some are done."
+        )
+        return
 
-    # Call the reference_to_video function to start the task
-    user_prompt = " ".join(context.args)
+    # Quota for all prompts is taken at once, so a batch never overshoots a limit
+    reservation_id, exceeded = db_reserve_quota(
+        group_id, user_id, len(prompts), group_limit, user_limit
+    )
+    if reservation_id is None:
+        if len(prompts) > 1:
+            await update.message.reply_text(
+                f"Not enough of {'the group' if exceeded == 'group' else 'your'} "
+                f"{window} limit is left for {len(prompts)} videos."
+            )
+        elif exceeded == "group":
+            await update.message.reply_text(f"Group has reached its {window} limit.")
+        else:
+            await update.message.reply_text(f"You have reached your {window} limit.")
+        return
 
-    try:
-        response = reference_to_video(
-            mock=USE_MOCK_DATA,
-            api_key=API_KEY,
-            model=MODEL,
-            images=[ref],
-            prompt=f"{user_prompt}, {ENDING_PROMPT}",
-            duration=DURATION,
-            aspect_ratio=ASPECT_RATIO,
-            resolution=RESOLUTION,
+    if total and USE_JOB_QUEUE:
+        await update.message.reply_text(
+            f"{total} video{'s are' if total != 1 else ' is'} ahead of yours. "
+            f"Estimated wait: {format_wait(estimate_wait(total, rate))}."
+        )
+    elif total:
+        # Without the queue, generations run side by side rather than in turn
+        await update.message.reply_text(
+            f"{total} other video{'s are' if total != 1 else ' is'} being "
+            "generated right now, so yours may take longer."
+        )
+
+    profile = get_profile(group_id, tier)
+    if USE_JOB_QUEUE:
+        # A worker process submits and tracks the jobs; see deliver_finished_jobs
+        queued = 0
+        for index, user_prompt in enumerate(prompts):
+            job_id = db_enqueue_job(
+                group_id=group_id,
+                user_id=user_id,
+                chat_id=update.effective_chat.id,
+                message_id=update.message.message_id,
+                prompt=f"{user_prompt}, {ENDING_PROMPT}",
+                images=images,
+                params={
+                    **profile,
+                    "tier": tier,
+                    "seed": seed,
+                    "user_prompt": user_prompt,
+                    "reservation_id": reservation_id,
+                },
+                idempotency_key=submission_key(update, index),
+            )
+            if job_id is not None:
+                queued += 1
+                print(f"Queued job {job_id}")
+        if queued < len(prompts):
+            # A redelivered update; its jobs were queued the first time
+            db_release_reservation(group_id, reservation_id, len(prompts) - queued)
+        if not queued:
+            return
+        await update.message.reply_text(
+            (
+                "Generating video..."
+                if len(prompts) == 1
+                else f"Generating {len(prompts)} videos..."
+            ),
+            reply_markup=cancel_markup(update.message.message_id),
         )
-        print(f"Response is: {response}")
-    except requests.exceptions.HTTPError as e:
-        await update.message.reply_text(f"Error: {e}")
         return
 
+    generation_tasks.add(asyncio.current_task())
+    outstanding[group_id] += len(prompts)
+    try:
+        if len(prompts) == 1:
+            video_url, error = await generate_video(
+                update,
+                group_id,
+                user_id,
+                images,
+                prompts[0],
+                profile,
+                tier,
+                seed,
+                reservation_id=reservation_id,
+                idempotency_key=submission_key(update),
+            )
+            if video_url:
+                await update.message.reply_video(video=video_url)
+            else:
+                await update.message.reply_text(error)
+        else:
+            await update.message.reply_text(
+                f"Generating {len(prompts)} videos...",
+                reply_markup=cancel_markup(update.message.message_id),
+            )
+            await generate_batch(
+                update,
+                group_id,
+                user_id,
+                images,
+                prompts,
+                profile,
+                tier,
+                reservation_id,
+            )
+    finally:
+        # Successful generations are counted in the usage table by now
+        db_release_reservation(group_id, reservation_id)
+        generation_tasks.discard(asyncio.current_task())
+        outstanding[group_id] -= len(prompts)
+        if outstanding[group_id] <= 0:
+            del outstanding[group_id]
+
+
+async def generate_video(
+    update,
+    group_id,
+    user_id,
+    images,
+    user_prompt,
+    profile,
+    tier,
+    seed=None,
+    announce=True,
+    reservation_id=None,
+    idempotency_key=None,
+):
+    """
+    Submit one prompt to Vidu and poll until the video is finished.
+
+    Calls to Vidu run in threads, at most VIDU_CONCURRENCY at a time over all
+    handlers.
+
+    Args:
+        update (Update): The update of the /imagine command.
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+        images (list): The reference images, as URLs or Base64.
+        user_prompt (str): The prompt.
+        profile (dict): The model, duration, aspect_ratio and resolution.
+        tier (str): The profile tier, recorded with the video.
+        seed (int, optional): The seed to render with.
+        announce (bool): Whether to reply once the task is created.
+        reservation_id (int, optional): The quota reservation of the command,
+            released by one slot if the user cancels.
+        idempotency_key (str, optional): Identifies the prompt of the command;
+            a redelivered update tracks the task created the first time
+            instead of submitting the prompt again.
+
+    Returns:
+        tuple: The video URL and None, or None and an error message.
+    """
+    claimed, task_id = True, None
+    if idempotency_key:
+        claimed, task_id = db_claim_submission(idempotency_key)
+        if not claimed and (task_id is None or task_id in tracked_tasks):
+            return None, "This video is already being generated."
+
+    if not claimed:
+        # A redelivered update: use the task created the first time
+        finished = db_get_memory_by_task(user_id, group_id, task_id)
+        if finished and finished[0] == "success":
+            return finished[1], None
+        if finished and finished[0] == "cancelled":
+            return None, CANCELLED_MESSAGE
+        response = {"task_id": task_id, "state": "created"}
+    else:
+        try:
+            response = await submit_video(images, user_prompt, profile, seed)
+        except requests.exceptions.RequestException as e:
+            if idempotency_key and submission_rejected(e):
+                db_release_submission(idempotency_key)
+            return None, f"Error: {e}"
+
     task_id = response.get("task_id")
     status = response.get("state")
 
     if not task_id:
-        await update.message.reply_text("Failed to create video generation task.")
-        return
+        if idempotency_key:
+            db_release_submission(idempotency_key)
+        return None, "Failed to create video generation task."
+    if idempotency_key:
+        db_complete_submission(idempotency_key, task_id)
 
     if status == "created":
         db_add_memory(
@@ -329,140 +1055,1115 @@ async def imagine(update: Update, context: ContextTypes.DEFAULT_TYPE):
             video_url="",
             task_id=task_id,
             status="pending",
+            prompt=user_prompt,
+            seed=response.get("seed"),
+            tier=tier,
+            idempotency_key=idempotency_key,
         )
-        await update.message.reply_text("Generating video...")
+        if announce:
+            await update.message.reply_text(
+                "Generating video...",
+                reply_markup=cancel_markup(update.message.message_id),
+            )
 
-    # Poll the API for the task status
-    for _ in range(MAX_POLLING_TIME_SECONDS // POLL_SLEEP_CYCLE_SECONDS):
-        status_response = get_generation_status(
-            mock=USE_MOCK_DATA, api_key=API_KEY, task_id=task_id
-        )
-        state = status_response.get("state")
+    tracked_tasks[task_id] = {
+        "task_id": task_id,
+        "group_id": group_id,
+        "user_id": user_id,
+        "chat_id": update.effective_chat.id,
+        "message_id": update.message.message_id,
+        "prompt": user_prompt,
+        "reservation_id": reservation_id,
+        "namespace": get_namespace(),
+    }
+    cancel_events[task_id] = asyncio.Event()
+    try:
+        return await poll_video(group_id, user_id, task_id)
+    finally:
+        tracked_tasks.pop(task_id, None)
+        cancel_events.pop(task_id, None)
 
-        if state == "success":
-            creations = status_response.get("creations", [])
-            if creations:
-                video_url = creations[0].get("url")
-                await update.message.reply_video(video=video_url)
-                db_update_usage(group_id, user_id)
-                db_update_video_url(user_id, group_id, task_id, video_url)
-            else:
-                await update.message.reply_text("No video URL found in the response.")
-            return
-        elif state == "failed":
-            await update.message.reply_text("Video generation failed.")
-            return
 
-        await asyncio.sleep(POLL_SLEEP_CYCLE_SECONDS)
+async def outstanding_counts(group_id):
+    """
+    Count the generations queued or in progress.
 
-    await update.message.reply_text(
-        "Video generation is taking too long. Use /memory <id> to check the status."
-    )
+    Args:
+        group_id (int): The group to count separately.
 
+    Returns:
+        tuple: The number in total and of the group.
+    """
+    if USE_JOB_QUEUE:
+        return await asyncio.to_thread(db_count_outstanding_jobs, group_id)
+    return sum(outstanding.values()), outstanding[group_id]
 
-async def memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    group_id = update.effective_chat.id
-    user_id = update.effective_user.id
 
-    # Check if an ID is passed as an argument
-    if context.args:
-        try:
-            memory_id = int(context.args[0])  # Parse the ID
-        except ValueError:
-            await update.message.reply_text(
-                "Invalid ID. Please provide a valid numeric ID."
-            )
-            return
+async def recent_completion_rate():
+    """
+    Get the number of generations finished per second recently.
 
-        # Fetch specific memory by ID
-        memory = db_get_memory_by_id(user_id, group_id, memory_id)
+    Returns:
+        float: The rate over the last COMPLETION_WINDOW_SECONDS.
+    """
+    if USE_JOB_QUEUE:
+        finished = await asyncio.to_thread(
+            db_count_finished_jobs, COMPLETION_WINDOW_SECONDS
+        )
+        return finished / COMPLETION_WINDOW_SECONDS
+    return completion_rate.per_second()
 
-        if not memory:
-            await update.message.reply_text(f"No memory found with ID {memory_id}.")
-            return
 
-        url, ts, task_id, status = memory
+async def submit_video(images, user_prompt, profile, seed=None):
+    """
+    Submit one prompt to Vidu, at most VIDU_CONCURRENCY calls at a time.
 
-        # Poll the API for the task status
-        if status == "pending":
-            await update.message.reply_text("Video is still being generated.")
-            for _ in range(MAX_POLLING_TIME_SECONDS // POLL_SLEEP_CYCLE_SECONDS):
-                status_response = get_generation_status(
-                    mock=USE_MOCK_DATA, api_key=API_KEY, task_id=task_id
-                )
-                state = status_response.get("state")
+    Returns:
+        dict: The response of the create endpoint.
+    """
+    async with vidu_semaphore:
+        # The seed is only passed for re-renders to keep other calls unchanged
+        response = await asyncio.to_thread(
+            reference_to_video,
+            mock=USE_MOCK_DATA,
+            api_key=API_KEY,
+            images=images,
+            prompt=f"{user_prompt}, {ENDING_PROMPT}",
+            **profile,
+            **({"seed": seed} if seed is not None else {}),
+        )
+    print(f"Response is: {response}")
+    return response
 
-                if state == "success":
-                    creations = status_response.get("creations", [])
-                    if creations:
-                        video_url = creations[0].get("url")
-                        db_update_usage(group_id, user_id)
-                        db_update_video_url(
-                            user_id, group_id, task_id, video_url, status="success"
-                        )
-                        await update.message.reply_video(video=video_url)
-                    else:
-                        await update.message.reply_text(
-                            "No video URL found in the response."
-                        )
-                    return
-                elif state == "failed":
-                    await update.message.reply_text("Video generation failed.")
-                    return
-
-                await asyncio.sleep(POLL_SLEEP_CYCLE_SECONDS)
-            await update.message.reply_text(
-                "Video generation is taking too long. Use /memory <id> to check the status."
-            )
-            return
-        elif status == "success":
-            await update.message.reply_video(video=url)
-            return
 
-        await update.message.reply_text(f"Generated at {ts} UTC:\n{url}")
-        return
+def submission_key(update, index=0):
+    """
+    Get the idempotency key of one prompt of a command.
 
-    # Fetch the last 5 memories if no ID is provided
-    history = db_get_memory(user_id, group_id)
+    Telegram redelivers an update with the same chat and message ID, so a
+    replayed command gets the same keys. Keys include the bot's namespace, as
+    every bot in a group receives the same message.
+
+    Args:
+        update (Update): The update of the command.
+        index (int): The position of the prompt in the command.
+
+    Returns:
+        str: The key.
+    """
+    key = f"{update.effective_chat.id}:{update.message.message_id}:{index}"
+    return f"{get_namespace()}:{key}" if get_namespace() else key
+
+
+async def poll_video(group_id, user_id, task_id):
+    """
+    Poll Vidu until a video is finished and record the result.
+
+    Args:
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+        task_id (str): The Vidu task ID.
+
+    Returns:
+        tuple: The video URL and None, or None and an error message.
+    """
+    for _ in range(int(MAX_POLLING_TIME_SECONDS // POLL_SLEEP_CYCLE_SECONDS)):
+        try:
+            async with vidu_semaphore:
+                status_response = await asyncio.to_thread(
+                    get_generation_status,
+                    mock=USE_MOCK_DATA,
+                    api_key=API_KEY,
+                    task_id=task_id,
+                )
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Status check for task {task_id} failed: {e}")
+            if await wait_for_next_poll(task_id):
+                return None, CANCELLED_MESSAGE
+            continue
+        state = status_response.get("state")
+        if state in ("success", "failed"):
+            # Only tasks Vidu finished tell how fast it works through them
+            completion_rate.record()
+
+        if state == "success":
+            creations = status_response.get("creations", [])
+            if not creations:
+                db_update_status(user_id, group_id, task_id, "failed")
+                return None, "No video URL found in the response."
+            video_url = creations[0].get("url")
+            db_complete_video(user_id, group_id, task_id, video_url)
+            return video_url, None
+        elif state == "failed":
+            db_update_status(user_id, group_id, task_id, "failed")
+            return None, "Video generation failed."
+
+        if await wait_for_next_poll(task_id):
+            return None, CANCELLED_MESSAGE
+
+    return (
+        None,
+        "Video generation is taking too long. Use /memory <id> to check the status.",
+    )
+
+
+async def wait_for_next_poll(task_id):
+    """
+    Sleep until the next status check of a task, waking early if the user
+    cancels it.
+
+    Args:
+        task_id (str): The Vidu task ID.
+
+    Returns:
+        bool: True if the generation was cancelled.
+    """
+    event = cancel_events.get(task_id)
+    if event is None:
+        await asyncio.sleep(POLL_SLEEP_CYCLE_SECONDS)
+        return False
+    try:
+        await asyncio.wait_for(event.wait(), POLL_SLEEP_CYCLE_SECONDS)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def cancel_markup(message_id):
+    """
+    Build the inline cancel button for the generations of a command.
+
+    Args:
+        message_id (int): The message of the /imagine command.
+
+    Returns:
+        InlineKeyboardMarkup: The keyboard.
+    """
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton("Cancel", callback_data=f"cancel:{message_id}")]]
+    )
+
+
+async def cancel_generations(group_id, user_id, message_id=None, task_id=None):
+    """
+    Cancel a user's unfinished generations, by the command that started them
+    or by Vidu task ID.
+
+    Running generations stop polling and queued jobs leave the queue. Their
+    reserved quota is released, their memory rows are marked cancelled and
+    Vidu is asked to cancel the tasks it already has.
+
+    Args:
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+        message_id (int, optional): The message of the /imagine command.
+        task_id (str, optional): The Vidu task ID.
+
+    Returns:
+        int: The number of generations cancelled.
+    """
+    cancelled = 0
+    for entry in list(tracked_tasks.values()):
+        if (entry["group_id"], entry["user_id"]) != (group_id, user_id):
+            continue
+        if message_id is not None and entry["message_id"] != message_id:
+            continue
+        if task_id is not None and entry["task_id"] != task_id:
+            continue
+        event = cancel_events.get(entry["task_id"])
+        if event is None or event.is_set():
+            continue
+        event.set()
+        if entry.get("reservation_id"):
+            db_release_reservation(group_id, entry["reservation_id"], slots=1)
+        await cancel_task(group_id, user_id, entry["task_id"])
+        cancelled += 1
+
+    if USE_JOB_QUEUE:
+        jobs = await asyncio.to_thread(
+            db_cancel_jobs, user_id, group_id, message_id=message_id, task_id=task_id
+        )
+        for job in jobs:
+            if job["params"].get("reservation_id"):
+                db_release_reservation(
+                    group_id, job["params"]["reservation_id"], slots=1
+                )
+            if job["task_id"]:
+                await cancel_task(group_id, user_id, job["task_id"])
+        cancelled += len(jobs)
+    return cancelled
+
+
+async def cancel_task(group_id, user_id, task_id):
+    """
+    Mark a video cancelled and cancel its task at Vidu.
+
+    Args:
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+        task_id (str): The Vidu task ID.
+    """
+    db_cancel_memory(user_id, group_id, task_id)
+    try:
+        await asyncio.to_thread(
+            cancel_generation, mock=USE_MOCK_DATA, api_key=API_KEY, task_id=task_id
+        )
+    except requests.exceptions.RequestException as e:
+        # Usually the task finished in the meantime
+        logging.warning(f"Cancelling task {task_id} at Vidu failed: {e}")
+
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the /cancel command to stop one of the user's videos.
+
+    Usage:
+        /cancel <id>
+    """
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        await update.message.reply_text("Usage: /cancel <id>")
+        return
+    video_id = int(context.args[0])
+    group_id = update.effective_chat.id
+    user_id = update.effective_user.id
+
+    memory = db_get_memory_by_id(user_id, group_id, video_id)
+    if not memory:
+        await update.message.reply_text(f"No memory found with ID {video_id}.")
+        return
+    _, _, task_id, status = memory
+    if status != "pending":
+        await update.message.reply_text(f"Video {video_id} is already {status}.")
+        return
+
+    if not await cancel_generations(group_id, user_id, task_id=task_id):
+        # Not tracked any more, e.g. polling gave up; Vidu may still have it
+        await cancel_task(group_id, user_id, task_id)
+    await update.message.reply_text(f"Video {video_id} cancelled.")
+
+
+async def cancel_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the inline cancel button under "Generating video...".
+
+    Only the user who sent the command can cancel its generations.
+    """
+    query = update.callback_query
+    message_id = int(query.data.split(":")[1])
+    cancelled = await cancel_generations(
+        query.message.chat.id, query.from_user.id, message_id=message_id
+    )
+    if cancelled:
+        await query.answer(
+            "Video cancelled." if cancelled == 1 else f"{cancelled} videos cancelled."
+        )
+        await query.edit_message_reply_markup(reply_markup=None)
+    else:
+        await query.answer("Nothing to cancel.")
+
+
+async def generate_batch(
+    update, group_id, user_id, images, prompts, profile, tier, reservation_id=None
+):
+    """
+    Generate several prompts concurrently and deliver the results.
+
+    If all videos finish within MEDIA_GROUP_WAIT_SECONDS of the first one
+    they are sent together as one media group; otherwise each result is sent
+    as soon as it is ready.
+
+    Args:
+        update (Update): The update of the /imagine command.
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+        images (list): The reference images, as URLs or Base64.
+        prompts (list): The prompts.
+        profile (dict): The model, duration, aspect_ratio and resolution.
+        tier (str): The profile tier, recorded with the videos.
+        reservation_id (int, optional): The quota reservation of the command.
+    """
+    tasks = {
+        asyncio.create_task(
+            generate_video(
+                update,
+                group_id,
+                user_id,
+                images,
+                prompt,
+                profile,
+                tier,
+                announce=False,
+                reservation_id=reservation_id,
+                idempotency_key=submission_key(update, index),
+            )
+        ): prompt
+        for index, prompt in enumerate(prompts)
+    }
+
+    async def deliver(task):
+        video_url, error = task.result()
+        if video_url:
+            await update.message.reply_video(video=video_url, caption=tasks[task])
+        else:
+            await update.message.reply_text(f"{tasks[task]}: {error}")
+
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        if pending:
+            more, pending = await asyncio.wait(
+                pending, timeout=MEDIA_GROUP_WAIT_SECONDS
+            )
+            done |= more
+
+        if pending:
+            for task in done:
+                await deliver(task)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    await deliver(task)
+            return
+
+        finished = [task for task in tasks if task.result()[0]]
+        if len(finished) > 1:
+            await update.message.reply_media_group(
+                [
+                    InputMediaVideo(task.result()[0], caption=tasks[task])
+                    for task in finished
+                ]
+            )
+        for task in tasks:
+            if len(finished) == 1 or not task.result()[0]:
+                await deliver(task)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    group_id = update.effective_chat.id
+    user_id = update.effective_user.id
+
+    # Check if an ID is passed as an argument
+    if context.args:
+        try:
+            memory_id = int(context.args[0])  # Parse the ID
+        except ValueError:
+            await update.message.reply_text(
+                "Invalid ID. Please provide a valid numeric ID."
+            )
+            return
+
+        # Fetch specific memory by ID
+        memory = db_get_memory_by_id(user_id, group_id, memory_id)
+
+        if not memory:
+            await update.message.reply_text(f"No memory found with ID {memory_id}.")
+            return
+
+        url, ts, task_id, status = memory
+
+        # Poll the API for the task status
+        if status == "pending":
+            await update.message.reply_text("Video is still being generated.")
+            # Tracked like a new generation, so /cancel and shutdown see it;
+            # a task still tracked by its /imagine command is left to it
+            tracking = task_id not in tracked_tasks
+            if tracking:
+                tracked_tasks[task_id] = {
+                    "task_id": task_id,
+                    "group_id": group_id,
+                    "user_id": user_id,
+                    "chat_id": update.effective_chat.id,
+                    "message_id": update.message.message_id,
+                    "prompt": None,
+                    "reservation_id": None,
+                    "namespace": get_namespace(),
+                }
+                cancel_events[task_id] = asyncio.Event()
+                generation_tasks.add(asyncio.current_task())
+            try:
+                video_url, error = await poll_video(group_id, user_id, task_id)
+            finally:
+                if tracking:
+                    tracked_tasks.pop(task_id, None)
+                    cancel_events.pop(task_id, None)
+                    generation_tasks.discard(asyncio.current_task())
+            if video_url:
+                await update.message.reply_video(video=video_url)
+            else:
+                await update.message.reply_text(error)
+            return
+        elif status == "success":
+            await update.message.reply_video(video=url)
+            return
+        elif status == "cancelled":
+            await update.message.reply_text(f"Video {memory_id} was cancelled.")
+            return
+
+        await update.message.reply_text(f"Generated at {ts} UTC:\n{url}")
+        return
+
+    # Fetch the latest page of memories if no ID is provided
+    history = db_get_memory(user_id, group_id, limit=MEMORY_PAGE_SIZE + 1)
     if not history:
         await update.message.reply_text("No past videos found.")
         return
 
-    # Combine all rows into a single message
-    message = f"Here are your last {len(history)} generated videos:\n\n"
+    message, reply_markup = memory_page(
+        user_id, history[:MEMORY_PAGE_SIZE], has_older=len(history) > MEMORY_PAGE_SIZE
+    )
+    await update.message.reply_text(message, reply_markup=reply_markup)
+
+
+def memory_page(user_id, history, has_older=False, has_newer=False, first=True):
+    """
+    Build the text and navigation buttons for a page of a user's videos.
+
+    Args:
+        user_id (int): The ID of the user the page belongs to.
+        history (list): Rows (user_video_id, video_url, timestamp), newest first.
+        has_older (bool): Whether older videos exist.
+        has_newer (bool): Whether newer videos exist.
+        first (bool): Whether this is the latest page.
+
+    Returns:
+        tuple: The message text and an InlineKeyboardMarkup or None.
+    """
+    if first:
+        message = f"Here are your last {len(history)} generated videos:\n\n"
+    else:
+        message = f"Here are {len(history)} of your generated videos:\n\n"
     for video_id, url, ts in history:
         formatted_ts = datetime.fromisoformat(ts).strftime("%Y-%m-%d")
         message += f"ID: {video_id} - Generated at {formatted_ts}\n"
     message += "\nUse /memory <id> to view a specific video."
-    await update.message.reply_text(message)
+
+    # Keyset cursors: the newest and oldest IDs shown on this page
+    buttons = []
+    if has_newer:
+        buttons.append(
+            InlineKeyboardButton(
+                "« Newer", callback_data=f"memory:{user_id}:newer:{history[0][0]}"
+            )
+        )
+    if has_older:
+        buttons.append(
+            InlineKeyboardButton(
+                "Older »", callback_data=f"memory:{user_id}:older:{history[-1][0]}"
+            )
+        )
+    return message, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def memory_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the inline buttons that page through a user's /memory history.
+
+    Args:
+        update (Update): The incoming update from the Telegram bot.
+        context (ContextTypes.DEFAULT_TYPE): The context for the callback.
+    """
+    query = update.callback_query
+    _, owner_id, direction, cursor = query.data.split(":")
+    if query.from_user.id != int(owner_id):
+        await query.answer("Use /memory to see your own videos.", show_alert=True)
+        return
+
+    group_id = update.effective_chat.id
+    user_id = int(owner_id)
+    if direction == "older":
+        history = db_get_memory(
+            user_id, group_id, before_id=int(cursor), limit=MEMORY_PAGE_SIZE + 1
+        )
+        has_older, has_newer = len(history) > MEMORY_PAGE_SIZE, True
+        history = history[:MEMORY_PAGE_SIZE]
+    else:
+        history = db_get_memory(
+            user_id, group_id, after_id=int(cursor), limit=MEMORY_PAGE_SIZE + 1
+        )
+        has_older, has_newer = True, len(history) > MEMORY_PAGE_SIZE
+        history = history[-MEMORY_PAGE_SIZE:]
+
+    await query.answer()
+    if not history:
+        await query.edit_message_text("No more videos found.")
+        return
+
+    message, reply_markup = memory_page(
+        user_id, history, has_older, has_newer, first=not has_newer
+    )
+    await query.edit_message_text(message, reply_markup=reply_markup)
+
+
+async def set_group_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the /sgp command to show or change a group's generation profiles.
+
+    Args:
+        update (Update): The incoming update from the Telegram bot.
+        context (ContextTypes.DEFAULT_TYPE): The context for the command, including arguments.
+
+    Behavior:
+        - Checks if the user has admin permissions.
+        - Without settings, shows the effective settings of every tier.
+        - With key=value settings, overrides them for the tier.
+        - With "reset", removes the tier's overrides.
+
+    Usage:
+        /sgp [group_id] [<tier> <key=value ...>|<tier> reset]
+    """
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "You don't have permission to set group profiles."
+        )
+        return
+
+    args = list(context.args)
+    group_id = update.effective_chat.id
+    if args:
+        try:
+            group_id = int(args[0])
+            args.pop(0)
+        except ValueError:
+            pass
+
+    if not args:
+        message = f"Generation profiles for group {group_id}:\n"
+        for tier in PROFILE_DEFAULTS:
+            profile = get_profile(group_id, tier)
+            message += f"\n{tier}: " + ", ".join(
+                f"{key}={value}" for key, value in profile.items()
+            )
+        await update.message.reply_text(message)
+        return
+
+    usage = (
+        "Usage: /sgp [group_id] <tier> <key=value ...>\n"
+        f"Tiers: {', '.join(PROFILE_DEFAULTS)}\n"
+        + "\n".join(
+            f"{key}: {', '.join(values)}" for key, values in PROFILE_CHOICES.items()
+        )
+    )
+    tier = args[0].lower()
+    if tier not in PROFILE_DEFAULTS or len(args) < 2:
+        await update.message.reply_text(usage)
+        return
+
+    if args[1].lower() == "reset":
+        db_reset_profile(group_id, tier)
+        await update.message.reply_text(
+            f"The {tier} profile of group {group_id} was reset to the defaults."
+        )
+        return
+
+    settings = {}
+    for arg in args[1:]:
+        key, _, value = arg.partition("=")
+        if value not in PROFILE_CHOICES.get(key, ()):
+            await update.message.reply_text(usage)
+            return
+        settings[key] = int(value) if key == "duration" else value
+
+    db_set_profile(group_id, tier, **settings)
+    profile = get_profile(group_id, tier)
+    await update.message.reply_text(
+        f"The {tier} profile of group {group_id} is now "
+        + ", ".join(f"{key}={value}" for key, value in profile.items())
+    )
 
 
 async def get_tracked_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Display all groups where the bot is added.
+    Display the groups where the bot is added, one page at a time.
 
     Args:
         update (Update): The incoming update from the Telegram bot.
-        context (ContextTypes.DEFAULT_TYPE): The context for the command.
+        context (ContextTypes.DEFAULT_TYPE): The context for the command, including arguments.
+
+    Usage:
+        /groups [name prefix]
     """
-    if update.effective_user.id not in ADMIN_IDs:
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text(
             "You don't have permission to view this information."
         )
         return
 
-    groups = db_get_all_groups()
-    if not groups:
+    name_prefix = (
+        " ".join(context.args)
+        .encode()[:GROUPS_PREFIX_MAX_BYTES]
+        .decode(errors="ignore")
+    )
+    message, reply_markup = groups_page(name_prefix)
+    if message is None:
         await update.message.reply_text("No groups found.")
         return
 
-    message = "Here are the groups where the bot is added:\n\n"
-    for group_id, group_name in groups:
-        message += f"Name: {group_name}\nID: {group_id}\n\n"
+    await update.message.reply_text(message, reply_markup=reply_markup)
+
+
+def groups_page(name_prefix="", after_id=None, before_id=None):
+    """
+    Build one page of the group listing that fits in a single message.
+
+    Groups are streamed from the database until the next one would push the
+    message over Telegram's size limit.
+
+    Args:
+        name_prefix (str): Only list groups whose name starts with this.
+        after_id (int, optional): Start after this group.
+        before_id (int, optional): End before this group.
+
+    Returns:
+        tuple: The message text and an InlineKeyboardMarkup or None, or
+        (None, None) if there are no groups on the page.
+    """
+    header = "Here are the groups where the bot is added:\n\n"
+    if name_prefix:
+        header = f"Groups starting with '{name_prefix}':\n\n"
+
+    entries = []
+    size = len(header)
+    has_more = False
+    rows = db_iter_groups(name_prefix or None, after_id=after_id, before_id=before_id)
+    try:
+        for group_id, group_name, group_limit, user_limit, month_calls in rows:
+            entry = (
+                f"Name: {group_name}\nID: {group_id}\n"
+                f"Used this month: {month_calls}/{group_limit or 'unlimited'} "
+                f"(per user: {user_limit or 'unlimited'})\n\n"
+            )
+            if size + len(entry) > GROUPS_PAGE_MAX_CHARS:
+                has_more = True
+                break
+            entries.append((group_id, entry))
+            size += len(entry)
+    finally:
+        rows.close()
+
+    if not entries:
+        return None, None
+    if before_id is not None:
+        entries.reverse()
+
+    # When paging backwards the page we came from is "newer", and vice versa
+    has_previous = has_more if before_id is not None else after_id is not None
+    has_next = has_more if before_id is None else True
+    buttons = []
+    if has_previous:
+        buttons.append(
+            InlineKeyboardButton(
+                "« Previous", callback_data=f"groups:p:{entries[0][0]}:{name_prefix}"
+            )
+        )
+    if has_next:
+        buttons.append(
+            InlineKeyboardButton(
+                "Next »", callback_data=f"groups:n:{entries[-1][0]}:{name_prefix}"
+            )
+        )
+    message = header + "".join(entry for _, entry in entries)
+    return message, InlineKeyboardMarkup([buttons]) if buttons else None
 
+
+async def groups_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the inline buttons that page through the /groups listing.
+
+    Args:
+        update (Update): The incoming update from the Telegram bot.
+        context (ContextTypes.DEFAULT_TYPE): The context for the callback.
+    """
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        await query.answer(
+            "You don't have permission to view this information.", show_alert=True
+        )
+        return
+
+    _, direction, cursor, name_prefix = query.data.split(":", 3)
+    if direction == "n":
+        message, reply_markup = groups_page(name_prefix, after_id=int(cursor))
+    else:
+        message, reply_markup = groups_page(name_prefix, before_id=int(cursor))
+
+    await query.answer()
+    if message is None:
+        await query.edit_message_text("No more groups found.")
+        return
+    await query.edit_message_text(message, reply_markup=reply_markup)
+
+
+async def loop_lag(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Display the current event loop lag and the call sites that blocked it.
+
+    Args:
+        update (Update): The incoming update from the Telegram bot.
+        context (ContextTypes.DEFAULT_TYPE): The context for the command.
+    """
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "You don't have permission to view this information."
+        )
+        return
+
+    if not loop_monitor.running:
+        await update.message.reply_text("Loop lag monitor is not running.")
+        return
+
+    await update.message.reply_text(loop_monitor.summary())
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the /profile command to profile the running bot for a time window.
+
+    Args:
+        update (Update): The incoming update from the Telegram bot.
+        context (ContextTypes.DEFAULT_TYPE): The context for the command, including arguments.
+
+    Behavior:
+        - Checks if the user has admin permissions.
+        - Profiles every handler on the event loop for the requested window.
+        - Sends a hot-function summary and the raw profile as a file.
+
+    Usage:
+        /profile <seconds>
+    """
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "You don't have permission to run the profiler."
+        )
+        return
+
+    try:
+        seconds = int(context.args[0])
+    except (ValueError, IndexError):
+        await update.message.reply_text("Usage: /profile <seconds>")
+        return
+
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(
+            f"Please choose between 1 and {PROFILE_MAX_SECONDS} seconds."
+        )
+        return
+
+    if profiler.active:
+        await update.message.reply_text("A profiling session is already running.")
+        return
+
+    await update.message.reply_text(f"Profiling for {seconds} seconds...")
+    report, raw = await profiler.run(seconds)
+    await update.message.reply_text(report)
+    await update.message.reply_document(
+        document=raw,
+        filename=f"curvebot-{datetime.now().strftime('%Y%m%d-%H%M%S')}.prof",
+        caption="Open with python -m pstats or snakeviz.",
+    )
+
+
+async def db_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Display per-statement database timing statistics.
+
+    Args:
+        update (Update): The incoming update from the Telegram bot.
+        context (ContextTypes.DEFAULT_TYPE): The context for the command, including arguments.
+
+    Usage:
+        /dbstats [reset]
+    """
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "You don't have permission to view this information."
+        )
+        return
+
+    if context.args and context.args[0].lower() == "reset":
+        query_stats.reset()
+        await update.message.reply_text("Query statistics have been reset.")
+        return
+
+    summary = query_stats.summary()
+    if not summary:
+        await update.message.reply_text("No queries recorded yet.")
+        return
+
+    message = "Slowest statements by total time (count, p50/p95/max ms, rows):\n\n"
+    for row in summary[:DB_STATS_TOP_N]:
+        message += (
+            f"{row['count']}x, {row['p50_ms']:.1f}/{row['p95_ms']:.1f}/"
+            f"{row['max_ms']:.1f} ms, {row['rows']} rows\n{row['sql'][:200]}\n\n"
+        )
+    await update.message.reply_text(message[:4096])
+
+
+def _success_rate(successes, failures):
+    finished = successes + failures
+    return f"{successes / finished * 100:.0f}%" if finished else "n/a"
+
+
+def _latency(latency_ms):
+    return f"{latency_ms / 1000:.1f}s" if latency_ms is not None else "n/a"
+
+
+async def usage_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Display usage statistics for a group, or for all groups this month.
+
+    Served from the precomputed `group_stats` aggregates.
+
+    Args:
+        update (Update): The incoming update from the Telegram bot.
+        context (ContextTypes.DEFAULT_TYPE): The context for the command, including arguments.
+
+    Usage:
+        /stats [group_id]
+    """
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "You don't have permission to view this information."
+        )
+        return
+
+    if context.args:
+        try:
+            group_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text(
+                "Invalid group ID. Please provide a valid numeric group ID."
+            )
+            return
+    elif update.effective_chat.id < 0:
+        group_id = update.effective_chat.id
+    else:
+        group_id = None
+
+    if group_id is None:
+        totals, groups = await asyncio.to_thread(
+            db_get_stats_overview, STATS_TOP_GROUPS
+        )
+        calls, successes, failures, latency_ms = totals
+        message = (
+            f"All groups, {db_get_month()}:\n"
+            f"Calls: {calls}\n"
+            f"Succeeded: {successes}, failed: {failures} "
+            f"({_success_rate(successes, failures)} success)\n"
+            f"Average generation time: {_latency(latency_ms)}\n"
+        )
+        if groups:
+            message += "\nBusiest groups:\n"
+        for group_id, group_name, calls, successes, failures in groups:
+            message += (
+                f"{group_name or group_id}: {calls} calls, "
+                f"{_success_rate(successes, failures)} success\n"
+            )
+        await update.message.reply_text(message)
+        return
+
+    monthly, users = await asyncio.to_thread(
+        db_get_group_stats, group_id, STATS_MONTHS, STATS_TOP_USERS
+    )
+    if not monthly:
+        await update.message.reply_text(f"No usage recorded for group {group_id}.")
+        return
+
+    message = f"Group {group_id}:\n\n"
+    for month, calls, successes, failures, latency_ms in monthly:
+        message += (
+            f"{month}: {calls} calls, {successes} succeeded, {failures} failed "
+            f"({_success_rate(successes, failures)}), "
+            f"avg {_latency(latency_ms)}\n"
+        )
+    if users:
+        message += "\nTop users this month:\n"
+    for user_id, calls in users:
+        message += f"{user_id}: {calls} calls\n"
     await update.message.reply_text(message)
 
 
+async def deliver_finished_jobs(application):
+    """
+    Send the results of jobs finished by the worker processes.
+
+    Args:
+        application (Application): The Telegram application.
+    """
+    while True:
+        try:
+            jobs = await asyncio.to_thread(db_get_finished_jobs)
+        except Exception as e:
+            logging.error(f"Fetching finished jobs failed: {e}")
+            jobs = []
+        for job_id, chat_id, message_id, state, video_url, error in jobs:
+            try:
+                if state == "success":
+                    await application.bot.send_video(
+                        chat_id=chat_id, video=video_url, reply_to_message_id=message_id
+                    )
+                else:
+                    await application.bot.send_message(
+                        chat_id=chat_id,
+                        text=error or "Video generation failed.",
+                        reply_to_message_id=message_id,
+                    )
+            except (Forbidden, BadRequest) as e:
+                # Retrying can't help when the bot was removed from the chat
+                # or the command was deleted, so the job is given up
+                logging.warning(f"Dropping result of job {job_id}: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Left undelivered, so the next round tries it again
+                logging.error(f"Delivering job {job_id} failed: {e}")
+                continue
+            try:
+                await asyncio.to_thread(db_mark_job_delivered, job_id)
+            except Exception as e:
+                logging.error(f"Marking job {job_id} delivered failed: {e}")
+        await asyncio.sleep(DELIVERY_INTERVAL_SECONDS)
+
+
+async def resume_generation(application, checkpoint):
+    """
+    Finish tracking a generation checkpointed by the last shutdown and deliver
+    the result as a reply to the original command.
+
+    Args:
+        application (Application): The Telegram application.
+        checkpoint (dict): The saved tracking state.
+    """
+    task_id = checkpoint["task_id"]
+    tracked_tasks[task_id] = checkpoint
+    cancel_events[task_id] = asyncio.Event()
+    try:
+        video_url, error = await poll_video(
+            checkpoint["group_id"], checkpoint["user_id"], task_id
+        )
+        if video_url:
+            await application.bot.send_video(
+                chat_id=checkpoint["chat_id"],
+                video=video_url,
+                reply_to_message_id=checkpoint["message_id"],
+            )
+        else:
+            await application.bot.send_message(
+                chat_id=checkpoint["chat_id"],
+                text=error,
+                reply_to_message_id=checkpoint["message_id"],
+            )
+        await asyncio.to_thread(db_delete_checkpoint, task_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"Resuming task {task_id} failed: {e}")
+        await asyncio.to_thread(db_delete_checkpoint, task_id)
+    finally:
+        tracked_tasks.pop(task_id, None)
+        cancel_events.pop(task_id, None)
+        generation_tasks.discard(asyncio.current_task())
+
+
+async def graceful_shutdown(*applications):
+    """
+    Stop the bots on SIGTERM without losing running generations.
+
+    Stops fetching updates, waits up to SHUTDOWN_DRAIN_SECONDS for running
+    generations, checkpoints the Vidu tasks still being tracked so the next
+    start delivers them, and flushes the databases before stopping.
+
+    Args:
+        *applications (Application): The Telegram applications.
+    """
+    global shutting_down
+    if shutting_down:
+        return
+    shutting_down = True
+    logging.info(f"Shutting down, draining {len(generation_tasks)} generations")
+    for application in applications:
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+
+    pending = set()
+    if generation_tasks:
+        _, pending = await asyncio.wait(
+            set(generation_tasks), timeout=SHUTDOWN_DRAIN_SECONDS
+        )
+    if tracked_tasks:
+        await asyncio.to_thread(db_save_checkpoints, list(tracked_tasks.values()))
+        logging.info(f"Checkpointed {len(tracked_tasks)} unfinished generations")
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for namespace in served_namespaces:
+        with use_namespace(namespace):
+            await asyncio.to_thread(db_checkpoint_wal)
+    for application in applications:
+        application.stop_running()
+
+
+async def start_services(applications):
+    """
+    Start the services all bots share once the event loop is running.
+
+    Args:
+        applications (list): The Telegram applications, stopped together on
+            SIGTERM or SIGINT.
+    """
+    loop_monitor.start()
+    try:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            asyncio.get_running_loop().add_signal_handler(
+                signum,
+                lambda: background_tasks.append(
+                    asyncio.create_task(graceful_shutdown(*applications))
+                ),
+            )
+    except NotImplementedError:  # Windows
+        logging.warning("Graceful shutdown on SIGTERM is not supported here")
+
+
+async def post_init(application):
+    """
+    Start the background services of one bot once the event loop is running.
+
+    Runs in the bot's context, so the loops started here use its databases.
+
+    Args:
+        application (Application): The Telegram application.
+    """
+    background_tasks.append(asyncio.create_task(retention_loop()))
+    background_tasks.append(
+        asyncio.create_task(sweep_loop(API_KEY, mock=USE_MOCK_DATA))
+    )
+    for checkpoint in await asyncio.to_thread(db_get_checkpoints):
+        generation_tasks.add(
+            asyncio.create_task(resume_generation(application, checkpoint))
+        )
+    if USE_JOB_QUEUE:
+        background_tasks.append(asyncio.create_task(deliver_finished_jobs(application)))
+
+
+async def stop_services():
+    """
+    Stop the background services and close the shared clients once every
+    application has shut down.
+    """
+    await loop_monitor.stop()
+    for task in [*background_tasks, *reference_prefetches]:
+        task.cancel()
+    await asyncio.gather(
+        *background_tasks, *reference_prefetches, return_exceptions=True
+    )
+    background_tasks.clear()
+    await reference_checker.close()
+    await reference_cache.close()
+
+
 async def bot_added_to_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Handle the event when the bot is added to a group.
@@ -486,6 +2187,158 @@ async def bot_added_to_group(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
 
 
+def load_bot_configs():
+    """
+    Get the bots to serve: those listed in the JSON file at BOTS_CONFIG, or
+    the single bot of BOT_TOKEN and ADMIN_ID.
+
+    Returns:
+        list: Dicts with token, admin_ids and namespace.
+
+    Raises:
+        OSError: If BOTS_CONFIG can't be read.
+        ValueError: If BOTS_CONFIG is invalid.
+    """
+    path = os.getenv("BOTS_CONFIG")
+    if not path:
+        return [
+            {"token": os.getenv("BOT_TOKEN"), "admin_ids": ADMIN_IDs, "namespace": ""}
+        ]
+    with open(path) as f:
+        return parse_bot_configs(f)
+
+
+def bot_context(config):
+    """
+    Create the context a bot's updates, background loops and database calls
+    run in, selecting its admins and database namespace.
+
+    Args:
+        config (dict): The bot's token, admin_ids and namespace.
+
+    Returns:
+        contextvars.Context: The context.
+    """
+    context = contextvars.copy_context()
+    context.run(bot_admin_ids.set, config["admin_ids"])
+    context.run(set_namespace, config["namespace"])
+    return context
+
+
+def build_application(token):
+    """
+    Build a Telegram application with all handlers.
+
+    Args:
+        token (str): The bot token.
+
+    Returns:
+        Application: The application.
+    """
+    application = ApplicationBuilder().token(token).build()
+    # Group -1 runs before all other handlers
+    application.add_handler(TypeHandler(Update, throttle_commands), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("reference", reference))
+    application.add_handler(CommandHandler("sgl", set_group_limit))
+    application.add_handler(CommandHandler("sul", set_user_limit))
+    application.add_handler(CommandHandler("sqw", set_quota_window))
+    application.add_handler(CommandHandler("imagine", imagine, block=False))
+    application.add_handler(CommandHandler("upscale", upscale, block=False))
+    application.add_handler(CommandHandler("sgp", set_group_profile))
+    application.add_handler(CommandHandler("cancel", cancel))
+    application.add_handler(CallbackQueryHandler(cancel_button, pattern=r"^cancel:"))
+    application.add_handler(CommandHandler("memory", memory))
+    application.add_handler(
+        CallbackQueryHandler(memory_navigation, pattern=r"^memory:")
+    )
+    application.add_handler(CommandHandler("groups", get_tracked_groups))
+    application.add_handler(CommandHandler("stats", usage_stats))
+    application.add_handler(
+        CallbackQueryHandler(groups_navigation, pattern=r"^groups:")
+    )
+    application.add_handler(CommandHandler("lag", loop_lag))
+    application.add_handler(CommandHandler("dbstats", db_stats))
+    # Non-blocking so the profiled window can see other updates being handled
+    application.add_handler(CommandHandler("profile", profile, block=False))
+    application.add_handler(
+        MessageHandler(
+            filters.Document.TEXT | filters.Document.MimeType("application/json"),
+            handle_file_upload,
+        )
+    )
+    application.add_handler(
+        ChatMemberHandler(bot_added_to_group, ChatMemberHandler.MY_CHAT_MEMBER)
+    )
+    return application
+
+
+async def start_bot(application):
+    """
+    Initialize and start one bot; run in its context.
+
+    Args:
+        application (Application): The Telegram application.
+    """
+    await asyncio.to_thread(init_db)
+    await application.initialize()
+    await post_init(application)
+    await application.updater.start_polling()
+    await application.start()
+
+
+async def stop_bot(application):
+    """
+    Stop and shut down one bot; run in its context.
+
+    Args:
+        application (Application): The Telegram application.
+    """
+    if application.updater.running:
+        await application.updater.stop()
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+
+
+def run_bots(configs):
+    """
+    Serve several bots from one event loop until SIGTERM or SIGINT.
+
+    Each bot runs in its own context (see `bot_context`), which the tasks of
+    its updates inherit. The Vidu and HTTP clients, caches, throttles and the
+    job queue are shared. Follows Application.run_polling, which only runs
+    one application.
+
+    Args:
+        configs (list): Dicts with token, admin_ids and namespace.
+    """
+    served_namespaces[:] = [config["namespace"] for config in configs]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bots = []
+    try:
+        for config in configs:
+            context = bot_context(config)
+            application = build_application(config["token"])
+            bots.append((application, context))
+            loop.run_until_complete(
+                loop.create_task(start_bot(application), context=context)
+            )
+            logging.info(f"Serving bot {config['namespace'] or 'default'}")
+        loop.run_until_complete(start_services([app for app, _ in bots]))
+        loop.run_forever()
+    except (KeyboardInterrupt, SystemExit):
+        logging.info("Stopping the bots")
+    finally:
+        for application, context in bots:
+            loop.run_until_complete(
+                loop.create_task(stop_bot(application), context=context)
+            )
+        loop.run_until_complete(stop_services())
+        loop.close()
+
+
 if __name__ == "__main__":
     print("Running CurveBot...")
     # Parse command-line arguments
@@ -495,23 +2348,65 @@ if __name__ == "__main__":
         action="store_true",
         help="Use mock data instead of connecting to external APIs.",
     )
+    parser.add_argument(
+        "--simulator",
+        action="store_true",
+        help="Run against a local Vidu API simulator with realistic timing.",
+    )
+    parser.add_argument(
+        "--queue",
+        action="store_true",
+        help="Enqueue generations for worker processes instead of running them here.",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Run worker processes that submit and track queued generations.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Number of worker processes to run with --worker.",
+    )
+    parser.add_argument(
+        "--rebalance-shards",
+        type=int,
+        metavar="N",
+        help="Move usage, limits and memory rows of the database into N shards and exit.",
+    )
     args = parser.parse_args()
 
     # Check if mock data is enabled
     USE_MOCK_DATA = args.mockdata
+    USE_JOB_QUEUE = args.queue
+
+    if args.simulator:
+        from vidu_simulator import ViduSimulator
+
+        os.environ["VIDU_API_BASE_URL"] = ViduSimulator().start()
+
+    if os.getenv("SLOW_QUERY_LOG"):
+        logging.getLogger("services.slow_query").addHandler(
+            logging.FileHandler(os.getenv("SLOW_QUERY_LOG"))
+        )
+
+    if args.rebalance_shards:
+        moved = db_rebalance_into_shards(args.rebalance_shards)
+        print(f"Moved rows into {args.rebalance_shards} shards: {moved}")
+        print(f"Run the bot with DB_SHARDS={args.rebalance_shards} from now on.")
+        raise SystemExit(0)
+
+    if args.worker:
+        from worker import run_workers
+
+        run_workers(API_KEY, mock=USE_MOCK_DATA, processes=args.processes)
+        raise SystemExit(0)
 
     # --- Bot Init ---
+    try:
+        configs = load_bot_configs()
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"Invalid BOTS_CONFIG: {e}")
     init_db()
-    app = ApplicationBuilder().token(os.getenv("BOT_TOKEN")).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("reference", reference))
-    app.add_handler(CommandHandler("sgl", set_group_limit))
-    app.add_handler(CommandHandler("sul", set_user_limit))
-    app.add_handler(CommandHandler("imagine", imagine))
-    app.add_handler(CommandHandler("memory", memory))
-    app.add_handler(CommandHandler("groups", get_tracked_groups))
-    app.add_handler(MessageHandler(filters.Document.TEXT, handle_file_upload))
-    app.add_handler(
-        ChatMemberHandler(bot_added_to_group, ChatMemberHandler.MY_CHAT_MEMBER)
-    )
-    app.run_polling()
+    run_bots(configs)
@@ -0,0 +1,293 @@
+import io
+import os
+import sys
+import time
+import marshal
+import cProfile
+import pstats
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _is_project_frame(filename):
+    """
+    Check whether a stack frame belongs to this repository's code.
+
+    Args:
+        filename (str): The filename of the frame.
+
+    Returns:
+        bool: True if the frame comes from a module of this project.
+    """
+    path = os.path.abspath(filename)
+    return path.startswith(PROJECT_DIR) and "site-packages" not in path
+
+
+def _call_site(stack):
+    """
+    Pick the most relevant call site from a stack snapshot.
+
+    The innermost frame from this project is preferred, so a blocking
+    `requests.get` is attributed to the line in vidu.py that issued it rather
+    than to a socket read deep inside the standard library.
+
+    Args:
+        stack (traceback.StackSummary): The stack, outermost frame first.
+
+    Returns:
+        str: The call site formatted as "file:line in function".
+    """
+    frames = [f for f in stack if _is_project_frame(f.filename)] or list(stack)
+    if not frames:
+        return "<unknown>"
+    frame = frames[-1]
+    return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+
+
+class LoopLagMonitor:
+    """
+    Measure event-loop scheduling delay and attribute stalls to call sites.
+
+    An asyncio task sleeps for a fixed interval and records how late it wakes
+    up. A watchdog thread watches the time of the last tick; when the loop has
+    not ticked for longer than the threshold it snapshots the stack of the
+    loop thread, which is the code that is blocking the loop at that moment.
+    """
+
+    def __init__(self, interval=0.1, threshold=0.25, top_n=10, report_interval=300):
+        """
+        Args:
+            interval (float): Sampling interval in seconds.
+            threshold (float): Lag in seconds above which a stall is recorded.
+            top_n (int): Number of call sites included in reports.
+            report_interval (float): Seconds between aggregated log reports.
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.top_n = top_n
+        self.report_interval = report_interval
+
+        self.current_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.sites = Counter()
+        self.last_snapshot = None
+
+        self._loop = None
+        self._loop_thread_id = None
+        self._last_tick = None
+        self._stall_captured = False
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """
+        Start sampling on the running event loop. Must be called from a coroutine.
+        """
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopped.clear()
+        self._task = self._loop.create_task(self._sample())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-lag-watchdog", daemon=True
+        )
+        self._watchdog.start()
+        logger.info(
+            "Loop lag monitor started (interval=%.3fs, threshold=%.3fs)",
+            self.interval,
+            self.threshold,
+        )
+
+    async def stop(self):
+        """
+        Stop sampling and the watchdog thread.
+        """
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog:
+            self._watchdog.join(timeout=1)
+            self._watchdog = None
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        next_report = loop.time() + self.report_interval
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            lag = max(0.0, now - started - self.interval)
+            self.current_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self._last_tick = time.monotonic()
+            self._stall_captured = False
+
+            if lag > self.threshold:
+                logger.warning(
+                    "Event loop blocked for %.0f ms (last site: %s)",
+                    lag * 1000,
+                    self.last_snapshot[0] if self.last_snapshot else "<unknown>",
+                )
+
+            if now >= next_report:
+                next_report = now + self.report_interval
+                self.log_report()
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval / 2):
+            blocked_for = time.monotonic() - self._last_tick - self.interval
+            if blocked_for <= self.threshold or self._stall_captured:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            self._record(traceback.extract_stack(frame))
+
+    def _record(self, stack):
+        """
+        Record a stack snapshot of the call that is blocking the loop.
+
+        Args:
+            stack (traceback.StackSummary): The loop thread's stack.
+        """
+        site = _call_site(stack)
+        self._stall_captured = True
+        self.stalls += 1
+        self.sites[site] += 1
+        self.last_snapshot = (site, "".join(stack.format()))
+
+    def top_sites(self, n=None):
+        """
+        Get the call sites that blocked the loop most often.
+
+        Args:
+            n (int, optional): Number of sites. Defaults to `top_n`.
+
+        Returns:
+            list: A list of (call site, count) tuples.
+        """
+        return self.sites.most_common(n or self.top_n)
+
+    def log_report(self):
+        """
+        Log the aggregated top-N blocking call sites.
+        """
+        if not self.sites:
+            return
+        lines = [f"{count:>5}  {site}" for site, count in self.top_sites()]
+        logger.warning(
+            "Event loop stalls: %d (max lag %.0f ms). Top call sites:\n%s",
+            self.stalls,
+            self.max_lag * 1000,
+            "\n".join(lines),
+        )
+
+    def summary(self):
+        """
+        Build a human-readable summary of the loop health.
+
+        Returns:
+            str: The summary text.
+        """
+        message = (
+            f"Current loop lag: {self.current_lag * 1000:.0f} ms\n"
+            f"Max loop lag: {self.max_lag * 1000:.0f} ms\n"
+            f"Stalls over {self.threshold * 1000:.0f} ms: {self.stalls}\n"
+        )
+        if self.sites:
+            message += "\nTop blocking call sites:\n"
+            for site, count in self.top_sites():
+                message += f"{count} x {site}\n"
+        return message
+
+
+class Profiler:
+    """
+    Run cProfile on the event loop thread for a bounded time window.
+
+    Every handler runs on the event loop thread, so enabling the profiler there
+    captures all of them. Nothing is installed while no window is open, so the
+    profiler costs nothing when it is off.
+    """
+
+    def __init__(self, top_n=20):
+        """
+        Args:
+            top_n (int): Number of functions included in the report.
+        """
+        self.top_n = top_n
+        self._profile = None
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    async def run(self, seconds):
+        """
+        Profile the event loop thread for the given number of seconds.
+
+        Args:
+            seconds (float): Length of the profiling window.
+
+        Returns:
+            tuple: The summary report (str) and the raw profile (bytes) in the
+            format written by `pstats.Stats.dump_stats`.
+
+        Raises:
+            RuntimeError: If a profiling window is already open.
+        """
+        if self.active:
+            raise RuntimeError("A profiling session is already running.")
+
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self._profile.disable()
+            profile, self._profile = self._profile, None
+
+        stats = pstats.Stats(profile, stream=io.StringIO())
+        return self.report(stats, seconds), marshal.dumps(stats.stats)
+
+    def report(self, stats, seconds):
+        """
+        Summarize the hottest functions of a finished profile.
+
+        Args:
+            stats (pstats.Stats): The statistics of the finished profile.
+            seconds (float): Length of the profiling window.
+
+        Returns:
+            str: The report text.
+        """
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        message = (
+            f"Profile of {seconds:g}s, {stats.total_calls} calls, "
+            f"{stats.total_tt * 1000:.0f} ms on the loop thread.\n"
+            f"Top {self.top_n} functions by own time (own ms / total ms / calls):\n\n"
+        )
+        for (filename, lineno, name), (_, calls, own, total, _) in rows[: self.top_n]:
+            location = f"{os.path.basename(filename)}:{lineno}" if lineno else filename
+            message += f"{own * 1000:.1f} / {total * 1000:.1f} / {calls}  {name} ({location})\n"
+        return message
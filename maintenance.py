@@ -0,0 +1,228 @@
+"""
+Background maintenance jobs that run inside the bot process.
+"""
+
+import os
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone, timedelta
+
+import requests
+
+from services import (
+    db_rollup_usage,
+    db_archive_memory,
+    db_compact,
+    db_prune_submissions,
+    db_prune_daily_usage,
+    db_get_stale_pending,
+    db_apply_task_outcomes,
+)
+from vidu import get_generation_status
+
+logger = logging.getLogger(__name__)
+
+USAGE_RETENTION_MONTHS = int(os.getenv("USAGE_RETENTION_MONTHS", "0"))
+MEMORY_RETENTION_DAYS = int(os.getenv("MEMORY_RETENTION_DAYS", "0"))
+RETENTION_HOUR_UTC = int(os.getenv("RETENTION_HOUR_UTC", "3"))
+RETENTION_PAUSE_SECONDS = 1
+COMPACT_PAGES = 200
+# Telegram redelivers updates for at most a day
+SUBMISSION_RETENTION_DAYS = 7
+# Longer than the bot and the workers track a task, so the sweeper only
+# picks up videos nobody is waiting for anymore
+STALE_PENDING_SECONDS = int(os.getenv("STALE_PENDING_SECONDS", "7200"))
+PENDING_EXPIRE_SECONDS = 24 * 3600
+SWEEP_INTERVAL_SECONDS = 600
+SWEEP_BATCH_SIZE = 50
+SWEEP_CONCURRENCY = 8
+
+
+def seconds_until_hour(hour, now=None):
+    """
+    Get the number of seconds until the next time the UTC clock shows `hour`.
+
+    Args:
+        hour (int): The hour of the day (0-23).
+        now (datetime, optional): The current time, for testing.
+
+    Returns:
+        float: Seconds until the next occurrence.
+    """
+    now = now or datetime.now(timezone.utc)
+    target = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    return (target - now).total_seconds()
+
+
+async def _in_batches(step, *args):
+    """
+    Run a batch step in a thread until it reports no more work.
+
+    Pauses between batches so the bot's own queries are never starved.
+
+    Returns:
+        int: The total amount of work reported by the steps.
+    """
+    total = 0
+    while True:
+        done = await asyncio.to_thread(step, *args)
+        total += done
+        if not done:
+            return total
+        await asyncio.sleep(RETENTION_PAUSE_SECONDS)
+
+
+async def run_retention():
+    """
+    Apply the retention policies once: roll up old usage, archive old memory
+    rows, drop old idempotency keys and daily usage counters and compact the
+    databases, all in small batches.
+
+    Returns:
+        dict: The amount of work done per step.
+    """
+    result = {"usage_rows": 0, "memory_rows": 0}
+    if USAGE_RETENTION_MONTHS:
+        result["usage_rows"] = await _in_batches(
+            db_rollup_usage, USAGE_RETENTION_MONTHS
+        )
+    if MEMORY_RETENTION_DAYS:
+        result["memory_rows"] = await _in_batches(
+            db_archive_memory, MEMORY_RETENTION_DAYS
+        )
+    result["submissions"] = await _in_batches(
+        db_prune_submissions, SUBMISSION_RETENTION_DAYS
+    )
+    result["daily_usage_rows"] = await _in_batches(db_prune_daily_usage)
+
+    # db_compact reports the free pages left, so stop once that stops shrinking
+    previous = None
+    while True:
+        remaining = await asyncio.to_thread(db_compact, COMPACT_PAGES)
+        if not remaining or remaining == previous:
+            break
+        previous = remaining
+        await asyncio.sleep(RETENTION_PAUSE_SECONDS)
+    return result
+
+
+async def retention_loop():
+    """
+    Run the retention policies every day at RETENTION_HOUR_UTC.
+    """
+    while True:
+        await asyncio.sleep(seconds_until_hour(RETENTION_HOUR_UTC))
+        try:
+            result = await run_retention()
+            logger.info(
+                "Retention rolled up %d usage rows, archived %d memory rows and "
+                "dropped %d idempotency keys and %d daily usage rows",
+                result["usage_rows"],
+                result["memory_rows"],
+                result["submissions"],
+                result["daily_usage_rows"],
+            )
+        except Exception:
+            logger.exception("Retention run failed")
+
+
+async def _task_outcome(row, api_key, mock, semaphore):
+    """
+    Check one pending video with Vidu.
+
+    Returns:
+        tuple or None: The outcome for `db_apply_task_outcomes`, or None if
+        the video should stay pending.
+    """
+    user_id, group_id, task_id, timestamp = row
+    async with semaphore:
+        try:
+            status_response = await asyncio.to_thread(
+                get_generation_status, mock=mock, api_key=api_key, task_id=task_id
+            )
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                logger.warning("Sweeping task %s failed: %s", task_id, e)
+                return None
+            status_response = {}
+        except requests.exceptions.RequestException as e:
+            logger.warning("Sweeping task %s failed: %s", task_id, e)
+            return None
+
+    state = status_response.get("state")
+    if state == "success":
+        creations = status_response.get("creations", [])
+        if creations:
+            return (user_id, group_id, task_id, "success", creations[0].get("url"))
+        return (user_id, group_id, task_id, "failed", None)
+    if state == "failed":
+        return (user_id, group_id, task_id, "failed", None)
+    created = datetime.fromisoformat(timestamp)
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    age = datetime.now(timezone.utc) - created
+    if not status_response or age.total_seconds() > PENDING_EXPIRE_SECONDS:
+        # Vidu doesn't know the task, or it will never finish
+        return (user_id, group_id, task_id, "expired", None)
+    return None
+
+
+async def run_sweep(api_key, mock=False):
+    """
+    Settle videos that have been pending for longer than STALE_PENDING_SECONDS.
+
+    Pending rows are read oldest first in batches, checked with Vidu
+    concurrently, and the outcomes of each batch are written in one
+    transaction per database.
+
+    Args:
+        api_key (str): The Vidu API key.
+        mock (bool): If True, use mock data instead of calling Vidu.
+
+    Returns:
+        int: The number of videos settled.
+    """
+    semaphore = asyncio.Semaphore(SWEEP_CONCURRENCY)
+    settled = 0
+    after = None
+    while True:
+        rows = await asyncio.to_thread(
+            db_get_stale_pending, STALE_PENDING_SECONDS, after, SWEEP_BATCH_SIZE
+        )
+        if not rows:
+            return settled
+        outcomes = await asyncio.gather(
+            *(_task_outcome(row, api_key, mock, semaphore) for row in rows)
+        )
+        outcomes = [outcome for outcome in outcomes if outcome]
+        if outcomes:
+            settled += await asyncio.to_thread(db_apply_task_outcomes, outcomes)
+        # Rows still pending are skipped until the next sweep
+        after = (rows[-1][3], rows[-1][2])
+        await asyncio.sleep(RETENTION_PAUSE_SECONDS)
+
+
+async def sweep_loop(api_key, mock=False):
+    """
+    Settle stale pending videos every SWEEP_INTERVAL_SECONDS.
+
+    Args:
+        api_key (str): The Vidu API key.
+        mock (bool): If True, use mock data instead of calling Vidu.
+    """
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+        started = time.monotonic()
+        try:
+            settled = await run_sweep(api_key, mock)
+            if settled:
+                logger.info(
+                    "Sweep settled %d pending videos in %.1fs",
+                    settled,
+                    time.monotonic() - started,
+                )
+        except Exception:
+            logger.exception("Sweep failed")
@@ -0,0 +1,354 @@
+"""
+Reachability checks for reference image URLs.
+
+Every URL is checked with a HEAD request, falling back to a one-byte ranged
+GET for hosts that don't answer HEAD properly, so dead links and non-image
+URLs are caught when a reference is set instead of when Vidu fails a
+generation. Results are cached per URL for a while.
+
+With INLINE_REFERENCES=1 the images are also fetched once, stored on disk and
+sent to Vidu as Base64 instead of URLs, so Vidu doesn't download them from
+the original host for every generation.
+"""
+
+import io
+import os
+import re
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import httpx
+
+try:
+    from PIL import Image
+except ImportError:  # Images are sent as they are without Pillow
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+REFERENCE_CHECK_TIMEOUT_SECONDS = 10
+REFERENCE_CHECK_CONCURRENCY = 8
+REFERENCE_CHECK_TTL_SECONDS = 600
+REFERENCE_MAX_IMAGE_BYTES = 50 * 1024 * 1024
+REFERENCE_CONTENT_TYPES = ("image/png", "image/jpeg", "image/webp")
+INLINE_REFERENCES = os.getenv("INLINE_REFERENCES", "0") == "1"
+REFERENCE_CACHE_DIR = os.getenv("REFERENCE_CACHE_DIR", "reference_cache")
+# Longest side images are downscaled to when Pillow is installed
+REFERENCE_MAX_SIDE = 1280
+REFERENCE_ENCODED_CACHE_SIZE = 64
+
+
+def split_reference(ref):
+    """
+    Split a stored reference into its image URLs.
+
+    References are stored separated by commas (uploads) or spaces (/reference).
+
+    Args:
+        ref (str): The stored reference.
+
+    Returns:
+        list: The URLs.
+    """
+    return [url for url in re.split(r"[\s,]+", ref or "") if url]
+
+
+class ReferenceChecker:
+    """
+    Check reference image URLs concurrently over one pooled HTTP client.
+    """
+
+    def __init__(
+        self,
+        timeout=REFERENCE_CHECK_TIMEOUT_SECONDS,
+        concurrency=REFERENCE_CHECK_CONCURRENCY,
+        ttl=REFERENCE_CHECK_TTL_SECONDS,
+        transport=None,
+    ):
+        """
+        Args:
+            timeout (float): Timeout of each request in seconds.
+            concurrency (int): Maximum number of requests in flight.
+            ttl (float): Seconds a result is cached for.
+            transport (httpx.AsyncBaseTransport, optional): For testing.
+        """
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self._transport = transport
+        self._client = None
+        self._semaphore = None
+        self._cache = {}
+
+    def _get_client(self):
+        # Created on first use so it belongs to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=self.concurrency),
+                transport=self._transport,
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def check_all(self, urls):
+        """
+        Check several URLs concurrently.
+
+        Args:
+            urls (list): The URLs to check.
+
+        Returns:
+            dict: Maps each URL that failed to the reason.
+        """
+        results = await asyncio.gather(*(self.check(url) for url in urls))
+        return {url: error for url, error in zip(urls, results) if error}
+
+    async def check(self, url):
+        """
+        Check that a URL serves an image Vidu accepts.
+
+        Args:
+            url (str): The URL, with or without a scheme.
+
+        Returns:
+            str or None: Why the URL can't be used, or None if it can.
+        """
+        now = time.monotonic()
+        cached = self._cache.get(url)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        error = await self._fetch(url)
+        self._cache[url] = (now + self.ttl, error)
+        # Drop expired entries now and then so the cache stays small
+        if len(self._cache) > 1000:
+            self._cache = {
+                key: value for key, value in self._cache.items() if value[0] > now
+            }
+        return error
+
+    async def _fetch(self, url):
+        client = self._get_client()
+        target = url if re.match(r"^https?://", url) else f"https://{url}"
+        try:
+            async with self._semaphore:
+                response = await client.head(target)
+                if response.status_code >= 400 or not response.headers.get(
+                    "content-type"
+                ):
+                    # Some hosts reject HEAD; ask for the first byte instead
+                    response = await client.get(target, headers={"Range": "bytes=0-0"})
+        except httpx.HTTPError as e:
+            logger.info("Reference check for %s failed: %s", url, e)
+            return f"unreachable ({type(e).__name__})"
+
+        if response.status_code >= 400:
+            return f"HTTP {response.status_code}"
+        content_type = response.headers.get("content-type", "").split(";")[0].strip()
+        if content_type not in REFERENCE_CONTENT_TYPES:
+            return f"not a PNG, JPEG or WebP image ({content_type or 'unknown type'})"
+
+        size = response.headers.get("content-length")
+        content_range = response.headers.get("content-range", "")
+        if response.status_code == 206 and "/" in content_range:
+            size = content_range.rsplit("/", 1)[1]
+        if size and size.isdigit() and int(size) > REFERENCE_MAX_IMAGE_BYTES:
+            return f"larger than {REFERENCE_MAX_IMAGE_BYTES // (1024 * 1024)} MB"
+        return None
+
+
+class ReferenceCache:
+    """
+    Fetch reference images once and send them to Vidu inline as Base64.
+
+    Images are downscaled to REFERENCE_MAX_SIDE and re-encoded as JPEG when
+    Pillow is installed, and stored on disk under the hash of their content;
+    a small file per URL points at the content. Encoded payloads of recently
+    used images are kept in memory.
+    """
+
+    def __init__(
+        self, directory, timeout=REFERENCE_CHECK_TIMEOUT_SECONDS, transport=None
+    ):
+        """
+        Args:
+            directory (str): Where the images are stored.
+            timeout (float): Timeout of each download in seconds.
+            transport (httpx.AsyncBaseTransport, optional): For testing.
+        """
+        self.directory = directory
+        self.timeout = timeout
+        self._transport = transport
+        self._client = None
+        self._encoded = OrderedDict()
+        # _encode runs on worker threads for several URLs at once
+        self._encoded_lock = threading.Lock()
+        # Per-URL lock and the number of callers using it, dropped when unused
+        self._locks = {}
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout, follow_redirects=True, transport=self._transport
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _url_path(self, url):
+        # Keyed on the full URL so links with and without a scheme share a copy
+        url = url if re.match(r"^https?://", url) else f"https://{url}"
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.directory, "urls", digest)
+
+    async def images_for(self, ref):
+        """
+        Get the images of a reference as Base64 data URIs.
+
+        Args:
+            ref (str): The stored reference.
+
+        Returns:
+            list: One data URI per image.
+
+        Raises:
+            httpx.HTTPError: If an image that isn't cached can't be fetched.
+        """
+        return [await self.data_uri(url) for url in split_reference(ref)]
+
+    async def prefetch(self, ref):
+        """
+        Fetch the images of a newly set reference again, so changed images
+        behind unchanged URLs are picked up.
+
+        Args:
+            ref (str): The stored reference.
+        """
+        for url in split_reference(ref):
+            try:
+                await self.data_uri(url, refresh=True)
+            except (httpx.HTTPError, OSError, ValueError) as e:
+                logger.warning("Prefetching reference image %s failed: %s", url, e)
+
+    async def data_uri(self, url, refresh=False):
+        """
+        Get one image as a Base64 data URI, fetching it if needed.
+
+        Args:
+            url (str): The image URL.
+            refresh (bool): Fetch the image even if it is cached.
+
+        Returns:
+            str: The data URI.
+        """
+        key = self._url_path(url)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                name = None
+                if not refresh:
+                    name = await asyncio.to_thread(self._read_pointer, url)
+                if name is None:
+                    data = await self._download(url)
+                    name = await asyncio.to_thread(self._store, url, data)
+                return await asyncio.to_thread(self._encode, name)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def _read_pointer(self, url):
+        try:
+            with open(self._url_path(url)) as f:
+                name = f.read().strip()
+        except FileNotFoundError:
+            return None
+        if not os.path.exists(os.path.join(self.directory, "objects", name)):
+            return None
+        return name
+
+    async def _download(self, url):
+        target = url if re.match(r"^https?://", url) else f"https://{url}"
+        async with self._get_client().stream("GET", target) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("content-type", "").split(";")[0]
+            if content_type not in REFERENCE_CONTENT_TYPES:
+                raise ValueError(f"{url} is not an image ({content_type})")
+            data = bytearray()
+            async for chunk in response.aiter_bytes():
+                data += chunk
+                if len(data) > REFERENCE_MAX_IMAGE_BYTES:
+                    raise ValueError(f"{url} is too large")
+        return content_type, bytes(data)
+
+    def _store(self, url, data):
+        content_type, content = normalize_image(*data)
+        extension = content_type.split("/")[1]
+        name = f"{hashlib.sha256(content).hexdigest()}.{extension}"
+        path = os.path.join(self.directory, "objects", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(os.path.dirname(self._url_path(url)), exist_ok=True)
+        if not os.path.exists(path):
+            # Written under a temporary name so readers never see a partial file
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(content)
+            os.replace(f"{path}.tmp", path)
+        with open(f"{self._url_path(url)}.tmp", "w") as f:
+            f.write(name)
+        os.replace(f"{self._url_path(url)}.tmp", self._url_path(url))
+        return name
+
+    def _encode(self, name):
+        with self._encoded_lock:
+            uri = self._encoded.get(name)
+            if uri is not None:
+                self._encoded.move_to_end(name)
+                return uri
+        with open(os.path.join(self.directory, "objects", name), "rb") as f:
+            content = f.read()
+        extension = name.rsplit(".", 1)[1]
+        uri = f"data:image/{extension};base64,{base64.b64encode(content).decode()}"
+        with self._encoded_lock:
+            self._encoded[name] = uri
+            while len(self._encoded) > REFERENCE_ENCODED_CACHE_SIZE:
+                self._encoded.popitem(last=False)
+        return uri
+
+
+def normalize_image(content_type, content):
+    """
+    Downscale an image to what the model needs, if Pillow is installed.
+
+    Args:
+        content_type (str): The MIME type of the image.
+        content (bytes): The image.
+
+    Returns:
+        tuple: The MIME type and the normalized image. Without Pillow, or for
+        images that are already small, the input is returned unchanged.
+    """
+    if Image is None:
+        return content_type, content
+    with Image.open(io.BytesIO(content)) as image:
+        if max(image.size) <= REFERENCE_MAX_SIDE:
+            return content_type, content
+        image.thumbnail((REFERENCE_MAX_SIDE, REFERENCE_MAX_SIDE))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=90)
+    return "image/jpeg", output.getvalue()
@@ -1,18 +1,355 @@
 import os
+import re
+import json
+import time
 import logging
 import sqlite3
-from datetime import datetime, timezone
+import threading
+import zlib
+import contextlib
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
 
 logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger("services.slow_query")
 
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+RETENTION_BATCH_SIZE = 500
+PROFILE_CACHE_SECONDS = 60
+# Columns added to memory after the first release, in order
+MEMORY_EXTRA_COLUMNS = (
+    ("prompt", "TEXT"),
+    ("seed", "INTEGER"),
+    ("tier", "TEXT"),
+    ("idempotency_key", "TEXT"),
+)
+# Columns added to limits after the first release, in order
+LIMITS_EXTRA_COLUMNS = (("quota_window", "TEXT"),)
+# Quota windows a group can use, with their length in days; a calendar month
+# has no fixed length
+QUOTA_WINDOWS = {"month": None, "24h": 1, "7d": 7, "30d": 30}
+DEFAULT_QUOTA_WINDOW = "month"
+# Daily usage counters are kept a little longer than the longest window
+DAILY_USAGE_RETENTION_DAYS = 40
+# Reservations of a crashed process stop counting against the limits after this
+RESERVATION_TTL_SECONDS = 7200
+QUERY_STATS_SAMPLES = 1000
 
-def get_db_path():
+
+# The bot that database calls are made for, when one process serves several
+_namespace = contextvars.ContextVar("db_namespace", default="")
+
+
+def get_namespace():
+    return _namespace.get()
+
+
+def set_namespace(namespace):
+    """
+    Make the database calls of the current context use a bot's own databases.
+
+    Tasks and threads started from the context afterwards inherit it.
+
+    Args:
+        namespace (str): The bot's namespace, "" for the databases at DATABASE.
+
+    Returns:
+        contextvars.Token: To restore the previous namespace with.
+    """
+    return _namespace.set(namespace)
+
+
+@contextlib.contextmanager
+def use_namespace(namespace):
+    """
+    Make the database calls in the block use a bot's own databases.
+
+    Args:
+        namespace (str): The bot's namespace, "" for the databases at DATABASE.
+    """
+    token = set_namespace(namespace)
+    try:
+        yield
+    finally:
+        _namespace.reset(token)
+
+
+def get_queue_path():
+    """
+    Get the path of the database holding the job queue, idempotency keys and
+    checkpoints, which all namespaces share.
+
+    Returns:
+        str: The value of DATABASE.
+    """
     return os.getenv("DATABASE", "bot_data.db")
 
 
-def init_db():
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
+def get_db_path():
+    """
+    Get the path of the current namespace's database.
+
+    Returns:
+        str: DATABASE, or a file next to it named after the namespace.
+    """
+    namespace = _namespace.get()
+    if not namespace:
+        return get_queue_path()
+    root, ext = os.path.splitext(get_queue_path())
+    return f"{root}.{namespace}{ext or '.db'}"
+
+
+def get_archive_path():
+    """
+    Get the path of the database that old memory rows are archived to.
+
+    Returns:
+        str: The value of ARCHIVE_DATABASE, by default next to get_db_path().
+    """
+    root, ext = os.path.splitext(get_db_path())
+    path = os.getenv("ARCHIVE_DATABASE")
+    if path and _namespace.get():
+        # Group IDs of different bots may overlap, so they never share a file
+        root, ext = os.path.splitext(path)
+        return f"{root}.{_namespace.get()}{ext or '.db'}"
+    return path or f"{root}.archive{ext or '.db'}"
+
+
+def get_shard_count():
+    """
+    Get the number of shards for per-group tables, 0 when sharding is off.
+
+    Returns:
+        int: The value of DB_SHARDS.
+    """
+    return int(os.getenv("DB_SHARDS", "0"))
+
+
+def get_shard_index(group_id, shard_count=None):
+    """
+    Get the shard that holds a group's usage, limits and memory rows.
+
+    Args:
+        group_id (int): The ID of the group.
+        shard_count (int, optional): Defaults to get_shard_count().
+
+    Returns:
+        int: The shard index.
+    """
+    return zlib.crc32(str(group_id).encode()) % (shard_count or get_shard_count())
+
+
+def get_shard_path(index):
+    """
+    Get the file path of a shard, next to get_db_path().
+
+    Args:
+        index (int): The shard index.
+
+    Returns:
+        str: The shard's database path.
+    """
+    root, ext = os.path.splitext(get_db_path())
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+class QueryStats:
+    """
+    Thread-safe per-statement timing statistics.
+
+    Statements are keyed by their SQL text with whitespace collapsed, which is
+    stable because every query binds its values as parameters. Percentiles are
+    computed from the most recent `QUERY_STATS_SAMPLES` executions.
+    """
+
+    def __init__(self, samples=QUERY_STATS_SAMPLES):
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, sql, elapsed, rows):
+        """
+        Record one execution of a statement.
+
+        Args:
+            sql (str): The normalized SQL text.
+            elapsed (float): Time spent executing and fetching, in seconds.
+            rows (int): Rows returned or modified.
+        """
+        with self._lock:
+            entry = self._stats.get(sql)
+            if entry is None:
+                entry = self._stats[sql] = {
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "rows": 0,
+                    "recent": deque(maxlen=self.samples),
+                }
+            entry["count"] += 1
+            entry["total"] += elapsed
+            entry["max"] = max(entry["max"], elapsed)
+            entry["rows"] += rows
+            entry["recent"].append(elapsed)
+
+    def summary(self):
+        """
+        Summarize the recorded statements, slowest in total first.
+
+        Returns:
+            list: A list of dicts with sql, count, rows, total_ms, p50_ms,
+            p95_ms and max_ms keys.
+        """
+        with self._lock:
+            items = [
+                (sql, dict(e, recent=sorted(e["recent"])))
+                for sql, e in self._stats.items()
+            ]
+
+        result = []
+        for sql, e in items:
+            recent = e["recent"]
+            result.append(
+                {
+                    "sql": sql,
+                    "count": e["count"],
+                    "rows": e["rows"],
+                    "total_ms": e["total"] * 1000,
+                    "p50_ms": recent[int(0.50 * (len(recent) - 1))] * 1000,
+                    "p95_ms": recent[int(0.95 * (len(recent) - 1))] * 1000,
+                    "max_ms": e["max"] * 1000,
+                }
+            )
+        return sorted(result, key=lambda row: row["total_ms"], reverse=True)
+
+    def reset(self):
+        """
+        Drop all recorded statistics.
+        """
+        with self._lock:
+            self._stats.clear()
+
+
+query_stats = QueryStats()
+
+
+def _normalize_sql(sql):
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor that times each statement, including the fetching of its rows.
+
+    A statement is finished when the cursor runs its next statement or when
+    the connection is closed; its time and row count are then recorded in
+    `query_stats` and, if slow, logged with its query plan.
+    """
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self._sql = None
+        self._params = ()
+        self._elapsed = 0.0
+        self._rows = 0
+        connection._cursors.append(self)
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        self._sql, self._params, self._rows = sql, parameters, 0
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._elapsed = time.perf_counter() - started
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        self._sql, self._params, self._rows = sql, None, 0
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._elapsed = time.perf_counter() - started
+
+    def _timed_fetch(self, fetch, *args):
+        started = time.perf_counter()
+        rows = fetch(*args)
+        self._elapsed += time.perf_counter() - started
+        return rows
+
+    def fetchone(self):
+        row = self._timed_fetch(super().fetchone)
+        self._rows += row is not None
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed_fetch(super().fetchmany, size or self.arraysize)
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed_fetch(super().fetchall)
+        self._rows += len(rows)
+        return rows
+
+    def _finish(self):
+        if self._sql is None:
+            return
+        sql, params, elapsed = _normalize_sql(self._sql), self._params, self._elapsed
+        rows = self.rowcount if self.rowcount >= 0 else self._rows
+        self._sql = None
+        query_stats.record(sql, elapsed, rows)
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            self._log_slow_query(sql, params, elapsed, rows)
+
+    def _log_slow_query(self, sql, params, elapsed, rows):
+        plan = "<unavailable>"
+        if params is not None and not sql.upper().startswith(("BEGIN", "PRAGMA")):
+            try:
+                plan_rows = (
+                    self.connection.cursor(sqlite3.Cursor)
+                    .execute(f"EXPLAIN QUERY PLAN {sql}", params)
+                    .fetchall()
+                )
+                plan = "; ".join(row[-1] for row in plan_rows)
+            except sqlite3.Error as e:
+                plan = f"<unavailable: {e}>"
+        slow_query_logger.warning(
+            "%.1f ms, %d rows: %s | params=%r | plan: %s",
+            elapsed * 1000,
+            rows,
+            sql,
+            params,
+            plan,
+        )
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors record statement statistics in `query_stats`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cursors = []
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or InstrumentedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def close(self):
+        for cursor in self._cursors:
+            cursor._finish()
+        self._cursors.clear()
+        super().close()
+
+
+def _create_catalog_tables(c):
     c.execute(
         """CREATE TABLE IF NOT EXISTS groups (
         group_id INTEGER PRIMARY KEY,
@@ -25,6 +362,100 @@ def init_db():
         prompt TEXT
     )"""
     )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        group_id INTEGER,
+        user_id INTEGER,
+        chat_id INTEGER,
+        message_id INTEGER,
+        prompt TEXT,
+        images TEXT,
+        params TEXT,
+        state TEXT DEFAULT 'queued',
+        task_id TEXT,
+        video_url TEXT,
+        error TEXT,
+        attempts INTEGER DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires REAL,
+        next_check REAL,
+        created_at REAL,
+        updated_at REAL,
+        delivered INTEGER DEFAULT 0,
+        idempotency_key TEXT,
+        namespace TEXT DEFAULT ''
+    )"""
+    )
+    _ensure_columns(
+        c, "jobs", (("idempotency_key", "TEXT"), ("namespace", "TEXT DEFAULT ''"))
+    )
+    c.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_idempotency ON jobs (idempotency_key)"
+    )
+    # Idempotency keys of Vidu submissions, recorded before the request is sent
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS submissions (
+        idempotency_key TEXT PRIMARY KEY,
+        task_id TEXT,
+        created_at REAL
+    )"""
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_submissions_created ON submissions (created_at)"
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS profiles (
+        group_id INTEGER,
+        tier TEXT,
+        model TEXT,
+        duration INTEGER,
+        aspect_ratio TEXT,
+        resolution TEXT,
+        PRIMARY KEY (group_id, tier)
+    )"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS checkpoints (
+        task_id TEXT PRIMARY KEY,
+        group_id INTEGER,
+        user_id INTEGER,
+        chat_id INTEGER,
+        message_id INTEGER,
+        prompt TEXT,
+        created_at REAL,
+        namespace TEXT DEFAULT ''
+    )"""
+    )
+    _ensure_columns(c, "checkpoints", (("namespace", "TEXT DEFAULT ''"),))
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_groups_name ON groups (group_name COLLATE NOCASE, group_id)"
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (state, next_check)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_delivery ON jobs (delivered, state)")
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs (state, updated_at)"
+    )
+
+
+def _ensure_columns(c, table, columns, schema="main"):
+    """
+    Add columns that a table created by an older version is missing.
+
+    Args:
+        c (sqlite3.Cursor): The cursor to use.
+        table (str): The table name.
+        columns (tuple): (name, type) pairs, in the order they were added.
+        schema (str): The attached database holding the table.
+    """
+    c.execute(f"PRAGMA {schema}.table_info({table})")
+    existing = {row[1] for row in c.fetchall()}
+    for name, kind in columns:
+        if name not in existing:
+            c.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {name} {kind}")
+
+
+def _create_shard_tables(c):
     c.execute(
         """CREATE TABLE IF NOT EXISTS usage (
         group_id INTEGER,
@@ -36,343 +467,2128 @@ def init_db():
     )"""
     )
     c.execute(
-        """CREATE TABLE IF NOT EXISTS limits (
-        group_id INTEGER PRIMARY KEY,
-        group_limit INTEGER,
-        user_limit INTEGER
-    )"""
+        """CREATE TABLE IF NOT EXISTS limits (
+        group_id INTEGER PRIMARY KEY,
+        group_limit INTEGER,
+        user_limit INTEGER,
+        quota_window TEXT
+    )"""
+    )
+    _ensure_columns(c, "limits", LIMITS_EXTRA_COLUMNS)
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS memory (
+        user_id INTEGER,
+        group_id INTEGER,
+        video_url TEXT,
+        timestamp TEXT,
+        task_id TEXT,
+        status TEXT,
+        user_video_id INTEGER,
+        prompt TEXT,
+        seed INTEGER,
+        tier TEXT,
+        idempotency_key TEXT
+    )"""
+    )
+    _ensure_columns(c, "memory", MEMORY_EXTRA_COLUMNS)
+    c.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_memory_idempotency ON memory (idempotency_key)"
+    )
+    # Only pending rows, so the stale task sweeper never scans finished ones
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_memory_pending ON memory (timestamp, task_id) WHERE status = 'pending'"
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_memory_timestamp ON memory (timestamp)")
+    c.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'idx_memory_user_video'"
+    )
+    row = c.fetchone()
+    if row and "UNIQUE" not in row[0]:
+        # Older versions could hand out one ID twice; renumber the later rows
+        _renumber_duplicate_memory_ids(c)
+        c.execute("DROP INDEX idx_memory_user_video")
+    c.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_memory_user_video ON memory (user_id, group_id, user_video_id)"
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS usage_rollup (
+        group_id INTEGER,
+        month TEXT,
+        calls INTEGER DEFAULT 0,
+        users INTEGER DEFAULT 0,
+        PRIMARY KEY (group_id, month)
+    )"""
+    )
+    c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'usage_daily'"
+    )
+    backfill_daily = c.fetchone() is None
+    # Calls per group, user and UTC day; user 0 holds the group's total
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS usage_daily (
+        group_id INTEGER,
+        user_id INTEGER,
+        day TEXT,
+        calls INTEGER DEFAULT 0,
+        PRIMARY KEY (group_id, user_id, day)
+    )"""
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_usage_daily_day ON usage_daily (day)")
+    # Running sum of usage_daily over each counter's current quota window,
+    # moved forward when the window start passes `since`
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS usage_windows (
+        group_id INTEGER,
+        user_id INTEGER,
+        quota_window TEXT,
+        since TEXT,
+        calls INTEGER DEFAULT 0,
+        PRIMARY KEY (group_id, user_id)
+    )"""
+    )
+    if backfill_daily:
+        # This month's calls have no day; dating them on the 1st keeps them
+        # in the monthly window without making rolling windows count them
+        # as if they all happened today
+        c.execute(
+            """INSERT INTO usage_daily (group_id, user_id, day, calls)
+            SELECT group_id, user_id, date('now', 'start of month'), user_calls
+            FROM usage WHERE month = ?
+            UNION ALL
+            SELECT group_id, 0, date('now', 'start of month'), SUM(user_calls)
+            FROM usage WHERE month = ?
+            GROUP BY group_id""",
+            (db_get_month(), db_get_month()),
+        )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS reservations (
+        reservation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        group_id INTEGER,
+        user_id INTEGER,
+        slots INTEGER,
+        expires_at REAL
+    )"""
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_reservations_group ON reservations (group_id, expires_at)"
+    )
+    c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'group_stats'"
+    )
+    backfill = c.fetchone() is None
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS group_stats (
+        group_id INTEGER,
+        month TEXT,
+        calls INTEGER DEFAULT 0,
+        successes INTEGER DEFAULT 0,
+        failures INTEGER DEFAULT 0,
+        latency_ms_total REAL DEFAULT 0,
+        latency_count INTEGER DEFAULT 0,
+        PRIMARY KEY (group_id, month)
+    )"""
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_group_stats_month ON group_stats (month, calls)"
+    )
+    if backfill:
+        # One-off scan of existing rows; from now on the write paths keep it current
+        c.execute(
+            """INSERT INTO group_stats (group_id, month, calls)
+            SELECT group_id, month, SUM(user_calls) FROM usage GROUP BY group_id, month"""
+        )
+        c.execute(
+            """INSERT INTO group_stats (group_id, month, successes, failures)
+            SELECT group_id, substr(timestamp, 1, 7),
+                SUM(status = 'success'), SUM(status = 'failed')
+            FROM memory WHERE status IN ('success', 'failed')
+            GROUP BY group_id, substr(timestamp, 1, 7)
+            ON CONFLICT (group_id, month) DO UPDATE SET
+                successes = excluded.successes, failures = excluded.failures"""
+        )
+        # Journal mode changes and ATTACH need to run outside a transaction
+        c.connection.commit()
+
+
+def _renumber_duplicate_memory_ids(c):
+    c.execute(
+        """SELECT rowid, user_id, group_id FROM memory m WHERE EXISTS (
+            SELECT 1 FROM memory o WHERE o.user_id = m.user_id AND o.group_id = m.group_id
+            AND o.user_video_id = m.user_video_id AND o.rowid < m.rowid
+        ) ORDER BY rowid"""
+    )
+    for rowid, user_id, group_id in c.fetchall():
+        c.execute(
+            """UPDATE memory SET user_video_id = (
+                SELECT MAX(user_video_id) + 1 FROM memory WHERE user_id = ? AND group_id = ?
+            ) WHERE rowid = ?""",
+            (user_id, group_id, rowid),
+        )
+
+
+def _record_outcome(c, group_id, user_id, task_id, status):
+    """
+    Count a finished generation in `group_stats`.
+
+    Must run before the memory row's status is updated, in the same
+    transaction, so a task is only counted on its first transition to
+    success or failed.
+
+    Args:
+        c (sqlite3.Cursor): A cursor of the group's database.
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+        task_id (str): The task ID of the memory row.
+        status (str): The new status.
+    """
+    if status not in ("success", "failed"):
+        return
+    c.execute(
+        """SELECT (julianday('now') - julianday(timestamp)) * 86400000 FROM memory
+        WHERE user_id = ? AND group_id = ? AND task_id = ?
+        AND status NOT IN ('success', 'failed')""",
+        (user_id, group_id, task_id),
+    )
+    row = c.fetchone()
+    if row is None:
+        return
+    success = status == "success"
+    c.execute(
+        """INSERT INTO group_stats (group_id, month, successes, failures, latency_ms_total, latency_count)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (group_id, month) DO UPDATE SET
+            successes = successes + excluded.successes,
+            failures = failures + excluded.failures,
+            latency_ms_total = latency_ms_total + excluded.latency_ms_total,
+            latency_count = latency_count + excluded.latency_count""",
+        (
+            group_id,
+            db_get_month(),
+            int(success),
+            int(not success),
+            row[0] if success else 0,
+            int(success),
+        ),
+    )
+
+
+def init_db():
+    if _namespace.get():
+        # The namespace's own file has the same tables, but the queue is shared
+        conn = get_queue_connection()
+        c = conn.cursor()
+        _create_catalog_tables(c)
+        c.execute("PRAGMA journal_mode=WAL")
+        conn.commit()
+        conn.close()
+
+    # WAL lets the bot and worker processes read while another one writes
+    conn = get_db_connection()
+    c = conn.cursor()
+    # Only applies to new files; lets retention reclaim space in small steps
+    c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    _create_catalog_tables(c)
+    if not get_shard_count():
+        _create_shard_tables(c)
+    # Migrations may have opened a transaction, and the mode can't change in one
+    conn.commit()
+    c.execute("PRAGMA journal_mode=WAL").fetchall()
+    conn.close()
+
+    for index in range(get_shard_count()):
+        conn = _connect(get_shard_path(index))
+        c = conn.cursor()
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        _create_shard_tables(c)
+        conn.commit()
+        c.execute("PRAGMA journal_mode=WAL").fetchall()
+        conn.close()
+
+
+def _connect(path):
+    return sqlite3.connect(path, factory=InstrumentedConnection)
+
+
+def get_db_connection(group_id=None):
+    """
+    Get a get_db_path() connection.
+
+    In sharded mode, passing a group ID returns a connection to the shard
+    holding that group's usage, limits and memory rows instead. Statements run
+    through it are timed and recorded in `query_stats`.
+
+    Args:
+        group_id (int, optional): The group whose shard to connect to.
+
+    Returns:
+        sqlite3.Connection: A connection object to the get_db_path().
+    """
+    if group_id is not None and get_shard_count():
+        return _connect(get_shard_path(get_shard_index(group_id)))
+    return _connect(get_db_path())
+
+
+def get_queue_connection():
+    """
+    Get a connection to the database shared by all namespaces, see
+    get_queue_path().
+
+    Returns:
+        sqlite3.Connection: A connection object to the get_queue_path().
+    """
+    return _connect(get_queue_path())
+
+
+def _fan_out(query):
+    """
+    Run a query function against every database holding per-group tables.
+
+    In sharded mode the shards are queried in parallel, one thread each.
+
+    Args:
+        query (callable): Called with a connection, returns a list of rows.
+
+    Returns:
+        list: The concatenated rows of all shards.
+    """
+
+    def run(path):
+        conn = _connect(path)
+        try:
+            return query(conn)
+        finally:
+            conn.close()
+
+    paths = _group_data_paths()
+    if len(paths) == 1:
+        return run(paths[0])
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        return [row for rows in executor.map(run, paths) for row in rows]
+
+
+def _group_data_paths():
+    """
+    Get the paths of all databases holding usage, limits and memory rows.
+
+    Returns:
+        list: The shard paths in sharded mode, otherwise just get_db_path().
+    """
+    shard_count = get_shard_count()
+    if not shard_count:
+        return [get_db_path()]
+    return [get_shard_path(index) for index in range(shard_count)]
+
+
+def db_get_month():
+    """
+    Get the current month in the format 'YYYY-MM'.
+
+    Returns:
+        str: The current month as a string.
+    """
+    return datetime.now(timezone.utc).strftime("%Y-%m")
+
+
+def db_get_reference(group_id):
+    """
+    Retrieve the reference text for a specific group.
+
+    Args:
+        group_id (int): The ID of the group.
+
+    Returns:
+        str or None: The reference text if it exists, otherwise None.
+    """
+
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT prompt FROM prompts WHERE group_id = ?", (group_id,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def db_add_reference(group_id, ref):
+    """
+    Add or update the reference text for a specific group.
+
+    Args:
+        group_id (int): The ID of the group.
+        ref (str): The reference text to set.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(
+        "INSERT OR REPLACE INTO prompts (group_id, prompt) VALUES (?, ?)",
+        (group_id, ref),
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_update_usage(group_id, user_id):
+    """
+    Update the usage statistics for a specific group and user.
+
+    Args:
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    _count_usage(c, group_id, user_id)
+    conn.commit()
+    conn.close()
+
+
+def _count_usage(c, group_id, user_id):
+    month = db_get_month()
+    c.execute(
+        """INSERT OR IGNORE INTO usage (group_id, user_id, month) VALUES (?, ?, ?)""",
+        (group_id, user_id, month),
+    )
+    c.execute(
+        """UPDATE usage SET group_calls = group_calls + 1, user_calls = user_calls + 1 WHERE group_id = ? AND user_id = ? AND month = ?""",
+        (group_id, user_id, month),
+    )
+    c.execute(
+        """INSERT INTO group_stats (group_id, month, calls) VALUES (?, ?, 1)
+        ON CONFLICT (group_id, month) DO UPDATE SET calls = calls + 1""",
+        (group_id, month),
+    )
+    quota_window = _get_quota_window(c, group_id)
+    today = _get_day()
+    for counter in (0, user_id):
+        # Move the window forward first, so this call is added exactly once
+        _window_calls(c, group_id, counter, quota_window, today)
+        c.execute(
+            """INSERT INTO usage_daily (group_id, user_id, day, calls) VALUES (?, ?, ?, 1)
+            ON CONFLICT (group_id, user_id, day) DO UPDATE SET calls = calls + 1""",
+            (group_id, counter, today),
+        )
+        c.execute(
+            "UPDATE usage_windows SET calls = calls + 1 WHERE group_id = ? AND user_id = ?",
+            (group_id, counter),
+        )
+
+
+def _get_day(now=None):
+    return (now or datetime.now(timezone.utc)).strftime("%Y-%m-%d")
+
+
+def _get_quota_window(c, group_id):
+    c.execute("SELECT quota_window FROM limits WHERE group_id = ?", (group_id,))
+    row = c.fetchone()
+    return row[0] if row and row[0] else DEFAULT_QUOTA_WINDOW
+
+
+def _window_start(quota_window, today):
+    days = QUOTA_WINDOWS[quota_window]
+    if days is None:
+        return today[:8] + "01"
+    start = datetime.strptime(today, "%Y-%m-%d") - timedelta(days=days - 1)
+    return start.strftime("%Y-%m-%d")
+
+
+def _window_calls(c, group_id, user_id, quota_window, today):
+    """
+    Get the calls of a counter in its quota window, bringing the cached
+    running sum in `usage_windows` up to date.
+
+    The sum only changes here when the window start has moved past days that
+    are still in it, so each daily row is subtracted once; it is rebuilt from
+    `usage_daily` when the group switches to another window, or when the
+    counter was idle for so long that the rows to subtract are gone.
+
+    Args:
+        c (sqlite3.Cursor): A cursor of the group's database, in a transaction.
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user, or 0 for the whole group.
+        quota_window (str): One of QUOTA_WINDOWS.
+        today (str): The current UTC day, YYYY-MM-DD.
+
+    Returns:
+        int: The calls from the window start up to and including today.
+    """
+    start = _window_start(quota_window, today)
+    c.execute(
+        "SELECT quota_window, since, calls FROM usage_windows WHERE group_id = ? AND user_id = ?",
+        (group_id, user_id),
+    )
+    row = c.fetchone()
+    if row and row[0] == quota_window and row[1] == start:
+        return row[2]
+    oldest_kept = _get_day(
+        datetime.strptime(today, "%Y-%m-%d")
+        - timedelta(days=DAILY_USAGE_RETENTION_DAYS)
+    )
+    if row and row[0] == quota_window and oldest_kept <= row[1] < start:
+        c.execute(
+            """SELECT COALESCE(SUM(calls), 0) FROM usage_daily
+            WHERE group_id = ? AND user_id = ? AND day >= ? AND day < ?""",
+            (group_id, user_id, row[1], start),
+        )
+        calls = row[2] - c.fetchone()[0]
+    else:
+        c.execute(
+            """SELECT COALESCE(SUM(calls), 0) FROM usage_daily
+            WHERE group_id = ? AND user_id = ? AND day >= ?""",
+            (group_id, user_id, start),
+        )
+        calls = c.fetchone()[0]
+    c.execute(
+        """INSERT INTO usage_windows (group_id, user_id, quota_window, since, calls)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (group_id, user_id) DO UPDATE SET
+            quota_window = excluded.quota_window,
+            since = excluded.since,
+            calls = excluded.calls""",
+        (group_id, user_id, quota_window, start, calls),
+    )
+    return calls
+
+
+def _window_usage(c, group_id, user_id, now=None):
+    """
+    Get the group's and the user's calls in the group's quota window.
+
+    Rolling windows also count the day before the window start, weighted by
+    the part of it that is still within the window, so usage leaves the
+    window gradually instead of a whole day at midnight.
+
+    Args:
+        c (sqlite3.Cursor): A cursor of the group's database, in a transaction.
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+        now (datetime, optional): The current time, for testing.
+
+    Returns:
+        tuple: The group's calls and the user's calls.
+    """
+    now = now or datetime.now(timezone.utc)
+    today = _get_day(now)
+    quota_window = _get_quota_window(c, group_id)
+    result = []
+    for counter in (0, user_id):
+        calls = _window_calls(c, group_id, counter, quota_window, today)
+        if QUOTA_WINDOWS[quota_window] is not None:
+            before = datetime.strptime(
+                _window_start(quota_window, today), "%Y-%m-%d"
+            ) - timedelta(days=1)
+            c.execute(
+                "SELECT calls FROM usage_daily WHERE group_id = ? AND user_id = ? AND day = ?",
+                (group_id, counter, before.strftime("%Y-%m-%d")),
+            )
+            row = c.fetchone()
+            if row:
+                elapsed = (
+                    now - now.replace(hour=0, minute=0, second=0, microsecond=0)
+                ).total_seconds() / 86400
+                calls += int(row[0] * (1 - elapsed))
+        result.append(calls)
+    return tuple(result)
+
+
+def db_get_limits(group_id):
+    """
+    Retrieve the group and user limits for a specific group.
+
+    Args:
+        group_id (int): The ID of the group.
+
+    Returns:
+        tuple: A tuple containing the group limit and user limit, or (None, None) if not set.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    c.execute(
+        "SELECT group_limit, user_limit FROM limits WHERE group_id = ?", (group_id,)
+    )
+    row = c.fetchone()
+    conn.close()
+    return row if row else (None, None)
+
+
+def db_set_group_limit(group_id, group_limit):
+    """
+    Set or update the group limit for a specific group.
+
+    Args:
+        group_id (int): The ID of the group.
+        group_limit (int): The group limit to set.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    c.execute(
+        """INSERT INTO limits (group_id, group_limit) VALUES (?, ?)
+        ON CONFLICT (group_id) DO UPDATE SET group_limit = excluded.group_limit""",
+        (group_id, group_limit),
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_set_user_limit(group_id, user_limit):
+    """
+    Set or update the user limit for a specific group.
+
+    Args:
+        group_id (int): The ID of the group.
+        user_limit (int): The user limit to set.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    c.execute(
+        """INSERT INTO limits (group_id, user_limit) VALUES (?, ?)
+        ON CONFLICT (group_id) DO UPDATE SET user_limit = excluded.user_limit""",
+        (group_id, user_limit),
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_get_quota_window(group_id):
+    """
+    Retrieve the quota window the limits of a group apply to.
+
+    Args:
+        group_id (int): The ID of the group.
+
+    Returns:
+        str: One of QUOTA_WINDOWS.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    quota_window = _get_quota_window(c, group_id)
+    conn.close()
+    return quota_window
+
+
+def db_set_quota_window(group_id, quota_window):
+    """
+    Set the quota window the limits of a group apply to.
+
+    Args:
+        group_id (int): The ID of the group.
+        quota_window (str): One of QUOTA_WINDOWS.
+
+    Raises:
+        ValueError: If the window is not one of QUOTA_WINDOWS.
+    """
+    if quota_window not in QUOTA_WINDOWS:
+        raise ValueError(f"Unknown quota window {quota_window}")
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    c.execute(
+        """INSERT INTO limits (group_id, quota_window) VALUES (?, ?)
+        ON CONFLICT (group_id) DO UPDATE SET quota_window = excluded.quota_window""",
+        (group_id, quota_window),
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_get_usage(group_id, user_id):
+    """
+    Retrieve the usage of a group and a user in the group's quota window.
+
+    Args:
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+
+    Returns:
+        tuple: A tuple containing the group calls and user calls, or (0, 0) if no usage exists.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    usage = _window_usage(c, group_id, user_id)
+    conn.commit()
+    conn.close()
+    return usage
+
+
+def db_reserve_quota(group_id, user_id, count, group_limit, user_limit):
+    """
+    Reserve quota for several generations of a user in one transaction.
+
+    The usage in the group's quota window plus the open reservations of the
+    group and the user must leave room for `count` more generations. Reserved slots count
+    against the limits until they are released with `db_release_reservation`,
+    or until they expire.
+
+    Args:
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+        count (int): The number of generations to reserve.
+        group_limit (int): The group's limit, or None for no limit.
+        user_limit (int): The per-user limit, or None for no limit.
+
+    Returns:
+        tuple: The reservation ID and None, or None and the exceeded limit
+        ("group" or "user").
+    """
+    now = time.time()
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    c.execute(
+        "DELETE FROM reservations WHERE group_id = ? AND expires_at <= ?",
+        (group_id, now),
+    )
+    group_used, user_used = _window_usage(c, group_id, user_id)
+    c.execute(
+        """SELECT COALESCE(SUM(slots), 0),
+            COALESCE(SUM(CASE WHEN user_id = ? THEN slots END), 0)
+        FROM reservations WHERE group_id = ?""",
+        (user_id, group_id),
+    )
+    group_reserved, user_reserved = c.fetchone()
+
+    exceeded = None
+    if group_limit is not None and group_used + group_reserved + count > group_limit:
+        exceeded = "group"
+    elif user_limit is not None and user_used + user_reserved + count > user_limit:
+        exceeded = "user"
+    if exceeded:
+        conn.commit()
+        conn.close()
+        return None, exceeded
+
+    c.execute(
+        "INSERT INTO reservations (group_id, user_id, slots, expires_at) VALUES (?, ?, ?, ?)",
+        (group_id, user_id, count, now + RESERVATION_TTL_SECONDS),
+    )
+    reservation_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    return reservation_id, None
+
+
+def db_release_reservation(group_id, reservation_id, slots=None):
+    """
+    Release reserved quota, once it is used or no longer needed.
+
+    Args:
+        group_id (int): The ID of the group.
+        reservation_id (int): The ID of the reservation.
+        slots (int, optional): The number of slots to release. Defaults to all.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    if slots is not None:
+        c.execute(
+            "UPDATE reservations SET slots = slots - ? WHERE reservation_id = ? AND group_id = ?",
+            (slots, reservation_id, group_id),
+        )
+    c.execute(
+        "DELETE FROM reservations WHERE reservation_id = ? AND group_id = ? AND (? OR slots <= 0)",
+        (reservation_id, group_id, slots is None),
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_add_memory(
+    user_id,
+    group_id,
+    video_url,
+    task_id,
+    status="pending",
+    prompt=None,
+    seed=None,
+    tier=None,
+    idempotency_key=None,
+):
+    """
+    Add a video URL to the memory table for a specific user.
+
+    A row whose idempotency key is already stored is not added again.
+
+    Args:
+        user_id (int): The ID of the user.
+        group_id (int): The ID of the group.
+        video_url (str): The URL of the video to add.
+        task_id (str): The task ID associated with the video.
+        status (str): The status of the task (default is "pending").
+        prompt (str, optional): The user's prompt, for re-rendering.
+        seed (int, optional): The seed Vidu used, for re-rendering.
+        tier (str, optional): The generation profile tier used.
+        idempotency_key (str, optional): The key of the submission.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    # The next user_video_id is read under the write lock, so concurrent
+    # workers never hand out the same ID
+    c.execute("BEGIN IMMEDIATE")
+    c.execute(
+        """INSERT INTO memory (user_id, group_id, video_url, timestamp, task_id, status, user_video_id, prompt, seed, tier, idempotency_key)
+        SELECT ?, ?, ?, ?, ?, ?, COALESCE(MAX(user_video_id), 0) + 1, ?, ?, ?, ?
+        FROM memory WHERE user_id = ? AND group_id = ?
+        ON CONFLICT (idempotency_key) DO NOTHING""",
+        (
+            user_id,
+            group_id,
+            video_url,
+            datetime.now(timezone.utc),
+            task_id,
+            status,
+            prompt,
+            seed,
+            tier,
+            idempotency_key,
+            user_id,
+            group_id,
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_update_video_url(user_id, group_id, task_id, video_url, status="success"):
+    """
+    Update the video URL in the memory table for a specific user and task.
+
+    Args:
+        user_id (int): The ID of the user.
+        group_id (int): The ID of the group.
+        task_id (str): The task ID associated with the video.
+        video_url (str): The new video URL to update.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    _record_outcome(c, group_id, user_id, task_id, status)
+    c.execute(
+        "UPDATE memory SET video_url = ?, status = ? WHERE user_id = ? AND group_id = ? AND task_id = ?",
+        (video_url, status, user_id, group_id, task_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_complete_video(user_id, group_id, task_id, video_url):
+    """
+    Record a finished video and count it in usage.
+
+    Only a pending row changes, so a video already settled by the sweeper or
+    another tracker is not counted twice. Both happen in one transaction.
+
+    Args:
+        user_id (int): The ID of the user.
+        group_id (int): The ID of the group.
+        task_id (str): The task ID associated with the video.
+        video_url (str): The URL of the video.
+
+    Returns:
+        bool: Whether the row was still pending.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    _record_outcome(c, group_id, user_id, task_id, "success")
+    c.execute(
+        """UPDATE memory SET video_url = ?, status = 'success'
+        WHERE user_id = ? AND group_id = ? AND task_id = ? AND status = 'pending'""",
+        (video_url, user_id, group_id, task_id),
+    )
+    completed = c.rowcount > 0
+    if completed:
+        _count_usage(c, group_id, user_id)
+    conn.commit()
+    conn.close()
+    return completed
+
+
+def db_update_status(user_id, group_id, task_id, status):
+    """
+    Update the status in the memory table for a specific user and task.
+
+    Args:
+        user_id (int): The ID of the user.
+        group_id (int): The ID of the group.
+        task_id (str): The task ID associated with the video.
+        status (str): The new status to update.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    _record_outcome(c, group_id, user_id, task_id, status)
+    c.execute(
+        "UPDATE memory SET status = ? WHERE user_id = ? AND group_id = ? AND task_id = ?",
+        (status, user_id, group_id, task_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_cancel_memory(user_id, group_id, task_id):
+    """
+    Mark a pending video as cancelled.
+
+    Videos that already finished keep their status.
+
+    Args:
+        user_id (int): The ID of the user.
+        group_id (int): The ID of the group.
+        task_id (str): The task ID associated with the video.
+
+    Returns:
+        bool: True if the video was pending and is now cancelled.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    c.execute(
+        "UPDATE memory SET status = 'cancelled' WHERE user_id = ? AND group_id = ? AND task_id = ? AND status = 'pending'",
+        (user_id, group_id, task_id),
+    )
+    cancelled = c.rowcount == 1
+    conn.commit()
+    conn.close()
+    return cancelled
+
+
+def db_get_stale_pending(older_than_seconds, after=None, limit=50):
+    """
+    Retrieve a batch of videos that have been pending for a long time.
+
+    Uses the partial index on pending rows, with keyset pagination on the
+    timestamp and task ID so rows left pending are not returned again in one
+    sweep.
+
+    Args:
+        older_than_seconds (float): Only rows created before this long ago.
+        after (tuple, optional): The (timestamp, task_id) of the last row of
+            the previous batch.
+        limit (int): The maximum number of rows to return.
+
+    Returns:
+        list: Tuples (user_id, group_id, task_id, timestamp), oldest first.
+    """
+    cutoff = str(datetime.now(timezone.utc) - timedelta(seconds=older_than_seconds))
+
+    def query(conn):
+        return conn.execute(
+            """SELECT user_id, group_id, task_id, timestamp FROM memory
+            WHERE status = 'pending' AND timestamp < ? AND (timestamp, task_id) > (?, ?)
+            ORDER BY timestamp, task_id LIMIT ?""",
+            (cutoff, *(after or ("", "")), limit),
+        ).fetchall()
+
+    return sorted(_fan_out(query), key=lambda row: (row[3], row[2]))[:limit]
+
+
+def db_apply_task_outcomes(outcomes):
+    """
+    Record the outcomes of pending videos found by the sweeper.
+
+    Only rows that are still pending change, so a video finished by its
+    tracker in the meantime is not counted twice. Successful videos are
+    counted in usage. Each database is written in one transaction.
+
+    Args:
+        outcomes (list): Tuples (user_id, group_id, task_id, status, video_url)
+            with status "success", "failed" or "expired".
+
+    Returns:
+        int: The number of rows updated.
+    """
+    by_path = {}
+    for outcome in outcomes:
+        path = (
+            get_shard_path(get_shard_index(outcome[1]))
+            if get_shard_count()
+            else get_db_path()
+        )
+        by_path.setdefault(path, []).append(outcome)
+
+    updated = 0
+    for path, batch in by_path.items():
+        conn = _connect(path)
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        for user_id, group_id, task_id, status, video_url in batch:
+            _record_outcome(c, group_id, user_id, task_id, status)
+            c.execute(
+                """UPDATE memory SET status = ?, video_url = COALESCE(?, video_url)
+                WHERE user_id = ? AND group_id = ? AND task_id = ? AND status = 'pending'""",
+                (status, video_url, user_id, group_id, task_id),
+            )
+            changed = c.rowcount
+            if changed and status == "success":
+                _count_usage(c, group_id, user_id)
+            updated += changed
+        conn.commit()
+        conn.close()
+    return updated
+
+
+def db_get_memory(user_id, group_id, before_id=None, after_id=None, limit=5):
+    """
+    Retrieve a page of videos from the memory table for a specific user.
+
+    Pages are found by keyset on user_video_id rather than OFFSET, so every
+    page is a single index range scan no matter how deep the history is.
+
+    Args:
+        user_id (int): The ID of the user.
+        group_id (int): The ID of the group.
+        before_id (int, optional): Only return videos older than this ID.
+        after_id (int, optional): Only return videos newer than this ID.
+        limit (int): The maximum number of videos to return (default is 5).
+
+    Returns:
+        list: A list of tuples (user_video_id, video_url, timestamp), newest first.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    if after_id is not None:
+        c.execute(
+            "SELECT user_video_id, video_url, timestamp FROM memory WHERE user_id = ? AND group_id = ? AND user_video_id > ? ORDER BY user_video_id ASC LIMIT ?",
+            (user_id, group_id, after_id, limit),
+        )
+        rows = c.fetchall()[::-1]
+    else:
+        c.execute(
+            "SELECT user_video_id, video_url, timestamp FROM memory WHERE user_id = ? AND group_id = ? AND user_video_id < ? ORDER BY user_video_id DESC LIMIT ?",
+            (
+                user_id,
+                group_id,
+                before_id if before_id is not None else 2**63 - 1,
+                limit,
+            ),
+        )
+        rows = c.fetchall()
+    conn.close()
+    return rows
+
+
+def db_get_memory_by_id(user_id, group_id, user_video_id):
+    """
+    Retrieve a specific video from the memory table by its user_video_id.
+
+    Args:
+        user_id (int): The ID of the user.
+        group_id (int): The ID of the group.
+        user_video_id (int): The user-specific video ID.
+
+    Returns:
+        tuple: A tuple containing video URL, timestamp, task ID, and status.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    c.execute(
+        "SELECT video_url, timestamp, task_id, status FROM memory WHERE user_id = ? AND group_id = ? AND user_video_id = ?",
+        (user_id, group_id, user_video_id),
+    )
+    memory = c.fetchone()
+    conn.close()
+    return memory
+
+
+def db_get_memory_by_task(user_id, group_id, task_id):
+    """
+    Retrieve the status and video URL of a video by its task ID.
+
+    Args:
+        user_id (int): The ID of the user.
+        group_id (int): The ID of the group.
+        task_id (str): The task ID associated with the video.
+
+    Returns:
+        tuple: The status and video URL, or None if there is no such video.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    c.execute(
+        "SELECT status, video_url FROM memory WHERE user_id = ? AND group_id = ? AND task_id = ?",
+        (user_id, group_id, task_id),
+    )
+    row = c.fetchone()
+    conn.close()
+    return row
+
+
+def db_add_group(group_id, group_name):
+    """
+    Add a group to the database or update its name if it already exists.
+
+    Args:
+        group_id (int): The ID of the group.
+        group_name (str): The name of the group.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(
+        """
+        INSERT INTO groups (group_id, group_name)
+        VALUES (?, ?)
+        ON CONFLICT(group_id) DO UPDATE SET group_name = excluded.group_name
+        """,
+        (group_id, group_name),
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_get_memory_source(user_id, group_id, user_video_id):
+    """
+    Retrieve what is needed to re-render a video from the memory table.
+
+    Args:
+        user_id (int): The ID of the user.
+        group_id (int): The ID of the group.
+        user_video_id (int): The user-specific video ID.
+
+    Returns:
+        tuple: The prompt, seed and tier, or None if there is no such video.
+    """
+    conn = get_db_connection(group_id)
+    c = conn.cursor()
+    c.execute(
+        "SELECT prompt, seed, tier FROM memory WHERE user_id = ? AND group_id = ? AND user_video_id = ?",
+        (user_id, group_id, user_video_id),
+    )
+    row = c.fetchone()
+    conn.close()
+    return row
+
+
+_profile_cache = {}
+_profile_cache_lock = threading.Lock()
+
+
+def db_get_profiles(group_id):
+    """
+    Retrieve the generation profile overrides of a group.
+
+    Results are cached for PROFILE_CACHE_SECONDS; changes made through
+    `db_set_profile` and `db_reset_profile` take effect immediately.
+
+    Args:
+        group_id (int): The ID of the group.
+
+    Returns:
+        dict: Maps tier to a dict of the overridden settings.
+    """
+    now = time.monotonic()
+    with _profile_cache_lock:
+        cached = _profile_cache.get((_namespace.get(), group_id))
+    if cached and cached[0] > now:
+        return cached[1]
+
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(
+        "SELECT tier, model, duration, aspect_ratio, resolution FROM profiles WHERE group_id = ?",
+        (group_id,),
+    )
+    profiles = {}
+    for tier, *values in c.fetchall():
+        fields = zip(("model", "duration", "aspect_ratio", "resolution"), values)
+        profiles[tier] = {key: value for key, value in fields if value is not None}
+    conn.close()
+
+    with _profile_cache_lock:
+        _profile_cache[(_namespace.get(), group_id)] = (
+            now + PROFILE_CACHE_SECONDS,
+            profiles,
+        )
+    return profiles
+
+
+def db_set_profile(group_id, tier, **settings):
+    """
+    Override settings of a group's generation profile tier.
+
+    Args:
+        group_id (int): The ID of the group.
+        tier (str): The profile tier.
+        **settings: Any of model, duration, aspect_ratio and resolution.
+    """
+    columns = ", ".join(settings)
+    updates = ", ".join(f"{key} = excluded.{key}" for key in settings)
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(
+        f"""INSERT INTO profiles (group_id, tier, {columns})
+        VALUES (?, ?, {", ".join("?" for _ in settings)})
+        ON CONFLICT (group_id, tier) DO UPDATE SET {updates}""",
+        (group_id, tier, *settings.values()),
+    )
+    conn.commit()
+    conn.close()
+    with _profile_cache_lock:
+        _profile_cache.pop((_namespace.get(), group_id), None)
+
+
+def db_reset_profile(group_id, tier):
+    """
+    Remove the overrides of a group's generation profile tier.
+
+    Args:
+        group_id (int): The ID of the group.
+        tier (str): The profile tier.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM profiles WHERE group_id = ? AND tier = ?", (group_id, tier))
+    conn.commit()
+    conn.close()
+    with _profile_cache_lock:
+        _profile_cache.pop((_namespace.get(), group_id), None)
+
+
+def db_get_all_groups():
+    """
+    Retrieve all groups from the database.
+
+    Returns:
+        list: A list of tuples containing group IDs and names.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT group_id, group_name FROM groups")
+    groups = c.fetchall()
+    conn.close()
+    return groups
+
+
+def db_iter_groups(name_prefix=None, after_id=None, before_id=None, batch_size=50):
+    """
+    Stream groups with their limits and this month's usage, ordered by name.
+
+    Rows are read from the cursor in batches instead of being materialized.
+    Paging uses a keyset on (group_name, group_id) taken from `after_id` or
+    `before_id`, so every page is an index range scan. Without sharding the
+    summaries are joined in the same query; with sharding each batch of the
+    catalog is summarized with one parallel query per shard.
+
+    Args:
+        name_prefix (str, optional): Only groups whose name starts with this, ignoring case.
+        after_id (int, optional): Continue after this group, in ascending order.
+        before_id (int, optional): Continue before this group, in descending order.
+        batch_size (int): The number of rows fetched from the cursor at a time.
+
+    Yields:
+        tuple: (group_id, group_name, group_limit, user_limit, month_calls).
+    """
+    sharded = bool(get_shard_count())
+    conditions, params = [], []
+    if name_prefix:
+        conditions.append(
+            "g.group_name >= ? COLLATE NOCASE AND g.group_name < ? COLLATE NOCASE"
+        )
+        params += [name_prefix, name_prefix + "\U0010ffff"]
+
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        cursor_id = after_id if after_id is not None else before_id
+        if cursor_id is not None:
+            c.execute("SELECT group_name FROM groups WHERE group_id = ?", (cursor_id,))
+            row = c.fetchone()
+            if row is None:
+                return
+            # The plain bound lets SQLite use the index for the row-value keyset
+            op = ">" if after_id is not None else "<"
+            conditions.append(
+                f"g.group_name {op}= ? COLLATE NOCASE AND (g.group_name COLLATE NOCASE, g.group_id) {op} (?, ?)"
+            )
+            params += [row[0], row[0], cursor_id]
+
+        order = "DESC" if before_id is not None else "ASC"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        if sharded:
+            columns = "g.group_id, g.group_name"
+            joins = ""
+        else:
+            columns = """g.group_id, g.group_name, l.group_limit, l.user_limit,
+                (SELECT COALESCE(SUM(u.user_calls), 0) FROM usage u
+                 WHERE u.group_id = g.group_id AND u.month = ?)"""
+            joins = "LEFT JOIN limits l ON l.group_id = g.group_id"
+            params.insert(0, db_get_month())
+        c.execute(
+            f"""SELECT {columns} FROM groups g {joins} {where}
+            ORDER BY g.group_name COLLATE NOCASE {order}, g.group_id {order}""",
+            params,
+        )
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                return
+            if sharded:
+                summaries = db_get_group_summaries([row[0] for row in rows])
+                rows = [
+                    (group_id, name, *summaries.get(group_id, (None, None, 0)))
+                    for group_id, name in rows
+                ]
+            yield from rows
+    finally:
+        conn.close()
+
+
+def db_import_config(entries, dry_run=False):
+    """
+    Apply a bulk import of group limits and references.
+
+    The current values of every group are read and the changes written in
+    one transaction per database file; all files are committed together at
+    the end, or rolled back on error or for a dry run. Fields that are None
+    in an entry are left unchanged.
+
+    Args:
+        entries (list): Dicts with group_id and optional group_limit,
+            user_limit and reference.
+        dry_run (bool): If True, compute the changes without writing them.
+
+    Returns:
+        list: The changes as (group_id, field, old value, new value) tuples.
+    """
+    connections = {}
+
+    def cursor_for(path):
+        if path not in connections:
+            conn = _connect(path)
+            conn.execute("BEGIN IMMEDIATE")
+            connections[path] = conn
+        return connections[path].cursor()
+
+    changes = []
+    try:
+        catalog = cursor_for(get_db_path())
+        for entry in entries:
+            group_id = entry["group_id"]
+            path = get_db_path()
+            if get_shard_count():
+                path = get_shard_path(get_shard_index(group_id))
+            c = cursor_for(path)
+
+            c.execute(
+                "SELECT group_limit, user_limit FROM limits WHERE group_id = ?",
+                (group_id,),
+            )
+            old_limits = c.fetchone() or (None, None)
+            new_limits = list(old_limits)
+            for index, field in enumerate(("group_limit", "user_limit")):
+                value = entry.get(field)
+                if value is not None and value != old_limits[index]:
+                    changes.append((group_id, field, old_limits[index], value))
+                    new_limits[index] = value
+            if tuple(new_limits) != tuple(old_limits):
+                c.execute(
+                    """INSERT INTO limits (group_id, group_limit, user_limit) VALUES (?, ?, ?)
+                    ON CONFLICT (group_id) DO UPDATE SET
+                        group_limit = excluded.group_limit,
+                        user_limit = excluded.user_limit""",
+                    (group_id, *new_limits),
+                )
+
+            reference = entry.get("reference")
+            if reference is not None:
+                catalog.execute(
+                    "SELECT prompt FROM prompts WHERE group_id = ?", (group_id,)
+                )
+                row = catalog.fetchone()
+                old_reference = row[0] if row else None
+                if reference != old_reference:
+                    changes.append((group_id, "reference", old_reference, reference))
+                    catalog.execute(
+                        "INSERT OR REPLACE INTO prompts (group_id, prompt) VALUES (?, ?)",
+                        (group_id, reference),
+                    )
+
+        for conn in connections.values():
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+    except Exception:
+        for conn in connections.values():
+            conn.rollback()
+        raise
+    finally:
+        for conn in connections.values():
+            conn.close()
+    return changes
+
+
+def db_enqueue_job(
+    group_id,
+    user_id,
+    chat_id,
+    message_id,
+    prompt,
+    images,
+    params,
+    idempotency_key=None,
+):
+    """
+    Add a video generation job to the queue for the worker processes.
+
+    Args:
+        group_id (int): The ID of the group.
+        user_id (int): The ID of the user.
+        chat_id (int): The chat to deliver the result to.
+        message_id (int): The message to reply to with the result.
+        prompt (str): The full prompt to send to Vidu.
+        images (list): The reference images.
+        params (dict): Generation parameters (model, duration, aspect_ratio, resolution).
+        idempotency_key (str, optional): Identifies the prompt of the command,
+            so a redelivered update doesn't queue it twice.
+
+    Returns:
+        int: The ID of the new job, or None if a job with the key exists.
+    """
+    now = time.time()
+    conn = get_queue_connection()
+    c = conn.cursor()
+    c.execute(
+        """INSERT INTO jobs (group_id, user_id, chat_id, message_id, prompt, images, params, state, next_check, created_at, updated_at, idempotency_key, namespace)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?) ON CONFLICT (idempotency_key) DO NOTHING""",
+        (
+            group_id,
+            user_id,
+            chat_id,
+            message_id,
+            prompt,
+            json.dumps(images),
+            json.dumps(params),
+            now,
+            now,
+            now,
+            idempotency_key,
+            _namespace.get(),
+        ),
+    )
+    job_id = c.lastrowid if c.rowcount == 1 else None
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+def db_claim_submission(idempotency_key):
+    """
+    Record an idempotency key before a prompt is submitted to Vidu.
+
+    Args:
+        idempotency_key (str): Identifies the prompt of a command.
+
+    Returns:
+        tuple: True and None if the key is new and the caller should submit.
+        Otherwise False and the task ID the key maps to, which is None while
+        the earlier submission has no task (yet).
+    """
+    conn = get_queue_connection()
+    c = conn.cursor()
+    c.execute(
+        "INSERT INTO submissions (idempotency_key, created_at) VALUES (?, ?) ON CONFLICT DO NOTHING",
+        (idempotency_key, time.time()),
     )
+    claimed = c.rowcount == 1
+    task_id = None
+    if not claimed:
+        c.execute(
+            "SELECT task_id FROM submissions WHERE idempotency_key = ?",
+            (idempotency_key,),
+        )
+        task_id = c.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return claimed, task_id
+
+
+def db_complete_submission(idempotency_key, task_id):
+    """
+    Map an idempotency key to the task Vidu created for it.
+
+    Args:
+        idempotency_key (str): The key.
+        task_id (str): The Vidu task ID.
+    """
+    conn = get_queue_connection()
+    c = conn.cursor()
     c.execute(
-        """CREATE TABLE IF NOT EXISTS memory (
-        user_id INTEGER,
-        group_id INTEGER,
-        video_url TEXT,
-        timestamp TEXT,
-        task_id TEXT,
-        status TEXT,
-        user_video_id INTEGER
-    )"""
+        "UPDATE submissions SET task_id = ? WHERE idempotency_key = ?",
+        (task_id, idempotency_key),
     )
     conn.commit()
     conn.close()
 
 
-def get_db_connection():
+def db_release_submission(idempotency_key):
     """
-    Get a get_db_path() connection.
+    Forget an idempotency key whose submission certainly created no task, so
+    the prompt can be submitted again.
 
-    Returns:
-        sqlite3.Connection: A connection object to the get_db_path().
+    Args:
+        idempotency_key (str): The key.
     """
-    return sqlite3.connect(get_db_path())
+    conn = get_queue_connection()
+    c = conn.cursor()
+    c.execute(
+        "DELETE FROM submissions WHERE idempotency_key = ? AND task_id IS NULL",
+        (idempotency_key,),
+    )
+    conn.commit()
+    conn.close()
 
 
-def db_get_month():
+def db_prune_daily_usage(
+    days_to_keep=DAILY_USAGE_RETENTION_DAYS, batch_size=RETENTION_BATCH_SIZE
+):
     """
-    Get the current month in the format 'YYYY-MM'.
+    Delete one batch of daily usage counters older than any quota window.
+
+    Args:
+        days_to_keep (int): Number of days of counters to keep.
+        batch_size (int): The maximum number of rows to delete per database.
 
     Returns:
-        str: The current month as a string.
+        int: The number of rows deleted.
     """
-    return datetime.now(timezone.utc).strftime("%Y-%m")
+    cutoff = _get_day(datetime.now(timezone.utc) - timedelta(days=days_to_keep))
+    deleted = 0
+    for path in _group_data_paths():
+        conn = _connect(path)
+        c = conn.cursor()
+        c.execute(
+            """DELETE FROM usage_daily WHERE rowid IN (
+                SELECT rowid FROM usage_daily WHERE day < ? LIMIT ?
+            )""",
+            (cutoff, batch_size),
+        )
+        deleted += c.rowcount
+        conn.commit()
+        conn.close()
+    return deleted
 
 
-def db_get_reference(group_id):
+def db_prune_submissions(days_to_keep, batch_size=RETENTION_BATCH_SIZE):
     """
-    Retrieve the reference text for a specific group.
+    Delete one batch of idempotency keys older than any update redelivery.
 
     Args:
-        group_id (int): The ID of the group.
+        days_to_keep (int): Number of days of keys to keep.
+        batch_size (int): The maximum number of keys to delete.
 
     Returns:
-        str or None: The reference text if it exists, otherwise None.
+        int: The number of keys deleted.
     """
-
-    conn = sqlite3.connect(get_db_path())
+    conn = get_queue_connection()
     c = conn.cursor()
-    c.execute("SELECT prompt FROM prompts WHERE group_id = ?", (group_id,))
-    row = c.fetchone()
+    c.execute(
+        """DELETE FROM submissions WHERE rowid IN (
+            SELECT rowid FROM submissions WHERE created_at < ? LIMIT ?
+        )""",
+        (time.time() - days_to_keep * 86400, batch_size),
+    )
+    deleted = c.rowcount
+    conn.commit()
     conn.close()
-    return row[0] if row else None
+    return deleted
 
 
-def db_add_reference(group_id, ref):
+def _job_from_row(row, columns):
+    job = dict(zip(columns, row))
+    job["images"] = json.loads(job["images"])
+    job["params"] = json.loads(job["params"])
+    return job
+
+
+def db_claim_jobs(worker_id, limit, lease_seconds):
     """
-    Add or update the reference text for a specific group.
+    Atomically lease queued or in-progress jobs that are due for work.
+
+    Jobs whose lease has expired, for example because their worker died, are
+    claimable again, so no job is lost with its worker.
 
     Args:
-        group_id (int): The ID of the group.
-        ref (str): The reference text to set.
+        worker_id (str): The ID of the claiming worker.
+        limit (int): The maximum number of jobs to claim.
+        lease_seconds (float): How long the lease is valid.
+
+    Returns:
+        list: A list of job dicts.
     """
-    conn = sqlite3.connect(get_db_path())
+    now = time.time()
+    conn = get_queue_connection()
     c = conn.cursor()
+    # Take the write lock up front so no other worker can claim the same rows
+    c.execute("BEGIN IMMEDIATE")
     c.execute(
-        "INSERT OR REPLACE INTO prompts (group_id, prompt) VALUES (?, ?)",
-        (group_id, ref),
+        """SELECT job_id, group_id, user_id, chat_id, message_id, prompt, images, params, state, task_id, attempts, created_at, idempotency_key, namespace
+        FROM jobs
+        WHERE state IN ('queued', 'processing') AND next_check <= ?
+        AND (lease_expires IS NULL OR lease_expires < ?)
+        ORDER BY next_check LIMIT ?""",
+        (now, now, limit),
+    )
+    columns = [column[0] for column in c.description]
+    rows = c.fetchall()
+    c.executemany(
+        "UPDATE jobs SET lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? WHERE job_id = ?",
+        [(worker_id, now + lease_seconds, now, row[0]) for row in rows],
     )
     conn.commit()
     conn.close()
+    return [_job_from_row(row, columns) for row in rows]
 
 
-def db_update_usage(group_id, user_id):
+def db_release_job(job_id, worker_id, **fields):
     """
-    Update the usage statistics for a specific group and user.
+    Update a leased job and release its lease.
+
+    The update only applies while the worker still holds the lease, so a
+    worker whose lease expired cannot overwrite the job's new owner.
 
     Args:
-        group_id (int): The ID of the group.
-        user_id (int): The ID of the user.
+        job_id (int): The ID of the job.
+        worker_id (str): The ID of the worker holding the lease.
+        **fields: Columns to update (state, task_id, video_url, error, next_check).
+
+    Returns:
+        bool: True if the job was updated.
     """
-    month = db_get_month()
-    conn = sqlite3.connect(get_db_path())
+    allowed = {"state", "task_id", "video_url", "error", "next_check"}
+    unknown = set(fields) - allowed
+    if unknown:
+        raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+
+    assignments = "".join(f"{name} = ?, " for name in fields)
+    conn = get_queue_connection()
     c = conn.cursor()
     c.execute(
-        """INSERT OR IGNORE INTO usage (group_id, user_id, month) VALUES (?, ?, ?)""",
-        (group_id, user_id, month),
-    )
-    c.execute(
-        """UPDATE usage SET group_calls = group_calls + 1, user_calls = user_calls + 1 WHERE group_id = ? AND user_id = ? AND month = ?""",
-        (group_id, user_id, month),
+        f"UPDATE jobs SET {assignments}lease_owner = NULL, lease_expires = NULL, updated_at = ? WHERE job_id = ? AND lease_owner = ?",
+        (*fields.values(), time.time(), job_id, worker_id),
     )
+    updated = c.rowcount == 1
     conn.commit()
     conn.close()
+    return updated
 
 
-def db_get_limits(group_id):
+def db_cancel_jobs(user_id, group_id, message_id=None, task_id=None):
     """
-    Retrieve the group and user limits for a specific group.
+    Cancel a user's unfinished jobs, by the command that started them or by
+    Vidu task ID.
+
+    Cancelled jobs lose their lease, so a worker still busy with one cannot
+    release it again and is never handed it by `db_claim_jobs`.
 
     Args:
+        user_id (int): The ID of the user.
         group_id (int): The ID of the group.
+        message_id (int, optional): The message of the /imagine command.
+        task_id (str, optional): The Vidu task ID.
 
     Returns:
-        tuple: A tuple containing the group limit and user limit, or (None, None) if not set.
+        list: Dicts with job_id, task_id and params of the cancelled jobs.
     """
-    conn = sqlite3.connect(get_db_path())
+    conditions = [
+        "user_id = ?",
+        "group_id = ?",
+        "namespace = ?",
+        "state IN ('queued', 'processing')",
+    ]
+    parameters = [user_id, group_id, _namespace.get()]
+    if message_id is not None:
+        conditions.append("message_id = ?")
+        parameters.append(message_id)
+    if task_id is not None:
+        conditions.append("task_id = ?")
+        parameters.append(task_id)
+
+    conn = get_queue_connection()
     c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
     c.execute(
-        "SELECT group_limit, user_limit FROM limits WHERE group_id = ?", (group_id,)
+        f"SELECT job_id, task_id, params FROM jobs WHERE {' AND '.join(conditions)}",
+        parameters,
     )
-    row = c.fetchone()
+    jobs = [
+        {"job_id": job_id, "task_id": task_id, "params": json.loads(params)}
+        for job_id, task_id, params in c.fetchall()
+    ]
+    c.executemany(
+        """UPDATE jobs SET state = 'cancelled', delivered = 1, lease_owner = NULL,
+        lease_expires = NULL, updated_at = ? WHERE job_id = ?""",
+        [(time.time(), job["job_id"]) for job in jobs],
+    )
+    conn.commit()
     conn.close()
-    return row if row else (None, None)
+    return jobs
 
 
-def db_set_group_limit(group_id, group_limit):
+def db_count_outstanding_jobs(group_id):
     """
-    Set or update the group limit for a specific group.
+    Count the jobs that are queued or being generated, for all namespaces.
 
     Args:
-        group_id (int): The ID of the group.
-        group_limit (int): The group limit to set.
+        group_id (int): The group of the current namespace to count separately.
+
+    Returns:
+        tuple: The number of outstanding jobs in total and of the group.
     """
-    conn = sqlite3.connect(get_db_path())
+    conn = get_queue_connection()
     c = conn.cursor()
     c.execute(
-        "INSERT OR REPLACE INTO limits (group_id, group_limit, user_limit) VALUES (?, ?, COALESCE((SELECT user_limit FROM limits WHERE group_id = ?), NULL))",
-        (group_id, group_limit, group_id),
+        """SELECT COUNT(*), COALESCE(SUM(group_id = ? AND namespace = ?), 0) FROM jobs
+        WHERE state IN ('queued', 'processing')""",
+        (group_id, _namespace.get()),
     )
-    conn.commit()
+    counts = c.fetchone()
     conn.close()
+    return counts
 
 
-def db_set_user_limit(group_id, user_limit):
+def db_count_finished_jobs(seconds):
     """
-    Set or update the user limit for a specific group.
+    Count the jobs that finished recently, to estimate the throughput.
 
     Args:
-        group_id (int): The ID of the group.
-        user_limit (int): The user limit to set.
+        seconds (float): How far back to count.
+
+    Returns:
+        int: The number of jobs that succeeded or failed in that time.
     """
-    conn = sqlite3.connect(get_db_path())
+    conn = get_queue_connection()
     c = conn.cursor()
     c.execute(
-        "INSERT OR REPLACE INTO limits (group_id, group_limit, user_limit) VALUES (?, COALESCE((SELECT group_limit FROM limits WHERE group_id = ?), NULL), ?)",
-        (group_id, group_id, user_limit),
+        "SELECT COUNT(*) FROM jobs WHERE state IN ('success', 'failed') AND updated_at >= ?",
+        (time.time() - seconds,),
     )
-    conn.commit()
+    count = c.fetchone()[0]
     conn.close()
+    return count
 
 
-def db_get_usage(group_id, user_id):
+def db_get_finished_jobs(limit=50):
     """
-    Retrieve the usage statistics for a specific group and user.
+    Retrieve finished jobs of the current namespace whose result has not been
+    delivered yet.
 
     Args:
-        group_id (int): The ID of the group.
-        user_id (int): The ID of the user.
+        limit (int): The maximum number of jobs to return.
 
     Returns:
-        tuple: A tuple containing the group calls and user calls, or (0, 0) if no usage exists.
+        list: A list of tuples (job_id, chat_id, message_id, state, video_url, error).
     """
-    conn = sqlite3.connect(get_db_path())
+    conn = get_queue_connection()
     c = conn.cursor()
     c.execute(
-        "SELECT group_calls, user_calls FROM usage WHERE group_id = ? AND user_id = ? AND month = ?",
-        (group_id, user_id, db_get_month()),
+        """SELECT job_id, chat_id, message_id, state, video_url, error FROM jobs
+        WHERE delivered = 0 AND state IN ('success', 'failed') AND namespace = ?
+        ORDER BY job_id LIMIT ?""",
+        (_namespace.get(), limit),
     )
-    row = c.fetchone()
+    rows = c.fetchall()
     conn.close()
-    return row if row else (0, 0)
+    return rows
 
 
-def db_add_memory(user_id, group_id, video_url, task_id, status="pending"):
+def db_mark_job_delivered(job_id):
     """
-    Add a video URL to the memory table for a specific user.
+    Mark a finished job's result as delivered.
 
     Args:
-        user_id (int): The ID of the user.
-        group_id (int): The ID of the group.
-        video_url (str): The URL of the video to add.
-        task_id (str): The task ID associated with the video.
-        status (str): The status of the task (default is "pending").
+        job_id (int): The ID of the job.
     """
-    conn = sqlite3.connect(get_db_path())
+    conn = get_queue_connection()
     c = conn.cursor()
+    c.execute("UPDATE jobs SET delivered = 1 WHERE job_id = ?", (job_id,))
+    conn.commit()
+    conn.close()
 
-    # Calculate the next user_video_id
-    c.execute(
-        "SELECT COALESCE(MAX(user_video_id), 0) + 1 FROM memory WHERE user_id = ? AND group_id = ?",
-        (user_id, group_id),
-    )
-    next_user_video_id = c.fetchone()[0]
 
-    # Insert the new record
-    c.execute(
-        "INSERT INTO memory (user_id, group_id, video_url, timestamp, task_id, status, user_video_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (
-            user_id,
-            group_id,
-            video_url,
-            datetime.now(timezone.utc),
-            task_id,
-            status,
-            next_user_video_id,
-        ),
+def db_save_checkpoints(entries):
+    """
+    Persist the tracking state of unfinished generations at shutdown.
+
+    Args:
+        entries (list): Dicts with task_id, group_id, user_id, chat_id,
+            message_id, prompt and, if not the current one, namespace.
+    """
+    now = time.time()
+    conn = get_queue_connection()
+    c = conn.cursor()
+    c.executemany(
+        """INSERT OR REPLACE INTO checkpoints (task_id, group_id, user_id, chat_id, message_id, prompt, created_at, namespace)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        [
+            (
+                entry["task_id"],
+                entry["group_id"],
+                entry["user_id"],
+                entry["chat_id"],
+                entry["message_id"],
+                entry["prompt"],
+                now,
+                entry.get("namespace", _namespace.get()),
+            )
+            for entry in entries
+        ],
     )
     conn.commit()
     conn.close()
 
 
-def db_update_video_url(user_id, group_id, task_id, video_url, status="success"):
+def db_get_checkpoints():
     """
-    Update the video URL in the memory table for a specific user and task.
+    Retrieve the current namespace's generations left unfinished by the last
+    shutdown.
 
-    Args:
-        user_id (int): The ID of the user.
-        group_id (int): The ID of the group.
-        task_id (str): The task ID associated with the video.
-        video_url (str): The new video URL to update.
+    Returns:
+        list: Dicts with task_id, group_id, user_id, chat_id, message_id,
+        prompt, created_at and namespace.
     """
-    conn = sqlite3.connect(get_db_path())
+    conn = get_queue_connection()
     c = conn.cursor()
     c.execute(
-        "UPDATE memory SET video_url = ?, status = ? WHERE user_id = ? AND group_id = ? AND task_id = ?",
-        (video_url, status, user_id, group_id, task_id),
+        """SELECT task_id, group_id, user_id, chat_id, message_id, prompt, created_at, namespace
+        FROM checkpoints WHERE namespace = ? ORDER BY created_at""",
+        (_namespace.get(),),
     )
-    conn.commit()
+    columns = [column[0] for column in c.description]
+    rows = [dict(zip(columns, row)) for row in c.fetchall()]
     conn.close()
+    return rows
 
 
-def db_update_status(user_id, group_id, task_id, status):
+def db_delete_checkpoint(task_id):
     """
-    Update the status in the memory table for a specific user and task.
+    Forget a checkpointed generation once its result has been delivered.
 
     Args:
-        user_id (int): The ID of the user.
-        group_id (int): The ID of the group.
-        task_id (str): The task ID associated with the video.
-        status (str): The new status to update.
+        task_id (str): The Vidu task ID.
     """
-    conn = sqlite3.connect(get_db_path())
+    conn = get_queue_connection()
     c = conn.cursor()
-    c.execute(
-        "UPDATE memory SET status = ? WHERE user_id = ? AND group_id = ? AND task_id = ?",
-        (status, user_id, group_id, task_id),
-    )
+    c.execute("DELETE FROM checkpoints WHERE task_id = ?", (task_id,))
     conn.commit()
     conn.close()
 
 
-def db_get_memory(user_id, group_id):
+def db_checkpoint_wal():
+    """
+    Write the WAL of the shared database and every database of the current
+    namespace back into the main files.
+
+    Run at shutdown so the next start doesn't begin by replaying a large WAL.
+    """
+    paths = list(dict.fromkeys([get_queue_path(), get_db_path()]))
+    if get_shard_count():
+        paths += _group_data_paths()
+    for path in paths:
+        conn = _connect(path)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        conn.close()
+
+
+def db_get_group_summaries(group_ids):
     """
-    Retrieve the last 5 video URLs from the memory table for a specific user.
+    Retrieve limits and this month's usage for several groups.
+
+    Queries all shards in parallel in sharded mode.
 
     Args:
-        user_id (int): The ID of the user.
-        group_id (int): The ID of the group.
+        group_ids (list): The IDs of the groups.
 
     Returns:
-        list: A list of tuples containing video URLs and timestamps.
+        dict: Maps group ID to a tuple (group_limit, user_limit, month_calls).
     """
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute(
-        "SELECT user_video_id, video_url, timestamp FROM memory WHERE user_id = ? AND group_id = ? ORDER BY timestamp DESC LIMIT 5",
-        (
-            user_id,
-            group_id,
-        ),
-    )
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    if not group_ids:
+        return {}
+    placeholders = ", ".join("?" for _ in group_ids)
+    month = db_get_month()
 
+    def query(conn):
+        c = conn.cursor()
+        c.execute(
+            f"""SELECT g.group_id, l.group_limit, l.user_limit, COALESCE(u.calls, 0)
+            FROM (SELECT DISTINCT group_id FROM limits WHERE group_id IN ({placeholders})
+                  UNION SELECT DISTINCT group_id FROM usage WHERE month = ? AND group_id IN ({placeholders})) g
+            LEFT JOIN limits l ON l.group_id = g.group_id
+            LEFT JOIN (SELECT group_id, SUM(user_calls) AS calls FROM usage
+                       WHERE month = ? AND group_id IN ({placeholders}) GROUP BY group_id) u
+                ON u.group_id = g.group_id""",
+            (*group_ids, month, *group_ids, month, *group_ids),
+        )
+        return c.fetchall()
 
-def db_get_memory_by_id(user_id, group_id, user_video_id):
+    return {row[0]: row[1:] for row in _fan_out(query)}
+
+
+def db_get_group_stats(group_id, months=6, top_users=5):
     """
-    Retrieve a specific video from the memory table by its user_video_id.
+    Retrieve the precomputed statistics of a group.
+
+    Only reads the `group_stats` aggregates and this month's per-user
+    counters, never the memory table.
 
     Args:
-        user_id (int): The ID of the user.
         group_id (int): The ID of the group.
-        user_video_id (int): The user-specific video ID.
+        months (int): The number of recent months to include.
+        top_users (int): The number of top users of this month to include.
 
     Returns:
-        tuple: A tuple containing video URL, timestamp, task ID, and status.
+        tuple: A list of (month, calls, successes, failures, avg latency ms or
+        None) tuples, newest first, and a list of (user_id, calls) tuples.
     """
-    conn = sqlite3.connect(get_db_path())
+    conn = get_db_connection(group_id)
     c = conn.cursor()
     c.execute(
-        "SELECT video_url, timestamp, task_id, status FROM memory WHERE user_id = ? AND group_id = ? AND user_video_id = ?",
-        (user_id, group_id, user_video_id),
+        """SELECT month, calls, successes, failures,
+            latency_ms_total / NULLIF(latency_count, 0)
+        FROM group_stats WHERE group_id = ? ORDER BY month DESC LIMIT ?""",
+        (group_id, months),
     )
-    memory = c.fetchone()
+    monthly = c.fetchall()
+    c.execute(
+        """SELECT user_id, user_calls FROM usage WHERE group_id = ? AND month = ?
+        ORDER BY user_calls DESC, user_id LIMIT ?""",
+        (group_id, db_get_month(), top_users),
+    )
+    users = c.fetchall()
     conn.close()
-    return memory
+    return monthly, users
 
 
-def db_add_group(group_id, group_name):
+def db_get_stats_overview(top_groups=10):
     """
-    Add a group to the database or update its name if it already exists.
+    Retrieve this month's totals over all groups and the busiest groups.
+
+    Queries all shards in parallel in sharded mode.
 
     Args:
-        group_id (int): The ID of the group.
-        group_name (str): The name of the group.
+        top_groups (int): The number of busiest groups to include.
+
+    Returns:
+        tuple: The totals as (calls, successes, failures, avg latency ms or
+        None) and a list of (group_id, group_name, calls, successes, failures)
+        tuples.
     """
-    conn = sqlite3.connect(get_db_path())
+    month = db_get_month()
+
+    def totals(conn):
+        c = conn.cursor()
+        c.execute(
+            """SELECT SUM(calls), SUM(successes), SUM(failures),
+                SUM(latency_ms_total), SUM(latency_count)
+            FROM group_stats WHERE month = ?""",
+            (month,),
+        )
+        return c.fetchall()
+
+    def busiest(conn):
+        c = conn.cursor()
+        c.execute(
+            """SELECT group_id, calls, successes, failures FROM group_stats
+            WHERE month = ? ORDER BY calls DESC LIMIT ?""",
+            (month, top_groups),
+        )
+        return c.fetchall()
+
+    rows = _fan_out(totals)
+    calls, successes, failures, latency_total, latency_count = (
+        sum(row[index] or 0 for row in rows) for index in range(5)
+    )
+    groups = sorted(_fan_out(busiest), key=lambda row: -row[1])[:top_groups]
+
+    conn = get_db_connection()
     c = conn.cursor()
+    placeholders = ", ".join("?" for _ in groups)
     c.execute(
-        """
-        INSERT INTO groups (group_id, group_name)
-        VALUES (?, ?)
-        ON CONFLICT(group_id) DO UPDATE SET group_name = excluded.group_name
-        """,
-        (group_id, group_name),
+        f"SELECT group_id, group_name FROM groups WHERE group_id IN ({placeholders})",
+        [row[0] for row in groups],
     )
-    conn.commit()
+    names = dict(c.fetchall())
     conn.close()
 
+    return (
+        (
+            calls,
+            successes,
+            failures,
+            latency_total / latency_count if latency_count else None,
+        ),
+        [(row[0], names.get(row[0]), *row[1:]) for row in groups],
+    )
 
-def db_get_all_groups():
+
+def db_rebalance_into_shards(shard_count):
     """
-    Retrieve all groups from the database.
+    Move usage, limits, memory and statistics rows from the single-file
+    database into shards.
+
+    Each shard is filled in one transaction with the source attached, and the
+    moved rows are deleted from the source in the same transaction.
+
+    Args:
+        shard_count (int): The number of shards to distribute the rows over.
 
     Returns:
-        list: A list of tuples containing group IDs and names.
+        dict: Maps table name to the number of rows moved.
     """
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT group_id, group_name FROM groups")
-    groups = c.fetchall()
-    conn.close()
-    return groups
+    source = get_db_path()
+    moved = {
+        "usage": 0,
+        "limits": 0,
+        "memory": 0,
+        "group_stats": 0,
+        "usage_rollup": 0,
+        "usage_daily": 0,
+        "usage_windows": 0,
+    }
+    for index in range(shard_count):
+        conn = _connect(get_shard_path(index))
+        conn.create_function(
+            "shard_of",
+            1,
+            lambda group_id: get_shard_index(group_id, shard_count),
+            deterministic=True,
+        )
+        c = conn.cursor()
+        _create_shard_tables(c)
+        c.execute("ATTACH DATABASE ? AS source", (source,))
+        c.execute("BEGIN IMMEDIATE")
+        for table in moved:
+            c.execute(
+                f"INSERT OR REPLACE INTO main.{table} SELECT * FROM source.{table} WHERE shard_of(group_id) = ?",
+                (index,),
+            )
+            moved[table] += c.rowcount
+            c.execute(
+                f"DELETE FROM source.{table} WHERE shard_of(group_id) = ?", (index,)
+            )
+        conn.commit()
+        c.execute("DETACH DATABASE source")
+        c.execute("PRAGMA journal_mode=WAL")
+        conn.close()
+    return moved
+
+
+def db_rollup_usage(months_to_keep, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Fold one batch of old monthly usage rows into the `usage_rollup` table.
+
+    Per-user rows of months older than the retention window are replaced by
+    one row per group and month holding the total calls and the number of
+    users. Each batch is one transaction per shard.
+
+    Args:
+        months_to_keep (int): Number of recent months to keep per-user rows for.
+        batch_size (int): The maximum number of (group, month) pairs to fold.
+
+    Returns:
+        int: The number of usage rows removed.
+    """
+    now = datetime.now(timezone.utc)
+    year, month = divmod(now.year * 12 + now.month - 1 - months_to_keep, 12)
+    cutoff = f"{year:04d}-{month + 1:02d}"
+
+    removed = 0
+    for path in _group_data_paths():
+        conn = _connect(path)
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(
+            "SELECT DISTINCT group_id, month FROM usage WHERE month <= ? LIMIT ?",
+            (cutoff, batch_size),
+        )
+        pairs = c.fetchall()
+        for group_id, old_month in pairs:
+            c.execute(
+                """INSERT INTO usage_rollup (group_id, month, calls, users)
+                SELECT group_id, month, SUM(user_calls), COUNT(*) FROM usage
+                WHERE group_id = ? AND month = ? GROUP BY group_id, month
+                ON CONFLICT(group_id, month) DO UPDATE SET
+                    calls = calls + excluded.calls, users = users + excluded.users""",
+                (group_id, old_month),
+            )
+            c.execute(
+                "DELETE FROM usage WHERE group_id = ? AND month = ?",
+                (group_id, old_month),
+            )
+            removed += c.rowcount
+        conn.commit()
+        conn.close()
+    return removed
+
+
+def db_archive_memory(days_to_keep, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Move one batch of old, finished memory rows to the archive database.
+
+    Pending rows are left alone, and so is each user's newest row, which
+    `db_add_memory` numbers the next video after. Each batch is one
+    transaction per shard.
+
+    Args:
+        days_to_keep (int): Number of days of memory rows to keep.
+        batch_size (int): The maximum number of rows to move per shard.
+
+    Returns:
+        int: The number of rows archived.
+    """
+    cutoff = str(datetime.now(timezone.utc) - timedelta(days=days_to_keep))
+
+    archived = 0
+    for path in _group_data_paths():
+        conn = _connect(path)
+        c = conn.cursor()
+        c.execute("ATTACH DATABASE ? AS archive", (get_archive_path(),))
+        c.execute(
+            "CREATE TABLE IF NOT EXISTS archive.memory AS SELECT * FROM main.memory WHERE 0"
+        )
+        _ensure_columns(c, "memory", MEMORY_EXTRA_COLUMNS, schema="archive")
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(
+            """SELECT rowid FROM main.memory m WHERE timestamp < ? AND status != 'pending'
+            AND user_video_id < (
+                SELECT MAX(user_video_id) FROM main.memory o
+                WHERE o.user_id = m.user_id AND o.group_id = m.group_id
+            )
+            ORDER BY timestamp LIMIT ?""",
+            (cutoff, batch_size),
+        )
+        rowids = [row[0] for row in c.fetchall()]
+        if rowids:
+            placeholders = ", ".join("?" for _ in rowids)
+            c.execute(
+                f"INSERT INTO archive.memory SELECT * FROM main.memory WHERE rowid IN ({placeholders})",
+                rowids,
+            )
+            c.execute(
+                f"DELETE FROM main.memory WHERE rowid IN ({placeholders})", rowids
+            )
+            archived += c.rowcount
+        conn.commit()
+        c.execute("DETACH DATABASE archive")
+        conn.close()
+    return archived
+
+
+def db_compact(pages):
+    """
+    Reclaim free pages incrementally and refresh the query planner statistics.
+
+    Databases created before incremental auto-vacuum was enabled are only
+    optimized, since converting them needs a full VACUUM that would stall.
+
+    Args:
+        pages (int): The maximum number of free pages to release per database.
+
+    Returns:
+        int: The number of free pages left over all databases.
+    """
+    remaining = 0
+    paths = [get_db_path()]
+    if get_shard_count():
+        paths += _group_data_paths()
+    for path in paths:
+        conn = _connect(path)
+        c = conn.cursor()
+        if c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:  # INCREMENTAL
+            c.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            remaining += c.execute("PRAGMA freelist_count").fetchone()[0]
+        c.execute("PRAGMA optimize")
+        conn.close()
+    return remaining
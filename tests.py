@@ -1,9 +1,16 @@
+import asyncio
+from collections import Counter
+import io
 import os
+import marshal
 import sqlite3
+import time
+import requests
 import pytest
-from unittest.mock import AsyncMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from services import (
     init_db,
     db_get_month,
@@ -17,16 +24,90 @@ from services import (
     db_add_memory,
     db_get_memory,
     db_update_video_url,
+    db_complete_video,
+    db_get_memory_by_task,
     db_update_status,
     get_db_path,
     db_add_group,
     db_get_all_groups,
+    query_stats,
+    db_enqueue_job,
+    db_claim_jobs,
+    db_release_job,
+    db_get_finished_jobs,
+    db_mark_job_delivered,
+    db_get_memory_by_id,
+    db_get_group_summaries,
+    db_rebalance_into_shards,
+    get_shard_index,
+    get_shard_path,
+    get_archive_path,
+    db_rollup_usage,
+    db_archive_memory,
+    db_compact,
+    db_iter_groups,
+    db_import_config,
+    db_get_group_stats,
+    db_get_stats_overview,
+    db_reserve_quota,
+    db_release_reservation,
+    db_set_profile,
+    db_reset_profile,
+    db_get_checkpoints,
+    db_cancel_jobs,
+    db_get_quota_window,
+    db_set_quota_window,
+    use_namespace,
 )
-from bot import imagine, memory
+from bot import (
+    imagine,
+    poll_video,
+    memory,
+    memory_navigation,
+    groups_page,
+    split_prompts,
+    upscale,
+    get_profile,
+    throttle_commands,
+    handle_file_upload,
+    graceful_shutdown,
+    resume_generation,
+    tracked_tasks,
+    cancel,
+    cancel_button,
+    cancel_markup,
+    set_quota_window,
+    bot_context,
+    is_admin,
+    submission_key,
+    deliver_finished_jobs,
+)
+from maintenance import run_sweep
+from diagnostics import LoopLagMonitor, Profiler
+from vidu_simulator import ViduSimulator
+from vidu import reference_to_video, get_generation_status, cancel_generation
+from utils import parse_config_import, parse_bot_configs, validate_and_extract_urls
+from throttle import Throttle
+from worker import Worker, UNCONFIRMED_SUBMISSION
+from backpressure import CompletionRate, estimate_wait, format_wait
+from references import ReferenceChecker, ReferenceCache
+import httpx
+from telegram.error import Forbidden, NetworkError
+from telegram.ext import ApplicationHandlerStop
 
 logger = logging.getLogger(__name__)
 
 
+@pytest.fixture(autouse=True)
+def skip_reference_checks(request):
+    # Reference URL checks make real HTTP requests; tests of them opt out
+    if request.node.name.startswith("test_reference_checker"):
+        yield
+        return
+    with patch("bot.reference_checker.check_all", AsyncMock(return_value={})):
+        yield
+
+
 @pytest.fixture(scope="module", autouse=True)
 def setup_test_db():
     # Override environment variable for the database path
@@ -150,7 +231,9 @@ async def test_imagine_successful_generation():
     mock_context = AsyncMock()
     mock_update.effective_chat.id = 12345
     mock_update.effective_user.id = 67890
+    mock_update.message.message_id = 1001
     mock_context.args = ["test", "prompt"]
+    mock_update.message.text = "/imagine test prompt"
 
     # Mock database and API calls
     with patch("bot.API_KEY", "abc"), patch(
@@ -170,10 +253,8 @@ async def test_imagine_successful_generation():
     ) as mock_get_generation_status, patch(
         "bot.db_add_memory"
     ) as mock_add_memory, patch(
-        "bot.db_update_usage"
-    ) as mock_update_usage, patch(
-        "bot.db_update_video_url"
-    ) as mock_update_video_url:
+        "bot.db_complete_video"
+    ) as mock_complete_video:
 
         # Call the imagine function
         await imagine(mock_update, mock_context)
@@ -198,10 +279,13 @@ async def test_imagine_successful_generation():
             video_url="",
             task_id="task_001",
             status="pending",
+            prompt="test prompt",
+            seed=None,
+            tier="standard",
+            idempotency_key="12345:1001:0",
         )
         mock_get_generation_status.assert_called()
-        mock_update_usage.assert_called_once_with(12345, 67890)
-        mock_update_video_url.assert_called_once_with(
+        mock_complete_video.assert_called_once_with(
             67890, 12345, "task_001", "http://example.com/video.mp4"
         )
         mock_update.message.reply_video.assert_called_once_with(
@@ -216,7 +300,9 @@ async def test_imagine_group_limit_reached():
     mock_context = AsyncMock()
     mock_update.effective_chat.id = 12345
     mock_update.effective_user.id = 67890
+    mock_update.message.message_id = 1002
     mock_context.args = ["test", "prompt"]
+    mock_update.message.text = "/imagine test prompt"
 
     # Mock database and API calls
     with patch("bot.API_KEY", "abc"), patch(
@@ -252,7 +338,9 @@ async def test_imagine_user_limit_reached():
     mock_context = AsyncMock()
     mock_update.effective_chat.id = 12345
     mock_update.effective_user.id = 67890
+    mock_update.message.message_id = 1003
     mock_context.args = ["test", "prompt"]
+    mock_update.message.text = "/imagine test prompt"
 
     # Mock database and API calls
     with patch("bot.API_KEY", "abc"), patch(
@@ -288,7 +376,9 @@ async def test_imagine_missing_task_id():
     mock_context = AsyncMock()
     mock_update.effective_chat.id = 12345
     mock_update.effective_user.id = 67890
+    mock_update.message.message_id = 1004
     mock_context.args = ["test", "prompt"]
+    mock_update.message.text = "/imagine test prompt"
 
     # Mock database and API calls
     with patch("bot.API_KEY", "abc"), patch(
@@ -308,10 +398,8 @@ async def test_imagine_missing_task_id():
     ) as mock_get_generation_status, patch(
         "bot.db_add_memory"
     ) as mock_add_memory, patch(
-        "bot.db_update_usage"
-    ) as mock_update_usage, patch(
-        "bot.db_update_video_url"
-    ) as mock_update_video_url:
+        "bot.db_complete_video"
+    ) as mock_complete_video:
 
         # Call the imagine function
         await imagine(mock_update, mock_context)
@@ -345,6 +433,14 @@ async def test_memory_with_id_pending_status():
     mock_update.effective_chat.id = 12345
     mock_update.effective_user.id = 67890
     mock_context.args = ["1"]  # Simulate passing an ID
+    tracked = []
+
+    def status(mock, api_key, task_id):
+        tracked.append(task_id in tracked_tasks)
+        return {
+            "state": "success",
+            "creations": [{"url": "http://example.com/generated_video.mp4"}],
+        }
 
     # Mock database and API calls
     with patch("bot.API_KEY", "abc"), patch(
@@ -358,18 +454,10 @@ async def test_memory_with_id_pending_status():
             "pending",
         ),
     ) as mock_get_memory_by_id, patch(
-        "bot.get_generation_status",
-        side_effect=[
-            {
-                "state": "success",
-                "creations": [{"url": "http://example.com/generated_video.mp4"}],
-            }
-        ],
+        "bot.get_generation_status", side_effect=status
     ) as mock_get_generation_status, patch(
-        "bot.db_update_usage"
-    ) as mock_update_usage, patch(
-        "bot.db_update_video_url"
-    ) as mock_update_video_url:
+        "bot.db_complete_video"
+    ) as mock_complete_video:
 
         # Call the memory function
         await memory(mock_update, mock_context)
@@ -379,13 +467,11 @@ async def test_memory_with_id_pending_status():
         mock_get_generation_status.assert_called_once_with(
             mock=False, api_key="abc", task_id="task_001"
         )
-        mock_update_usage.assert_called_once_with(12345, 67890)
-        mock_update_video_url.assert_called_once_with(
-            67890,
-            12345,
-            "task_001",
-            "http://example.com/generated_video.mp4",
-            status="success",
+        # The task is tracked, so /cancel and shutdown see it while polled
+        assert tracked == [True]
+        assert "task_001" not in tracked_tasks
+        mock_complete_video.assert_called_once_with(
+            67890, 12345, "task_001", "http://example.com/generated_video.mp4"
         )
         mock_update.message.reply_video.assert_called_once_with(
             video="http://example.com/generated_video.mp4"
@@ -411,12 +497,13 @@ async def test_memory_with_no_id():
         await memory(mock_update, mock_context)
 
         # Assertions
-        mock_get_memory.assert_called_once_with(67890, 12345)
+        mock_get_memory.assert_called_once_with(67890, 12345, limit=6)
         mock_update.message.reply_text.assert_called_once_with(
             "Here are your last 2 generated videos:\n\n"
             "ID: 1 - Generated at 2025-05-04\n"
             "ID: 2 - Generated at 2025-05-05\n\n"
-            "Use /memory <id> to view a specific video."
+            "Use /memory <id> to view a specific video.",
+            reply_markup=None,
         )
 
 
@@ -518,3 +605,1355 @@ def test_db_add_duplicate_group():
     assert len(result) == 1  # Ensure only one entry exists
     assert result[0][0] == group_id
     assert result[0][1] == updated_group_name  # Ensure the name was updated
+
+
+def _block_event_loop(seconds):
+    time.sleep(seconds)
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_monitor_records_blocking_call_site():
+    monitor = LoopLagMonitor(interval=0.02, threshold=0.1, report_interval=60)
+    monitor.start()
+    await asyncio.sleep(0.05)
+
+    _block_event_loop(0.4)
+    await asyncio.sleep(0.05)
+    await monitor.stop()
+
+    assert monitor.stalls >= 1
+    assert monitor.max_lag >= 0.3
+    site, count = monitor.top_sites(1)[0]
+    assert site.startswith("tests.py:")
+    assert "_block_event_loop" in site
+    assert "_block_event_loop" in monitor.last_snapshot[1]
+
+
+def _busy_function():
+    return sum(i * i for i in range(20000))
+
+
+@pytest.mark.asyncio
+async def test_profiler_reports_hot_functions():
+    profiler = Profiler(top_n=50)
+
+    async def workload():
+        for _ in range(5):
+            _busy_function()
+            await asyncio.sleep(0.01)
+
+    job = asyncio.create_task(workload())
+    report, raw = await profiler.run(0.2)
+    await job
+
+    assert not profiler.active
+    assert "_busy_function" in report
+    stats = marshal.loads(raw)
+    assert any(name == "_busy_function" for _, _, name in stats)
+
+
+def test_query_stats_record_statement_timings():
+    query_stats.reset()
+    db_add_memory(31, 32, "", "task_stats", "pending")
+    db_get_memory(31, 32)
+    db_get_memory(31, 32)
+
+    summary = {row["sql"]: row for row in query_stats.summary()}
+    select = next(row for sql, row in summary.items() if "ORDER BY" in sql)
+    assert select["count"] == 2
+    assert select["rows"] == 2
+    assert 0 <= select["p50_ms"] <= select["p95_ms"] <= select["max_ms"]
+    insert = next(row for sql, row in summary.items() if sql.startswith("INSERT"))
+    assert insert["rows"] == 1
+
+
+def test_slow_queries_are_logged_with_query_plan(caplog):
+    with patch("services.SLOW_QUERY_MS", 0), caplog.at_level(
+        logging.WARNING, logger="services.slow_query"
+    ):
+        db_get_memory(31, 32)
+
+    messages = [r.getMessage() for r in caplog.records if "ORDER BY" in r.getMessage()]
+    assert messages
+    assert "plan:" in messages[0] and "memory" in messages[0]
+
+
+@pytest.fixture
+def vidu_simulator(monkeypatch):
+    simulator = ViduSimulator(
+        queue_seconds="const:0.05", render_seconds="const:0.1", failure_rate=0
+    )
+    monkeypatch.setenv("VIDU_API_BASE_URL", simulator.start())
+    yield simulator
+    simulator.stop()
+
+
+def test_vidu_simulator_moves_task_to_success(vidu_simulator):
+    response = reference_to_video(
+        mock=False,
+        api_key="abc",
+        model="vidu2.0",
+        images=["http://example.com/image.jpg"],
+        prompt="test prompt",
+    )
+    assert response["state"] == "created"
+
+    task_id = response["task_id"]
+    states = [get_generation_status(False, "abc", task_id)["state"]]
+    time.sleep(0.08)
+    states.append(get_generation_status(False, "abc", task_id)["state"])
+    time.sleep(0.1)
+    status = get_generation_status(False, "abc", task_id)
+
+    assert states == ["created", "processing"]
+    assert status["state"] == "success"
+    assert status["creations"][0]["url"].endswith("video.mp4")
+
+
+def test_vidu_simulator_injects_rate_limits(vidu_simulator):
+    vidu_simulator.rate_limit_rate = 1.0
+    with pytest.raises(requests.exceptions.HTTPError) as error:
+        get_generation_status(False, "abc", "unknown")
+    assert error.value.response.status_code == 429
+
+
+def test_vidu_simulator_cancels_unfinished_tasks(vidu_simulator):
+    task_id = reference_to_video(
+        mock=False,
+        api_key="abc",
+        model="vidu2.0",
+        images=["http://example.com/image.jpg"],
+        prompt="test prompt",
+    )["task_id"]
+    cancel_generation(False, "abc", task_id)
+    status = get_generation_status(False, "abc", task_id)
+    assert (status["state"], status["err_code"]) == ("failed", "TaskCancelled")
+
+    with pytest.raises(requests.exceptions.HTTPError) as error:
+        cancel_generation(False, "abc", task_id)
+    assert error.value.response.status_code == 400
+
+
+def _enqueue_test_job(group_id=41, user_id=42):
+    return db_enqueue_job(
+        group_id=group_id,
+        user_id=user_id,
+        chat_id=group_id,
+        message_id=7,
+        prompt="test prompt, 2d animation",
+        images=["http://example.com/image.jpg"],
+        params={
+            "model": "vidu2.0",
+            "duration": 4,
+            "aspect_ratio": "16:9",
+            "resolution": "360p",
+        },
+    )
+
+
+def test_job_leases_are_exclusive_and_expire():
+    job_id = _enqueue_test_job()
+
+    claimed = db_claim_jobs("worker-a", 10, lease_seconds=60)
+    assert [job["job_id"] for job in claimed] == [job_id]
+    assert claimed[0]["images"] == ["http://example.com/image.jpg"]
+    assert db_claim_jobs("worker-b", 10, lease_seconds=60) == []
+
+    # A dead worker's lease is reclaimed once it expires
+    conn = sqlite3.connect(get_db_path())
+    conn.execute("UPDATE jobs SET lease_expires = 0 WHERE job_id = ?", (job_id,))
+    conn.commit()
+    conn.close()
+    reclaimed = db_claim_jobs("worker-b", 10, lease_seconds=60)
+    assert [job["job_id"] for job in reclaimed] == [job_id]
+
+    # The old owner can no longer update the job
+    assert not db_release_job(job_id, "worker-a", state="failed")
+    assert db_release_job(job_id, "worker-b", state="failed", error="boom")
+    assert [row[0] for row in db_get_finished_jobs()] == [job_id]
+    db_mark_job_delivered(job_id)
+    assert db_get_finished_jobs() == []
+
+
+def test_worker_submits_and_tracks_job():
+    job_id = _enqueue_test_job(group_id=43, user_id=44)
+    worker = Worker("abc")
+    with patch(
+        "worker.reference_to_video",
+        return_value={"task_id": "task_worker", "state": "created"},
+    ) as mock_reference_to_video, patch(
+        "worker.get_generation_status",
+        return_value={
+            "state": "success",
+            "creations": [{"url": "http://example.com/worker.mp4"}],
+        },
+    ):
+        assert worker.run_once() == 1
+        mock_reference_to_video.assert_called_once()
+        assert db_get_memory_by_id(44, 43, 1)[3] == "pending"
+
+        conn = sqlite3.connect(get_db_path())
+        conn.execute("UPDATE jobs SET next_check = 0 WHERE job_id = ?", (job_id,))
+        conn.commit()
+        conn.close()
+        assert worker.run_once() == 1
+
+    assert db_get_finished_jobs() == [
+        (job_id, 43, 7, "success", "http://example.com/worker.mp4", None)
+    ]
+    assert db_get_memory_by_id(44, 43, 1)[:1] == ("http://example.com/worker.mp4",)
+    assert db_get_usage(43, 44) == (1, 1)
+    db_mark_job_delivered(job_id)
+
+
+def test_concurrent_memory_rows_get_distinct_ids(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE", str(tmp_path / "ids.db"))
+    init_db()
+    with ThreadPoolExecutor(8) as executor:
+        list(
+            executor.map(
+                lambda index: db_add_memory(1, 2, "", f"task_{index}", "pending"),
+                range(100),
+            )
+        )
+    conn = sqlite3.connect(get_db_path())
+    ids = [row[0] for row in conn.execute("SELECT user_video_id FROM memory")]
+    assert sorted(ids) == list(range(1, 101))
+
+    # Databases of older versions have their duplicate IDs renumbered
+    conn.execute("DROP INDEX idx_memory_user_video")
+    conn.execute(
+        "CREATE INDEX idx_memory_user_video ON memory (user_id, group_id, user_video_id)"
+    )
+    # The later of two rows with the same ID gets a new one
+    conn.execute(
+        """UPDATE memory SET user_video_id = (
+            SELECT user_video_id FROM memory ORDER BY rowid LIMIT 1
+        ) WHERE rowid = (SELECT MAX(rowid) FROM memory)"""
+    )
+    conn.commit()
+    conn.close()
+    init_db()
+    conn = sqlite3.connect(get_db_path())
+    ids = [row[0] for row in conn.execute("SELECT user_video_id FROM memory")]
+    assert len(set(ids)) == 100
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("UPDATE memory SET user_video_id = 1 WHERE user_video_id = 2")
+    conn.close()
+
+
+def test_namespaces_share_the_queue_but_not_group_data(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE", str(tmp_path / "bots.db"))
+    init_db()
+    with use_namespace("brand"):
+        init_db()
+        assert get_db_path() == str(tmp_path / "bots.brand.db")
+        db_set_group_limit(43, 5)
+        job_id = _enqueue_test_job(group_id=43, user_id=44)
+    assert db_get_limits(43) == (None, None)
+
+    # Workers claim jobs of every bot and write to the job's databases
+    with patch(
+        "worker.reference_to_video",
+        return_value={"task_id": "task_brand", "state": "created"},
+    ):
+        assert Worker("abc").run_once() == 1
+    assert db_get_memory_by_id(44, 43, 1) is None
+    with use_namespace("brand"):
+        assert db_get_memory_by_id(44, 43, 1)[2] == "task_brand"
+        assert db_get_limits(43) == (5, None)
+
+    conn = sqlite3.connect(get_db_path())
+    conn.execute("UPDATE jobs SET state = 'success' WHERE job_id = ?", (job_id,))
+    conn.commit()
+    conn.close()
+    # Results are only delivered by the bot that queued them
+    assert db_get_finished_jobs() == []
+    with use_namespace("brand"):
+        assert [row[0] for row in db_get_finished_jobs()] == [job_id]
+
+
+def test_bot_configs_select_admins_and_namespace():
+    configs = parse_bot_configs(
+        io.StringIO(
+            '[{"token": "a", "admin_ids": [7]}, '
+            '{"token": "b", "admin_ids": ["8"], "namespace": "brand"}]'
+        )
+    )
+    assert configs == [
+        {"token": "a", "admin_ids": [7], "namespace": ""},
+        {"token": "b", "admin_ids": [8], "namespace": "brand"},
+    ]
+    for text in (
+        "[]",
+        '[{"admin_ids": [7]}]',
+        '[{"token": "a", "namespace": "../x"}]',
+        '[{"token": "a"}, {"token": "b"}]',
+    ):
+        with pytest.raises(ValueError):
+            parse_bot_configs(io.StringIO(text))
+
+    context = bot_context(configs[1])
+    assert context.run(is_admin, 8) and not context.run(is_admin, 7)
+    assert is_admin(1) and not is_admin(8)
+
+    update = MagicMock()
+    update.effective_chat.id = -5
+    update.message.message_id = 9
+    assert submission_key(update) == "-5:9:0"
+    assert context.run(submission_key, update, 1) == "brand:-5:9:1"
+
+
+def test_cancelled_jobs_leave_the_queue():
+    job_id = _enqueue_test_job(group_id=45, user_id=46)
+    claimed = db_claim_jobs("worker-a", 10, lease_seconds=60)
+    assert [job["job_id"] for job in claimed] == [job_id]
+
+    # Other users' commands are untouched
+    assert db_cancel_jobs(99, 45, message_id=7) == []
+    [cancelled] = db_cancel_jobs(46, 45, message_id=7)
+    assert cancelled["job_id"] == job_id
+    # The worker that was busy with it can't bring it back
+    assert not db_release_job(job_id, "worker-a", state="processing", task_id="t")
+    conn = sqlite3.connect(get_db_path())
+    conn.execute("UPDATE jobs SET next_check = 0 WHERE job_id = ?", (job_id,))
+    conn.commit()
+    conn.close()
+    assert db_claim_jobs("worker-b", 10, lease_seconds=60) == []
+    assert job_id not in [row[0] for row in db_get_finished_jobs()]
+
+
+@pytest.mark.asyncio
+async def test_imagine_enqueues_job_in_queue_mode():
+    mock_update = AsyncMock()
+    mock_context = AsyncMock()
+    mock_update.effective_chat.id = 12345
+    mock_update.effective_user.id = 67890
+    mock_update.message.message_id = 99
+    mock_context.args = ["test", "prompt"]
+    mock_update.message.text = "/imagine test prompt"
+
+    with patch("bot.USE_JOB_QUEUE", True), patch(
+        "bot.db_get_limits", return_value=(10, 5)
+    ), patch("bot.db_get_usage", return_value=(2, 1)), patch(
+        "bot.db_get_reference", return_value="http://example.com/image.jpg"
+    ), patch(
+        "bot.db_enqueue_job", return_value=1
+    ) as mock_enqueue_job, patch(
+        "bot.db_count_outstanding_jobs", return_value=(0, 0)
+    ), patch(
+        "bot.reference_to_video"
+    ) as mock_reference_to_video:
+        await imagine(mock_update, mock_context)
+
+    mock_reference_to_video.assert_not_called()
+    kwargs = mock_enqueue_job.call_args.kwargs
+    assert kwargs["chat_id"] == 12345 and kwargs["message_id"] == 99
+    assert kwargs["prompt"] == "test prompt, 2d animation"
+    mock_update.message.reply_text.assert_called_once_with(
+        "Generating video...", reply_markup=cancel_markup(99)
+    )
+
+
+def test_sharded_mode_routes_groups_and_rebalances(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE", str(tmp_path / "single.db"))
+    init_db()
+    for group_id in range(1, 9):
+        db_set_group_limit(group_id, 100 + group_id)
+        db_update_usage(group_id, 1)
+        db_add_memory(1, group_id, "", f"task_{group_id}", "pending")
+    conn = sqlite3.connect(get_db_path())
+    conn.execute("INSERT INTO usage_rollup VALUES (3, '2020-01', 7, 2)")
+    conn.commit()
+    conn.close()
+
+    moved = db_rebalance_into_shards(3)
+    assert moved == {
+        "usage": 8,
+        "limits": 8,
+        "memory": 8,
+        "group_stats": 8,
+        "usage_rollup": 1,
+        "usage_daily": 16,
+        "usage_windows": 16,
+    }
+
+    monkeypatch.setenv("DB_SHARDS", "3")
+    init_db()
+    for group_id in range(1, 9):
+        assert db_get_limits(group_id) == (100 + group_id, None)
+        assert db_get_usage(group_id, 1) == (1, 1)
+        conn = sqlite3.connect(get_shard_path(get_shard_index(group_id)))
+        count = conn.execute(
+            "SELECT COUNT(*) FROM memory WHERE group_id = ?", (group_id,)
+        ).fetchone()[0]
+        conn.close()
+        assert count == 1
+    conn = sqlite3.connect(get_shard_path(get_shard_index(3)))
+    assert conn.execute("SELECT calls FROM usage_rollup").fetchall() == [(7,)]
+    conn.close()
+
+    db_update_usage(5, 2)
+    summaries = db_get_group_summaries([1, 5, 99])
+    assert summaries[1] == (101, None, 1)
+    assert summaries[5] == (105, None, 2)
+    assert 99 not in summaries
+
+
+def test_retention_rolls_up_usage_and_archives_memory(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE", str(tmp_path / "retention.db"))
+    init_db()
+    conn = sqlite3.connect(get_db_path())
+    conn.executemany(
+        "INSERT INTO usage (group_id, user_id, month, group_calls, user_calls) VALUES (?, ?, ?, ?, ?)",
+        [(1, 1, "2020-01", 3, 3), (1, 2, "2020-01", 2, 2)],
+    )
+    conn.executemany(
+        "INSERT INTO memory (user_id, group_id, video_url, timestamp, task_id, status, user_video_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (1, 1, "old.mp4", "2020-01-01 00:00:00+00:00", "t1", "success", 1),
+            (1, 1, "", "2020-01-02 00:00:00+00:00", "t2", "pending", 2),
+            (2, 1, "old.mp4", "2020-01-01 00:00:00+00:00", "t4", "success", 1),
+        ],
+    )
+    conn.commit()
+    conn.close()
+    db_update_usage(1, 1)
+    db_add_memory(1, 1, "new.mp4", "t3", "success")
+
+    assert db_rollup_usage(months_to_keep=12, batch_size=1) == 2
+    assert db_rollup_usage(months_to_keep=12, batch_size=1) == 0
+    assert db_archive_memory(days_to_keep=30) == 1
+    assert db_archive_memory(days_to_keep=30) == 0
+    assert db_compact(pages=100) >= 0
+
+    conn = sqlite3.connect(get_db_path())
+    assert conn.execute("SELECT * FROM usage_rollup").fetchall() == [
+        (1, "2020-01", 5, 2)
+    ]
+    # A user's newest row stays, so their next video doesn't reuse its ID
+    assert [row[0] for row in conn.execute("SELECT task_id FROM memory")] == [
+        "t2",
+        "t4",
+        "t3",
+    ]
+    conn.close()
+    db_add_memory(2, 1, "new.mp4", "t5", "success")
+    assert db_get_memory_by_id(2, 1, 2)[2] == "t5"
+    assert db_get_usage(1, 1) == (1, 1)
+
+    archive = sqlite3.connect(get_archive_path())
+    assert archive.execute("SELECT task_id FROM memory").fetchall() == [("t1",)]
+    archive.close()
+
+
+@pytest.mark.asyncio
+async def test_sweep_settles_stale_pending_videos(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE", str(tmp_path / "sweep.db"))
+    monkeypatch.setattr("maintenance.RETENTION_PAUSE_SECONDS", 0)
+    monkeypatch.setattr("maintenance.SWEEP_BATCH_SIZE", 2)
+    init_db()
+    old = "2020-01-01 00:00:00+00:00"
+    conn = sqlite3.connect(get_db_path())
+    conn.executemany(
+        "INSERT INTO memory (user_id, group_id, video_url, timestamp, task_id, status, user_video_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (1, 1, "", old, "done", "pending", 1),
+            (1, 1, "", old, "broken", "pending", 2),
+            (1, 1, "", old, "lost", "pending", 3),
+            (1, 1, "", "2020-01-02 00:00:00+00:00", "slow", "pending", 4),
+        ],
+    )
+    conn.commit()
+    conn.close()
+    db_add_memory(1, 1, "", "fresh", "pending")
+
+    responses = {
+        "done": {"state": "success", "creations": [{"url": "done.mp4"}]},
+        "broken": {"state": "failed"},
+        "slow": {"state": "processing"},
+    }
+    checked = []
+
+    def status(mock, api_key, task_id):
+        checked.append(task_id)
+        if task_id == "lost":
+            response = MagicMock(status_code=404)
+            raise requests.exceptions.HTTPError(response=response)
+        return responses[task_id]
+
+    with patch("maintenance.PENDING_EXPIRE_SECONDS", 10**10), patch(
+        "maintenance.get_generation_status", side_effect=status
+    ):
+        assert await run_sweep("key") == 3
+
+    assert sorted(checked) == ["broken", "done", "lost", "slow"]
+    conn = sqlite3.connect(get_db_path())
+    assert dict(conn.execute("SELECT task_id, status FROM memory")) == {
+        "done": "success",
+        "broken": "failed",
+        "lost": "expired",
+        "slow": "pending",
+        "fresh": "pending",
+    }
+    conn.close()
+    assert db_get_usage(1, 1) == (1, 1)
+    assert db_get_memory_by_id(1, 1, 1)[0] == "done.mp4"
+
+    # Settled rows are not counted again, and old enough tasks expire
+    with patch("maintenance.get_generation_status", side_effect=status):
+        assert await run_sweep("key") == 1
+    assert db_get_usage(1, 1) == (1, 1)
+
+    # A tracker finishing the same task later does not count it again
+    with patch("bot.get_generation_status", return_value=responses["done"]):
+        assert await poll_video(1, 1, "done") == ("done.mp4", None)
+    assert not db_complete_video(1, 1, "done", "done.mp4")
+    assert db_get_usage(1, 1) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_poll_video_records_failed_tasks():
+    db_add_memory(61, 62, "", "poll_failed", "pending")
+    db_add_memory(61, 62, "", "poll_empty", "pending")
+    responses = {
+        "poll_failed": {"state": "failed"},
+        "poll_empty": {"state": "success", "creations": []},
+    }
+
+    with patch(
+        "bot.get_generation_status",
+        side_effect=lambda mock, api_key, task_id: responses[task_id],
+    ):
+        assert await poll_video(62, 61, "poll_failed") == (
+            None,
+            "Video generation failed.",
+        )
+        assert await poll_video(62, 61, "poll_empty") == (
+            None,
+            "No video URL found in the response.",
+        )
+
+    assert db_get_memory_by_task(61, 62, "poll_failed")[0] == "failed"
+    assert db_get_memory_by_task(61, 62, "poll_empty")[0] == "failed"
+    assert db_get_usage(62, 61) == (0, 0)
+
+
+def test_daily_usage_backfill_is_dated_at_month_start(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE", str(tmp_path / "backfill.db"))
+    init_db()
+    db_update_usage(71, 72)
+    db_update_usage(71, 72)
+    conn = sqlite3.connect(get_db_path())
+    conn.executescript("DROP TABLE usage_daily; DROP TABLE usage_windows;")
+    conn.close()
+
+    init_db()
+    conn = sqlite3.connect(get_db_path())
+    (month_start,) = conn.execute("SELECT date('now', 'start of month')").fetchone()
+    assert sorted(conn.execute("SELECT user_id, day, calls FROM usage_daily")) == [
+        (0, month_start, 2),
+        (72, month_start, 2),
+    ]
+    conn.close()
+
+
+def test_db_get_memory_keyset_pages():
+    for index in range(12):
+        db_add_memory(51, 52, f"video_{index}.mp4", f"task_page_{index}", "success")
+
+    first = db_get_memory(51, 52)
+    assert [row[0] for row in first] == [12, 11, 10, 9, 8]
+    older = db_get_memory(51, 52, before_id=first[-1][0])
+    assert [row[0] for row in older] == [7, 6, 5, 4, 3]
+    newer = db_get_memory(51, 52, after_id=older[0][0])
+    assert [row[0] for row in newer] == [12, 11, 10, 9, 8]
+    assert [row[0] for row in db_get_memory(51, 52, before_id=3)] == [2, 1]
+
+
+@pytest.mark.asyncio
+async def test_memory_navigation_shows_older_page():
+    mock_update = AsyncMock()
+    mock_context = AsyncMock()
+    mock_update.effective_chat.id = 52
+    mock_update.callback_query.from_user.id = 51
+    mock_update.callback_query.data = "memory:51:older:8"
+
+    await memory_navigation(mock_update, mock_context)
+
+    text = mock_update.callback_query.edit_message_text.call_args.args[0]
+    markup = mock_update.callback_query.edit_message_text.call_args.kwargs[
+        "reply_markup"
+    ]
+    assert "ID: 7 -" in text and "ID: 3 -" in text and "ID: 8 -" not in text
+    assert [button.callback_data for button in markup.inline_keyboard[0]] == [
+        "memory:51:newer:7",
+        "memory:51:older:3",
+    ]
+
+
+def test_db_iter_groups_filters_by_prefix_and_pages():
+    for index in range(7):
+        db_add_group(-9000 - index, f"Paged group {index}")
+    db_add_group(-9100, "Other group")
+    db_set_group_limit(-9003, 40)
+    db_update_usage(-9003, 1)
+
+    rows = list(db_iter_groups("paged", batch_size=2))
+    assert [row[0] for row in rows] == [-9000 - index for index in range(7)]
+    assert rows[3] == (-9003, "Paged group 3", 40, None, 1)
+    after = list(db_iter_groups("paged", after_id=-9002))
+    assert [row[0] for row in after] == [-9003, -9004, -9005, -9006]
+    before = list(db_iter_groups("paged", before_id=-9002))
+    assert [row[0] for row in before] == [-9001, -9000]
+
+
+def test_groups_page_fits_message_limit():
+    for index in range(7):
+        db_add_group(-9200 - index, f"Sized group {index}")
+
+    with patch("bot.GROUPS_PAGE_MAX_CHARS", 300):
+        message, markup = groups_page("Sized")
+        assert len(message) <= 300
+        assert "Sized group 0" in message and "Sized group 6" not in message
+        [next_button] = markup.inline_keyboard[0]
+        last_id = int(next_button.callback_data.split(":")[2])
+
+        message, markup = groups_page("Sized", after_id=last_id)
+        assert f"ID: {last_id}\n" not in message
+        assert markup.inline_keyboard[0][0].callback_data.startswith("groups:p:")
+
+
+def test_parse_config_import_reports_errors_per_line():
+    csv_file = io.StringIO(
+        "group_id,group_limit,user_limit,reference\n"
+        "-1,10,2,https://example.com/a.png https://example.com/b.png\n"
+        "-2,abc,,\n"
+        "-1,5,,\n"
+        "-3,,,not a url\n"
+    )
+    entries, errors = parse_config_import(csv_file, "csv")
+    assert entries == [
+        {
+            "group_id": -1,
+            "group_limit": 10,
+            "user_limit": 2,
+            "reference": "https://example.com/a.png,https://example.com/b.png",
+        }
+    ]
+    assert errors == [
+        "line 3: group_limit must be a number",
+        "line 4: duplicate group_id -1",
+        "line 5: invalid reference URL: not",
+    ]
+
+    json_file = io.StringIO(
+        '[{"group_id": -4, "reference": ["https://example.com/c.png"]}]'
+    )
+    entries, errors = parse_config_import(json_file, "json")
+    assert errors == [] and entries[0]["reference"] == "https://example.com/c.png"
+
+
+def test_db_import_config_dry_run_and_apply():
+    db_set_group_limit(-9300, 10)
+    entries = [
+        {"group_id": -9300, "group_limit": 20, "user_limit": None, "reference": None},
+        {
+            "group_id": -9301,
+            "group_limit": None,
+            "user_limit": 3,
+            "reference": "https://example.com/d.png",
+        },
+    ]
+
+    changes = db_import_config(entries, dry_run=True)
+    assert changes == [
+        (-9300, "group_limit", 10, 20),
+        (-9301, "user_limit", None, 3),
+        (-9301, "reference", None, "https://example.com/d.png"),
+    ]
+    assert db_get_limits(-9300) == (10, None)
+
+    assert db_import_config(entries) == changes
+    assert db_get_limits(-9300) == (20, None)
+    assert db_get_limits(-9301) == (None, 3)
+    assert db_get_reference(-9301) == "https://example.com/d.png"
+    assert db_import_config(entries) == []
+
+
+def test_group_stats_are_maintained_by_write_paths():
+    group_id = -9400
+    for user_id, task_id in ((1, "stats_a"), (1, "stats_b"), (2, "stats_c")):
+        db_add_memory(user_id, group_id, "", task_id)
+        db_update_usage(group_id, user_id)
+    db_update_video_url(1, group_id, "stats_a", "a.mp4")
+    db_update_status(1, group_id, "stats_b", "failed")
+    # Repeated updates of a finished task are not counted twice
+    db_update_video_url(1, group_id, "stats_a", "a.mp4")
+    db_update_status(2, group_id, "stats_c", "pending")
+
+    monthly, users = db_get_group_stats(group_id)
+    [(month, calls, successes, failures, latency_ms)] = monthly
+    assert (month, calls, successes, failures) == (db_get_month(), 3, 1, 1)
+    assert latency_ms is not None and latency_ms >= 0
+    assert users == [(1, 2), (2, 1)]
+
+    totals, groups = db_get_stats_overview()
+    assert totals[0] >= 3
+    assert (group_id, None, 3, 1, 1) in groups
+
+
+def test_split_prompts():
+    assert split_prompts("/imagine a cat | a dog\n\na bird|") == [
+        "a cat",
+        "a dog",
+        "a bird",
+    ]
+    assert split_prompts("/imagine@CurveBot  one prompt ") == ["one prompt"]
+    assert split_prompts("/imagine") == []
+
+
+def test_quota_reservations_count_against_limits():
+    group_id = -9500
+    db_update_usage(group_id, 1)
+
+    first, exceeded = db_reserve_quota(group_id, 1, 3, 5, None)
+    assert first is not None and exceeded is None
+    # 1 used and 3 reserved leave room for 1 more in the group
+    assert db_reserve_quota(group_id, 2, 2, 5, None) == (None, "group")
+    assert db_reserve_quota(group_id, 1, 1, None, 4) == (None, "user")
+
+    db_release_reservation(group_id, first, slots=2)
+    second, _ = db_reserve_quota(group_id, 2, 2, 5, None)
+    assert second is not None
+    db_release_reservation(group_id, first)
+    db_release_reservation(group_id, second)
+    assert db_reserve_quota(group_id, 2, 4, 5, None)[1] is None
+
+
+def test_rolling_quota_windows_use_daily_counters():
+    group_id, user_id = -9550, 1
+    today = datetime.now(timezone.utc)
+
+    def day(days_ago):
+        return (today - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+
+    conn = sqlite3.connect(get_db_path())
+    for counter in (0, user_id):
+        conn.executemany(
+            "INSERT INTO usage_daily (group_id, user_id, day, calls) VALUES (?, ?, ?, ?)",
+            [(group_id, counter, day(3), 2), (group_id, counter, day(10), 5)],
+        )
+    conn.commit()
+    conn.close()
+
+    assert db_get_quota_window(group_id) == "month"
+    db_set_quota_window(group_id, "7d")
+    db_set_group_limit(group_id, 10)
+    assert db_get_quota_window(group_id) == "7d"
+    assert db_get_usage(group_id, user_id) == (2, 2)
+    db_update_usage(group_id, user_id)
+    db_update_usage(group_id, 2)
+    assert db_get_usage(group_id, user_id) == (4, 3)
+    assert db_reserve_quota(group_id, user_id, 7, 10, None) == (None, "group")
+
+    db_set_quota_window(group_id, "30d")
+    assert db_get_usage(group_id, user_id) == (9, 8)
+
+    # A running sum from 10 days ago drops the days that left the window
+    db_set_quota_window(group_id, "7d")
+    conn = sqlite3.connect(get_db_path())
+    conn.execute(
+        "UPDATE usage_windows SET since = ?, calls = 9 WHERE group_id = ? AND user_id = 0",
+        (day(10), group_id),
+    )
+    conn.commit()
+    conn.close()
+    assert db_get_usage(group_id, user_id)[0] == 4
+
+    with pytest.raises(ValueError):
+        db_set_quota_window(group_id, "1y")
+
+
+@pytest.mark.asyncio
+async def test_set_quota_window_command():
+    mock_update = AsyncMock()
+    mock_context = AsyncMock()
+    mock_update.effective_user.id = 1
+    mock_update.effective_chat.id = -9560
+    mock_context.args = ["24h"]
+
+    await set_quota_window(mock_update, mock_context)
+    mock_update.message.reply_text.assert_called_with(
+        "Limits for group -9560 now apply to the last 24 hours"
+    )
+    assert db_get_quota_window(-9560) == "24h"
+
+    mock_context.args = ["-9560", "weekly"]
+    await set_quota_window(mock_update, mock_context)
+    mock_update.message.reply_text.assert_called_with(
+        "Usage: /sqw [group_id] <month|24h|7d|30d>"
+    )
+    assert db_get_quota_window(-9560) == "24h"
+
+
+@pytest.mark.asyncio
+async def test_imagine_batch_sends_media_group():
+    mock_update = AsyncMock()
+    mock_context = AsyncMock()
+    mock_update.effective_chat.id = -9600
+    mock_update.effective_user.id = 1
+    mock_update.message.message_id = 1005
+    mock_update.message.text = "/imagine a cat | a dog"
+    tasks = iter(["task_batch_1", "task_batch_2"])
+
+    with patch("bot.db_get_limits", return_value=(None, None)), patch(
+        "bot.db_get_reference", return_value="http://example.com/image.jpg"
+    ), patch(
+        "bot.reference_to_video",
+        side_effect=lambda **kwargs: {"task_id": next(tasks), "state": "created"},
+    ) as mock_reference_to_video, patch(
+        "bot.get_generation_status",
+        side_effect=lambda **kwargs: {
+            "state": "success",
+            "creations": [{"url": f"http://example.com/{kwargs['task_id']}.mp4"}],
+        },
+    ):
+        await imagine(mock_update, mock_context)
+
+    assert mock_reference_to_video.call_count == 2
+    assert mock_update.message.reply_text.call_args.args == ("Generating 2 videos...",)
+    [media] = mock_update.message.reply_media_group.call_args.args
+    assert sorted(item.caption for item in media) == ["a cat", "a dog"]
+    assert db_get_usage(-9600, 1) == (2, 2)
+    # The reservation is released once the batch is done
+    assert db_reserve_quota(-9600, 1, 1, 2, None) == (None, "group")
+
+
+def test_group_profiles_override_defaults():
+    group_id = -9700
+    assert get_profile(group_id, "upscale")["resolution"] == "1080p"
+
+    db_set_profile(group_id, "draft", resolution="720p", duration=8)
+    db_set_profile(group_id, "draft", model="vidu1.5")
+    assert get_profile(group_id, "draft") == {
+        "model": "vidu1.5",
+        "duration": 8,
+        "aspect_ratio": "16:9",
+        "resolution": "720p",
+    }
+    assert get_profile(group_id, "standard")["resolution"] == "360p"
+
+    db_reset_profile(group_id, "draft")
+    assert get_profile(group_id, "draft")["model"] == "vidu2.0"
+
+
+@pytest.mark.asyncio
+async def test_upscale_rerenders_with_seed_and_upscale_profile():
+    group_id = -9800
+    db_add_memory(
+        3, group_id, "draft.mp4", "task_draft", "success", "a cat", 42, "draft"
+    )
+    mock_update = AsyncMock()
+    mock_context = AsyncMock()
+    mock_update.effective_chat.id = group_id
+    mock_update.effective_user.id = 3
+    mock_update.message.message_id = 1006
+    mock_context.args = ["1"]
+
+    with patch(
+        "bot.db_get_reference", return_value="http://example.com/image.jpg"
+    ), patch(
+        "bot.reference_to_video",
+        return_value={"task_id": "task_upscaled", "state": "created", "seed": 42},
+    ) as mock_reference_to_video, patch(
+        "bot.get_generation_status",
+        return_value={"state": "success", "creations": [{"url": "upscaled.mp4"}]},
+    ):
+        await upscale(mock_update, mock_context)
+
+    kwargs = mock_reference_to_video.call_args.kwargs
+    assert kwargs["prompt"] == "a cat, 2d animation"
+    assert kwargs["seed"] == 42 and kwargs["resolution"] == "1080p"
+    mock_update.message.reply_video.assert_called_once_with(video="upscaled.mp4")
+    assert db_get_memory(3, group_id)[0][:2] == (2, "upscaled.mp4")
+
+
+def test_throttle_refills_and_evicts_idle_buckets():
+    throttle = Throttle(rate=1, burst=2)
+    assert throttle.check("a", now=0) == (True, False)
+    assert throttle.check("a", now=0) == (True, False)
+    assert throttle.check("a", now=0.1) == (False, True)
+    assert throttle.check("a", now=0.2) == (False, False)
+    assert throttle.check("a", now=1.2) == (True, False)
+    assert throttle.check("b", now=1.5) == (True, False)
+    assert len(throttle) == 2
+
+    # Buckets idle long enough to be full again are dropped
+    throttle.check("c", now=3.4)
+    assert len(throttle) == 2
+    throttle.check("c", now=4)
+    assert len(throttle) == 1
+
+
+@pytest.mark.asyncio
+async def test_throttle_commands_stops_bursts_with_one_reply():
+    mock_update = AsyncMock()
+    mock_context = AsyncMock()
+    mock_update.callback_query = None
+    mock_update.message.text = "/imagine a cat"
+    mock_update.effective_user.id = 9900
+    mock_update.effective_chat.id = 9900
+
+    with patch("bot.user_throttle", Throttle(rate=0.001, burst=2)):
+        await throttle_commands(mock_update, mock_context)
+        await throttle_commands(mock_update, mock_context)
+        for _ in range(3):
+            with pytest.raises(ApplicationHandlerStop):
+                await throttle_commands(mock_update, mock_context)
+
+    mock_update.message.reply_text.assert_called_once()
+
+
+def test_validate_and_extract_urls_dedupes_and_reports_lines():
+    f = io.StringIO(
+        "https://example.com/a.png\n\nnot a url\nhttps://example.com/a.png\nexample.com/b.png\n"
+    )
+    urls, errors = validate_and_extract_urls(f)
+    assert urls == ["https://example.com/a.png", "example.com/b.png"]
+    assert errors == ["line 3: not a valid URL: not a url"]
+
+
+@pytest.mark.asyncio
+async def test_reference_upload_is_read_in_memory():
+    mock_update = AsyncMock()
+    mock_context = AsyncMock()
+    mock_update.effective_user.id = 1
+    mock_update.effective_chat.id = -9900
+    mock_update.message.caption = "/reference"
+    mock_update.message.document.mime_type = "text/plain"
+    mock_update.message.document.file_size = 60
+    file = AsyncMock()
+    file.download_as_bytearray.return_value = bytearray(
+        b"https://example.com/a.png\nhttps://example.com/b.png\n"
+    )
+    mock_context.bot.get_file.return_value = file
+
+    await handle_file_upload(mock_update, mock_context)
+
+    assert (
+        db_get_reference(-9900) == "https://example.com/a.png,https://example.com/b.png"
+    )
+    file.download_to_drive.assert_not_called()
+
+    mock_update.message.document.file_size = 10**6
+    await handle_file_upload(mock_update, mock_context)
+    mock_update.message.reply_text.assert_called_with(
+        "The file is too large, the limit is 64 KB."
+    )
+    file.download_as_bytearray.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_reference_checker_checks_type_size_and_caches():
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append((request.method, request.url.path))
+        if request.url.path == "/image.png":
+            return httpx.Response(200, headers={"content-type": "image/png"})
+        if request.url.path == "/no-head.jpg":
+            if request.method == "HEAD":
+                return httpx.Response(405)
+            return httpx.Response(
+                206,
+                headers={
+                    "content-type": "image/jpeg",
+                    "content-range": "bytes 0-0/99999999999",
+                },
+            )
+        if request.url.path == "/page":
+            return httpx.Response(200, headers={"content-type": "text/html"})
+        return httpx.Response(404)
+
+    checker = ReferenceChecker(transport=httpx.MockTransport(handler))
+    urls = [
+        "https://example.com/image.png",
+        "example.com/no-head.jpg",
+        "https://example.com/page",
+        "https://example.com/missing.png",
+    ]
+    failed = await checker.check_all(urls)
+    await checker.check_all(urls)
+    await checker.close()
+
+    assert failed == {
+        "example.com/no-head.jpg": "larger than 50 MB",
+        "https://example.com/page": "not a PNG, JPEG or WebP image (text/html)",
+        "https://example.com/missing.png": "HTTP 404",
+    }
+    # The second round is served from the cache
+    assert len(requests_seen) == 6
+
+
+@pytest.mark.asyncio
+async def test_reference_cache_stores_content_addressed_and_refreshes(tmp_path):
+    images = {"/a.png": b"first"}
+    downloads = []
+
+    def handler(request):
+        downloads.append(request.url.path)
+        if request.url.path not in images:
+            return httpx.Response(404)
+        return httpx.Response(
+            200,
+            headers={"content-type": "image/png"},
+            content=images[request.url.path],
+        )
+
+    cache = ReferenceCache(str(tmp_path), transport=httpx.MockTransport(handler))
+    uris = await cache.images_for("https://example.com/a.png example.com/a.png")
+    await cache.images_for("https://example.com/a.png")
+    assert uris == ["data:image/png;base64,Zmlyc3Q="] * 2
+    # Both forms of the URL share one copy, which isn't fetched again
+    assert downloads == ["/a.png"]
+    assert len(os.listdir(tmp_path / "objects")) == 1
+    # Per-URL locks are dropped once nobody is waiting on them
+    assert cache._locks == {}
+
+    # Setting the reference again picks up a changed image behind the same URL
+    images["/a.png"] = b"second"
+    await cache.prefetch("https://example.com/a.png")
+    assert await cache.data_uri("https://example.com/a.png") == (
+        "data:image/png;base64,c2Vjb25k"
+    )
+    await cache.prefetch("https://example.com/missing.png")
+    with pytest.raises(httpx.HTTPStatusError):
+        await cache.data_uri("https://example.com/missing.png")
+    await cache.close()
+
+    # A new process finds the stored images without downloading them
+    downloads.clear()
+    restarted = ReferenceCache(str(tmp_path), transport=httpx.MockTransport(handler))
+    assert await restarted.images_for("example.com/a.png") == [
+        "data:image/png;base64,c2Vjb25k"
+    ]
+    assert downloads == []
+
+
+@pytest.mark.asyncio
+async def test_imagine_refuses_unreachable_reference():
+    mock_update = AsyncMock()
+    mock_context = AsyncMock()
+    mock_update.effective_chat.id = -9950
+    mock_update.effective_user.id = 1
+    mock_update.message.message_id = 1007
+    mock_update.message.text = "/imagine a cat"
+
+    with patch("bot.db_get_limits", return_value=(None, None)), patch(
+        "bot.db_get_reference", return_value="https://example.com/gone.png"
+    ), patch(
+        "bot.reference_checker.check_all",
+        AsyncMock(return_value={"https://example.com/gone.png": "HTTP 404"}),
+    ), patch(
+        "bot.reference_to_video"
+    ) as mock_reference_to_video:
+        await imagine(mock_update, mock_context)
+
+    mock_reference_to_video.assert_not_called()
+    mock_update.message.reply_text.assert_called_once_with(
+        "The group's reference images can't be loaded. Ask an admin to set a new /reference."
+    )
+
+
+@pytest.mark.asyncio
+async def test_graceful_shutdown_checkpoints_and_resumes_generations():
+    mock_update = AsyncMock()
+    mock_update.effective_chat.id = -9960
+    mock_update.effective_user.id = 1
+    mock_update.message.message_id = 77
+    mock_update.message.text = "/imagine a cat"
+    application = MagicMock()
+    application.updater.stop = AsyncMock()
+
+    with patch("bot.db_get_limits", return_value=(None, None)), patch(
+        "bot.db_get_reference", return_value="http://example.com/image.jpg"
+    ), patch(
+        "bot.reference_to_video",
+        return_value={"task_id": "task_shutdown", "state": "created"},
+    ), patch(
+        "bot.get_generation_status", return_value={"state": "processing"}
+    ), patch(
+        "bot.POLL_SLEEP_CYCLE_SECONDS", 0.01
+    ), patch(
+        "bot.SHUTDOWN_DRAIN_SECONDS", 0.05
+    ), patch(
+        "bot.shutting_down", False
+    ):
+        generation = asyncio.create_task(imagine(mock_update, AsyncMock()))
+        while "task_shutdown" not in tracked_tasks:
+            await asyncio.sleep(0.01)
+        await graceful_shutdown(application)
+
+        # New generations are refused while the bot stops
+        late_update = AsyncMock()
+        late_update.message.text = "/imagine a dog"
+        await imagine(late_update, AsyncMock())
+        late_update.message.reply_text.assert_called_once_with(
+            "The bot is restarting, please try again in a minute."
+        )
+
+    assert generation.cancelled()
+    application.updater.stop.assert_called_once()
+    application.stop_running.assert_called_once()
+    [checkpoint] = [
+        row for row in db_get_checkpoints() if row["task_id"] == "task_shutdown"
+    ]
+    assert (checkpoint["chat_id"], checkpoint["message_id"]) == (-9960, 77)
+
+    # The next start finishes tracking the video and replies to the command
+    application.bot = AsyncMock()
+    with patch(
+        "bot.get_generation_status",
+        return_value={
+            "state": "success",
+            "creations": [{"url": "http://example.com/shutdown.mp4"}],
+        },
+    ):
+        await resume_generation(application, checkpoint)
+
+    application.bot.send_video.assert_called_once_with(
+        chat_id=-9960,
+        video="http://example.com/shutdown.mp4",
+        reply_to_message_id=77,
+    )
+    assert db_get_usage(-9960, 1) == (1, 1)
+    assert not [
+        row for row in db_get_checkpoints() if row["task_id"] == "task_shutdown"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_cancel_button_stops_generation_and_frees_quota():
+    mock_update = AsyncMock()
+    mock_update.effective_chat.id = -9970
+    mock_update.effective_user.id = 5
+    mock_update.message.message_id = 31
+    mock_update.message.text = "/imagine a cat"
+    query_update = AsyncMock()
+    query_update.callback_query.data = "cancel:31"
+    query_update.callback_query.message.chat.id = -9970
+
+    with patch("bot.db_get_limits", return_value=(1, None)), patch(
+        "bot.db_get_reference", return_value="http://example.com/image.jpg"
+    ), patch(
+        "bot.reference_to_video",
+        return_value={"task_id": "task_cancel", "state": "created"},
+    ), patch(
+        "bot.get_generation_status", return_value={"state": "processing"}
+    ), patch(
+        "bot.cancel_generation"
+    ) as mock_cancel_generation:
+        generation = asyncio.create_task(imagine(mock_update, AsyncMock()))
+        while "task_cancel" not in tracked_tasks:
+            await asyncio.sleep(0.01)
+
+        # Only the user who sent the command can cancel it
+        query_update.callback_query.from_user.id = 6
+        await cancel_button(query_update, AsyncMock())
+        query_update.callback_query.answer.assert_called_with("Nothing to cancel.")
+
+        query_update.callback_query.from_user.id = 5
+        await cancel_button(query_update, AsyncMock())
+        # The group's only slot is free again before polling even stops
+        reservation_id, _ = db_reserve_quota(-9970, 7, 1, 1, None)
+        assert reservation_id is not None
+        db_release_reservation(-9970, reservation_id)
+        await asyncio.wait_for(generation, 1)
+
+    query_update.callback_query.answer.assert_called_with("Video cancelled.")
+    mock_cancel_generation.assert_called_once()
+    assert mock_cancel_generation.call_args.kwargs["task_id"] == "task_cancel"
+    mock_update.message.reply_text.assert_called_with("Video generation was cancelled.")
+    assert db_get_memory_by_id(5, -9970, 1)[3] == "cancelled"
+
+    cancel_update = AsyncMock()
+    cancel_update.effective_chat.id = -9970
+    cancel_update.effective_user.id = 5
+    context = AsyncMock()
+    context.args = ["1"]
+    await cancel(cancel_update, context)
+    cancel_update.message.reply_text.assert_called_once_with(
+        "Video 1 is already cancelled."
+    )
+
+
+@pytest.mark.asyncio
+async def test_redelivered_imagine_reuses_the_first_task():
+    mock_update = AsyncMock()
+    mock_update.effective_chat.id = -9980
+    mock_update.effective_user.id = 8
+    mock_update.message.message_id = 55
+    mock_update.message.text = "/imagine a cat"
+
+    with patch("bot.db_get_limits", return_value=(None, None)), patch(
+        "bot.db_get_reference", return_value="http://example.com/image.jpg"
+    ), patch(
+        "bot.reference_to_video",
+        return_value={"task_id": "task_replay", "state": "created"},
+    ) as mock_reference_to_video, patch(
+        "bot.get_generation_status",
+        return_value={
+            "state": "success",
+            "creations": [{"url": "http://example.com/replay.mp4"}],
+        },
+    ):
+        await imagine(mock_update, AsyncMock())
+        await imagine(mock_update, AsyncMock())
+
+    mock_reference_to_video.assert_called_once()
+    assert mock_update.message.reply_video.call_count == 2
+    assert db_get_usage(-9980, 8) == (1, 1)
+    assert db_get_memory_by_id(8, -9980, 2) is None
+
+
+def test_enqueue_and_worker_submission_are_idempotent():
+    def enqueue(message_id):
+        return db_enqueue_job(
+            group_id=47,
+            user_id=48,
+            chat_id=47,
+            message_id=message_id,
+            prompt="test prompt, 2d animation",
+            images=["http://example.com/image.jpg"],
+            params={
+                "model": "vidu2.0",
+                "duration": 4,
+                "aspect_ratio": "16:9",
+                "resolution": "360p",
+            },
+            idempotency_key=f"47:{message_id}:0",
+        )
+
+    job_id = enqueue(1)
+    assert job_id is not None and enqueue(1) is None
+
+    worker = Worker("abc")
+    rejected = requests.exceptions.HTTPError(response=requests.Response())
+    with patch("worker.reference_to_video", side_effect=rejected):
+        worker.run_once()
+    # Vidu refused the request, so the job is retried later
+    conn = sqlite3.connect(get_db_path())
+    conn.execute("UPDATE jobs SET next_check = 0 WHERE job_id = ?", (job_id,))
+    conn.commit()
+    conn.close()
+    with patch(
+        "worker.reference_to_video",
+        side_effect=requests.exceptions.ReadTimeout("read timed out"),
+    ) as mock_reference_to_video:
+        worker.run_once()
+    mock_reference_to_video.assert_called_once()
+    # Vidu may have the task, so the job fails instead of submitting again
+    assert (job_id, 47, 1, "failed", None, UNCONFIRMED_SUBMISSION) in (
+        db_get_finished_jobs()
+    )
+    db_mark_job_delivered(job_id)
+
+
+@pytest.mark.asyncio
+async def test_undeliverable_job_does_not_block_the_others():
+    jobs = [
+        (1, -1, 10, "success", "http://x/1.mp4", None),
+        (2, -2, 20, "success", "http://x/2.mp4", None),
+        (3, -3, 30, "failed", None, "boom"),
+    ]
+    fetched = []
+
+    def finished_jobs():
+        fetched.append(1)
+        return jobs if len(fetched) == 1 else []
+
+    application = MagicMock()
+    application.bot.send_video = AsyncMock(side_effect=[Forbidden("kicked"), None])
+    application.bot.send_message = AsyncMock(side_effect=NetworkError("down"))
+    delivered = []
+    with patch("bot.db_get_finished_jobs", side_effect=finished_jobs), patch(
+        "bot.db_mark_job_delivered", side_effect=delivered.append
+    ), patch("bot.DELIVERY_INTERVAL_SECONDS", 0):
+        task = asyncio.create_task(deliver_finished_jobs(application))
+        while len(fetched) < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    assert application.bot.send_video.await_count == 2
+    # The job of a chat the bot was removed from is given up, while one that
+    # failed on a network error is tried again next round
+    assert delivered == [1, 2]
+
+
+def test_completion_rate_and_wait_estimates():
+    rate = CompletionRate(window=60)
+    for second in range(6):
+        rate.record(now=second)
+    assert rate.per_second(now=10) == 0.1
+    # Completions older than the window no longer count
+    assert rate.per_second(now=62) == 4 / 60
+
+    assert estimate_wait(0, 0) == 0
+    assert estimate_wait(3, 0) is None
+    assert estimate_wait(30, 0.1) == 300
+    assert format_wait(None) == "unknown"
+    assert format_wait(20) == "less than a minute"
+    assert format_wait(300) == "about 5 minutes"
+
+
+@pytest.mark.asyncio
+async def test_imagine_reports_backlog_and_rejects_over_cap():
+    mock_update = AsyncMock()
+    mock_update.effective_chat.id = -9990
+    mock_update.effective_user.id = 9
+    mock_update.message.message_id = 61
+    mock_update.message.text = "/imagine a cat | a dog"
+    busy = Counter({-9991: 3})
+    rate = CompletionRate(window=60)
+    for _ in range(6):
+        rate.record()
+
+    with patch("bot.db_get_limits", return_value=(None, None)), patch(
+        "bot.db_get_reference", return_value="http://example.com/image.jpg"
+    ), patch("bot.outstanding", busy), patch("bot.completion_rate", rate), patch(
+        "bot.MAX_OUTSTANDING_JOBS", 4
+    ), patch(
+        "bot.reference_to_video"
+    ) as mock_reference_to_video:
+        await imagine(mock_update, AsyncMock())
+        mock_reference_to_video.assert_not_called()
+        mock_update.message.reply_text.assert_called_once_with(
+            "Too many videos are being generated right now. Estimated wait for a "
+            "free slot: less than a minute. Please try again later."
+        )
+
+        mock_update.message.text = "/imagine a cat"
+        mock_update.message.reply_text.reset_mock()
+        with patch(
+            "bot.generate_video", AsyncMock(return_value=("http://x/v.mp4", None))
+        ):
+            await imagine(mock_update, AsyncMock())
+        mock_update.message.reply_text.assert_called_once_with(
+            "3 other videos are being generated right now, so yours may take longer."
+        )
+
+        # Only the job queue hands out videos in turn
+        mock_update.message.reply_text.reset_mock()
+        with patch("bot.USE_JOB_QUEUE", True), patch(
+            "bot.db_count_outstanding_jobs", return_value=(3, 0)
+        ), patch("bot.db_count_finished_jobs", return_value=6), patch(
+            "bot.db_enqueue_job", return_value=1
+        ):
+            await imagine(mock_update, AsyncMock())
+        assert mock_update.message.reply_text.call_args_list[0].args == (
+            "3 videos are ahead of yours. Estimated wait: about 5 minutes.",
+        )
+
+    # The generation no longer counts once it is done
+    assert busy == Counter({-9991: 3})
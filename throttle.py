@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+
+
+class Throttle:
+    """
+    Per-key token buckets for cheap, in-memory rate limiting.
+
+    Each key may spend up to `burst` tokens at once, refilled at `rate`
+    tokens per second. A bucket that has been idle long enough to refill
+    completely is indistinguishable from a new one, so it is evicted; the
+    buckets are kept in least recently used order, which makes every check
+    O(1) amortized and bounds memory by the number of recently active keys.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        Args:
+            rate (float): Tokens added per second.
+            burst (int): Bucket size, the number of requests allowed at once.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.idle_seconds = burst / rate
+        # key -> [tokens, last update, warned since the bucket ran dry]
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def check(self, key, now=None):
+        """
+        Take a token for the key if one is available.
+
+        Args:
+            key: The user or chat the request is charged to.
+            now (float, optional): The current monotonic time, for testing.
+
+        Returns:
+            tuple: Whether the request is allowed, and whether this is the
+            first rejection since the key ran out of tokens (so the caller
+            can reply once instead of to every rejected request).
+        """
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now, False]
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True, False
+        first_rejection = not bucket[2]
+        bucket[2] = True
+        return False, first_rejection
+
+    def _evict(self, now):
+        while self._buckets:
+            key, (_, updated, _) = next(iter(self._buckets.items()))
+            if now - updated < self.idle_seconds:
+                return
+            del self._buckets[key]
@@ -1,34 +1,183 @@
 import re
-import logging
+import csv
+import json
 
+URL_PATTERN = re.compile(r"^(https?://)?([a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}(/.*)?$")
+IMPORT_FIELDS = ("group_id", "group_limit", "user_limit", "reference")
+# Namespaces become part of database file names
+NAMESPACE_PATTERN = re.compile(r"^[A-Za-z0-9_-]{0,32}$")
 
-def validate_and_extract_urls(file_path):
+
+def validate_and_extract_urls(f):
+    """
+    Validate a reference file that lists one URL per line.
+
+    The file is read one line at a time. Blank lines are skipped and
+    repeated URLs are only kept once.
+
+    Args:
+        f (file): The text file to read.
+
+    Returns:
+        tuple: The list of unique valid URLs in file order, and the list of
+        error messages for invalid lines.
+    """
+    urls = {}
+    errors = []
+    for line_number, line in enumerate(f, 1):
+        url = line.strip()
+        if not url:
+            continue
+        if URL_PATTERN.match(url):
+            urls[url] = None
+        else:
+            errors.append(f"line {line_number}: not a valid URL: {url[:100]}")
+    return list(urls), errors
+
+
+def _parse_import_entry(record):
     """
-    Reads a .txt file and validates that it contains a list of URLs.
+    Validate one record of a configuration import.
 
     Args:
-        file_path (str): The path to the .txt file.
+        record (dict): The raw record, with values as read from the file.
 
     Returns:
-        list: A list of valid URLs if the file is valid.
-        None: If the file contains invalid data.
+        dict: The normalized entry.
+
+    Raises:
+        ValueError: If the record is invalid.
     """
-    url_pattern = re.compile(r"^(https?://)?([a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}(/.*)?$")
-    valid_urls = []
+    unknown = set(record) - set(IMPORT_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(sorted(map(str, unknown)))}")
 
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-
-        for line in lines:
-            url = line.strip()
-            if url_pattern.match(url):
-                valid_urls.append(url)
-            else:
-                # If any line is not a valid URL, return None
-                return None
-
-        return valid_urls if valid_urls else None
-    except Exception as e:
-        logging.error(f"Error reading or validating file: {e}")
-        return None
+        entry = {"group_id": int(record.get("group_id"))}
+    except (TypeError, ValueError):
+        raise ValueError("group_id must be a number")
+
+    for field in ("group_limit", "user_limit"):
+        value = record.get(field)
+        if value is None or value == "":
+            entry[field] = None
+            continue
+        try:
+            entry[field] = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{field} must be a number")
+        if entry[field] < 0:
+            raise ValueError(f"{field} must not be negative")
+
+    reference = record.get("reference")
+    if reference is None or reference == "" or reference == []:
+        entry["reference"] = None
+    else:
+        if isinstance(reference, str):
+            urls = re.split(r"[\s,;]+", reference.strip())
+        elif isinstance(reference, list):
+            urls = [str(url).strip() for url in reference]
+        else:
+            raise ValueError("reference must be a string or a list of URLs")
+        invalid = [url for url in urls if not URL_PATTERN.match(url)]
+        if invalid:
+            raise ValueError(f"invalid reference URL: {invalid[0]}")
+        entry["reference"] = ",".join(urls)
+    return entry
+
+
+def parse_config_import(f, file_format):
+    """
+    Validate a bulk import of group limits and references in one pass.
+
+    CSV files need a header row with any of the columns group_id, group_limit,
+    user_limit and reference, and are read a row at a time. JSON files hold a
+    list of objects with the same keys. Reference URLs are separated by
+    whitespace, commas or semicolons, or given as a JSON list. Empty values
+    leave the current setting unchanged.
+
+    Args:
+        f (file): The text file to read.
+        file_format (str): "csv" or "json".
+
+    Returns:
+        tuple: The list of valid entries and the list of error messages, each
+        prefixed with the line (CSV) or entry (JSON) it refers to.
+    """
+    entries, errors, seen = [], [], set()
+
+    if file_format == "csv":
+        reader = csv.DictReader(f)
+        if not reader.fieldnames or "group_id" not in reader.fieldnames:
+            return [], ["line 1: the header must include group_id"]
+        records = ((f"line {reader.line_num}", record) for record in reader)
+    else:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            return [], [f"invalid JSON: {e}"]
+        if not isinstance(data, list):
+            return [], ["the JSON file must contain a list of objects"]
+        records = ((f"entry {index}", record) for index, record in enumerate(data, 1))
+
+    for location, record in records:
+        if not isinstance(record, dict):
+            errors.append(f"{location}: expected an object")
+            continue
+        if None in record:
+            errors.append(f"{location}: more values than columns")
+            continue
+        try:
+            entry = _parse_import_entry(record)
+        except ValueError as e:
+            errors.append(f"{location}: {e}")
+            continue
+        if entry["group_id"] in seen:
+            errors.append(f"{location}: duplicate group_id {entry['group_id']}")
+            continue
+        seen.add(entry["group_id"])
+        entries.append(entry)
+    return entries, errors
+
+
+def parse_bot_configs(f):
+    """
+    Validate the list of bots one process serves.
+
+    The JSON file holds a list of objects with the bot's "token", its
+    "admin_ids" and a "namespace" naming its databases. At most one bot may
+    leave the namespace empty, to keep using the databases at DATABASE.
+
+    Args:
+        f (file): The JSON file to read.
+
+    Returns:
+        list: Dicts with token, admin_ids and namespace.
+
+    Raises:
+        ValueError: If the file is invalid, naming the entry at fault.
+    """
+    data = json.load(f)
+    if not isinstance(data, list) or not data:
+        raise ValueError("the JSON file must contain a non-empty list of objects")
+
+    configs, namespaces = [], set()
+    for index, record in enumerate(data, 1):
+        if not isinstance(record, dict) or not record.get("token"):
+            raise ValueError(f"entry {index}: expected an object with a token")
+        namespace = str(record.get("namespace") or "")
+        if not NAMESPACE_PATTERN.match(namespace):
+            raise ValueError(
+                f"entry {index}: namespace may only contain letters, digits, - and _"
+            )
+        if namespace in namespaces:
+            raise ValueError(f"entry {index}: namespace {namespace!r} is used twice")
+        namespaces.add(namespace)
+        try:
+            admin_ids = [int(admin_id) for admin_id in record.get("admin_ids", [])]
+        except (TypeError, ValueError):
+            raise ValueError(f"entry {index}: admin_ids must be a list of numbers")
+        configs.append(
+            {"token": record["token"], "admin_ids": admin_ids, "namespace": namespace}
+        )
+    return configs
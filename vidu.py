@@ -1,6 +1,19 @@
+import os
 import requests
 from mockdata import MOCK_TASK_SUCCESS, MOCK_TASK_PENDING
 
+REQUEST_TIMEOUT_SECONDS = 30
+
+
+def get_api_base_url():
+    """
+    Get the Vidu API base URL, which can point at a local simulator.
+
+    Returns:
+        str: The base URL without a trailing slash.
+    """
+    return os.getenv("VIDU_API_BASE_URL", "https://api.vidu.com").rstrip("/")
+
 
 def reference_to_video(
     mock,
@@ -38,7 +51,7 @@ def reference_to_video(
     if mock:
         return MOCK_TASK_PENDING
 
-    url = "https://api.vidu.com/ent/v2/reference2video"
+    url = f"{get_api_base_url()}/ent/v2/reference2video"
     headers = {"Authorization": f"Token {api_key}", "Content-Type": "application/json"}
     payload = {
         "model": model,
@@ -55,11 +68,33 @@ def reference_to_video(
     # Remove keys with None values
     payload = {key: value for key, value in payload.items() if value is not None}
 
-    response = requests.post(url, headers=headers, json=payload)
+    response = requests.post(
+        url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT_SECONDS
+    )
     print(response)
+    response.raise_for_status()  # Raise an exception for HTTP errors
     return response.json()
 
 
+def submission_rejected(error):
+    """
+    Tell whether a failed `reference_to_video` call certainly created no task.
+
+    Vidu answered with an error status, or the connection was never made.
+    After other failures, such as a read timeout, Vidu may have accepted the
+    request, so submitting it again could create a second paid generation.
+
+    Args:
+        error (requests.exceptions.RequestException): The error of the call.
+
+    Returns:
+        bool: True if the prompt can safely be submitted again.
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None
+    return isinstance(error, requests.exceptions.ConnectTimeout)
+
+
 def get_generation_status(mock, api_key, task_id):
     """
     Get the status and results of a video generation task from the Vidu API.
@@ -74,9 +109,33 @@ def get_generation_status(mock, api_key, task_id):
     """
     if mock:
         return MOCK_TASK_SUCCESS
-    url = f"https://api.vidu.com/ent/v2/tasks/{task_id}/creations"
+    url = f"{get_api_base_url()}/ent/v2/tasks/{task_id}/creations"
+    headers = {"Authorization": f"Token {api_key}", "Content-Type": "application/json"}
+
+    response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+    response.raise_for_status()  # Raise an exception for HTTP errors
+    return response.json()
+
+
+def cancel_generation(mock, api_key, task_id):
+    """
+    Cancel a video generation task that has not finished yet.
+
+    Args:
+        mock (bool): If True, use mock data instead of making an actual API call.
+        api_key (str): Your API key for authorization.
+        task_id (str): The task ID returned upon the successful creation of a task.
+
+    Returns:
+        dict: The response from the API.
+    """
+    if mock:
+        return {}
+    url = f"{get_api_base_url()}/ent/v2/tasks/{task_id}/cancel"
     headers = {"Authorization": f"Token {api_key}", "Content-Type": "application/json"}
 
-    response = requests.get(url, headers=headers)
+    response = requests.post(
+        url, headers=headers, json={"id": task_id}, timeout=REQUEST_TIMEOUT_SECONDS
+    )
     response.raise_for_status()  # Raise an exception for HTTP errors
     return response.json()
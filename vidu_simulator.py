@@ -0,0 +1,377 @@
+"""
+Local stand-in for the Vidu API, for realistic offline load and soak testing.
+
+Tasks move through created -> processing -> success/failed over configurable
+durations, and 429/5xx responses and timeouts can be injected at set rates.
+Point the bot at it with VIDU_API_BASE_URL, or run the bot with --simulator.
+
+Usage:
+    python vidu_simulator.py --port 8765 --render-seconds uniform:20:60
+    VIDU_API_BASE_URL=http://127.0.0.1:8765 python bot.py
+"""
+
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+def parse_distribution(spec):
+    """
+    Parse a duration distribution spec into a sampling function.
+
+    Supported specs (all values in seconds):
+        const:<value>
+        uniform:<low>:<high>
+        exp:<mean>
+        lognormal:<median>:<sigma>
+
+    Args:
+        spec (str): The distribution spec.
+
+    Returns:
+        callable: A function returning one sample in seconds.
+    """
+    kind, *values = spec.split(":")
+    values = [float(v) for v in values]
+    if kind == "const":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise argparse.ArgumentTypeError(f"Unknown distribution: {spec}")
+
+
+class ViduSimulator:
+    """
+    In-memory Vidu task store served over HTTP from a background thread.
+    """
+
+    def __init__(
+        self,
+        queue_seconds="const:1",
+        render_seconds="uniform:5:15",
+        failure_rate=0.05,
+        rate_limit_rate=0.0,
+        server_error_rate=0.0,
+        timeout_rate=0.0,
+        timeout_seconds=65,
+    ):
+        """
+        Args:
+            queue_seconds (str): Distribution of time spent in "created".
+            render_seconds (str): Distribution of time spent in "processing".
+            failure_rate (float): Fraction of tasks that end in "failed".
+            rate_limit_rate (float): Fraction of requests answered with 429.
+            server_error_rate (float): Fraction of requests answered with 5xx.
+            timeout_rate (float): Fraction of requests that hang before answering.
+            timeout_seconds (float): How long a hanging request hangs.
+        """
+        self.queue_seconds = parse_distribution(queue_seconds)
+        self.render_seconds = parse_distribution(render_seconds)
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self._next_id = 816069859350695936
+        self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host="127.0.0.1", port=0):
+        """
+        Serve the API from a daemon thread.
+
+        Args:
+            host (str): Interface to bind.
+            port (int): Port to bind; 0 picks a free port.
+
+        Returns:
+            str: The base URL to use as VIDU_API_BASE_URL.
+        """
+        handler = type("Handler", (_SimulatorRequestHandler,), {"simulator": self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, name="vidu-simulator", daemon=True
+        ).start()
+        logger.info("Vidu simulator listening on %s", self.base_url)
+        return self.base_url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def create_task(self, payload):
+        """
+        Create a task and schedule its state transitions.
+
+        Args:
+            payload (dict): The reference2video request body.
+
+        Returns:
+            dict: The task as returned by the create endpoint.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self._next_id += 1
+            task_id = str(self._next_id)
+        processing_at = now + self.queue_seconds()
+        task = {
+            "task_id": task_id,
+            "type": "reference2video",
+            "model": payload.get("model"),
+            "prompt": payload.get("prompt"),
+            "images": payload.get("images"),
+            "duration": payload.get("duration"),
+            "seed": payload.get("seed") or random.randint(0, 2**31),
+            "aspect_ratio": payload.get("aspect_ratio"),
+            "resolution": payload.get("resolution"),
+            "movement_amplitude": payload.get("movement_amplitude"),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "callback_url": payload.get("callback_url"),
+            "processing_at": processing_at,
+            "finished_at": processing_at + self.render_seconds(),
+            "outcome": "failed" if random.random() < self.failure_rate else "success",
+            "cancelled": False,
+            "notified": "created",
+        }
+        with self.lock:
+            self.tasks[task_id] = task
+        if task["callback_url"]:
+            self._schedule_callbacks(task)
+        return self._public(task, "created")
+
+    def state(self, task):
+        """
+        Get the current state of a task from the clock.
+        """
+        if task["cancelled"]:
+            return "failed"
+        now = time.monotonic()
+        if now < task["processing_at"]:
+            return "created"
+        if now < task["finished_at"]:
+            return "processing"
+        return task["outcome"]
+
+    def creations(self, task_id):
+        """
+        Build the creations endpoint response for a task.
+
+        Returns:
+            dict or None: The response, or None for unknown tasks.
+        """
+        with self.lock:
+            task = self.tasks.get(task_id)
+        if task is None:
+            return None
+        state = self.state(task)
+        response = {"id": task_id, "state": state, "err_code": "", "creations": []}
+        if state == "failed":
+            response["err_code"] = "TaskCancelled" if task["cancelled"] else "Failed"
+        elif state == "success":
+            base = f"https://video.simulator.local/{task_id}"
+            response["creations"] = [
+                {
+                    "id": task_id,
+                    "url": f"{base}/video.mp4",
+                    "cover_url": f"{base}/cover.jpeg",
+                }
+            ]
+        return response
+
+    def cancel(self, task_id):
+        """
+        Cancel a task that has not finished yet.
+
+        Returns:
+            bool or None: True if the task was cancelled, False if it had
+            already finished, None for unknown tasks.
+        """
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return None
+            if self.state(task) in ("success", "failed"):
+                return False
+            task["cancelled"] = True
+            return True
+
+    def _public(self, task, state):
+        public = {
+            key: value
+            for key, value in task.items()
+            if key
+            not in ("processing_at", "finished_at", "outcome", "cancelled", "notified")
+        }
+        public["state"] = state
+        return public
+
+    def _schedule_callbacks(self, task):
+        now = time.monotonic()
+        for at in (task["processing_at"], task["finished_at"]):
+            timer = threading.Timer(max(0, at - now), self._send_callback, (task,))
+            timer.daemon = True
+            timer.start()
+
+    def _send_callback(self, task):
+        state = self.state(task)
+        if state == task["notified"]:
+            return
+        task["notified"] = state
+        body = self.creations(task["task_id"])
+        try:
+            requests.post(task["callback_url"], json=body, timeout=10)
+        except requests.exceptions.RequestException as e:
+            logger.warning("Callback to %s failed: %s", task["callback_url"], e)
+
+    def injected_fault(self):
+        """
+        Pick a fault to inject into the current request, if any.
+
+        Returns:
+            str or None: "timeout", "rate_limit", "server_error" or None.
+        """
+        roll = random.random()
+        for fault, rate in (
+            ("timeout", self.timeout_rate),
+            ("rate_limit", self.rate_limit_rate),
+            ("server_error", self.server_error_rate),
+        ):
+            if roll < rate:
+                return fault
+            roll -= rate
+        return None
+
+
+class _SimulatorRequestHandler(BaseHTTPRequestHandler):
+    simulator = None
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _fault(self):
+        fault = self.simulator.injected_fault()
+        if fault == "timeout":
+            time.sleep(self.simulator.timeout_seconds)
+            self._send_json(504, {"code": 504, "message": "Gateway Timeout"})
+        elif fault == "rate_limit":
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif fault == "server_error":
+            status = random.choice((500, 502, 503))
+            self._send_json(status, {"code": status, "message": "Injected error"})
+        return fault is not None
+
+    def _authorized(self):
+        if not self.headers.get("Authorization", "").startswith("Token "):
+            self._send_json(401, {"code": 401, "message": "Unauthorized"})
+            return False
+        return True
+
+    def do_POST(self):
+        if not self._authorized() or self._fault():
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"code": 400, "message": "Invalid JSON"})
+            return
+
+        if self.path == "/ent/v2/reference2video":
+            if not payload.get("images") or not payload.get("prompt"):
+                self._send_json(400, {"code": 400, "message": "Missing parameters"})
+                return
+            self._send_json(200, self.simulator.create_task(payload))
+        elif self.path.startswith("/ent/v2/tasks/") and self.path.endswith("/cancel"):
+            cancelled = self.simulator.cancel(self.path.split("/")[4])
+            if cancelled is None:
+                self._send_json(404, {"code": 404, "message": "Not Found"})
+            elif not cancelled:
+                self._send_json(400, {"code": 400, "message": "Task already finished"})
+            else:
+                self._send_json(200, {})
+        else:
+            self._send_json(404, {"code": 404, "message": "Not Found"})
+
+    def do_GET(self):
+        if not self._authorized() or self._fault():
+            return
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 5 and parts[:3] == ["ent", "v2", "tasks"]:
+            if parts[4] == "creations":
+                response = self.simulator.creations(parts[3])
+                if response is not None:
+                    self._send_json(200, response)
+                    return
+        self._send_json(404, {"code": 404, "message": "Not Found"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local Vidu API simulator.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--queue-seconds", default="const:1")
+    parser.add_argument("--render-seconds", default="uniform:5:15")
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-seconds", type=float, default=65)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    simulator = ViduSimulator(
+        queue_seconds=args.queue_seconds,
+        render_seconds=args.render_seconds,
+        failure_rate=args.failure_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        server_error_rate=args.server_error_rate,
+        timeout_rate=args.timeout_rate,
+        timeout_seconds=args.timeout_seconds,
+    )
+    simulator.start(args.host, args.port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+Worker process that submits queued generation jobs to Vidu and tracks them.
+
+The bot process only enqueues jobs and delivers finished results; workers
+claim jobs from the SQLite `jobs` table with expiring leases, so any number of
+worker processes can share the queue and a dead worker's jobs are picked up
+again once its leases expire. Jobs of all bots served by the bot process share
+the queue; each job is processed with its bot's databases.
+
+Usage:
+    python bot.py --worker --processes 4
+"""
+
+import os
+import time
+import uuid
+import signal
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from services import (
+    init_db,
+    db_claim_jobs,
+    db_release_job,
+    db_add_memory,
+    db_complete_video,
+    db_update_status,
+    db_release_reservation,
+    db_cancel_memory,
+    db_claim_submission,
+    db_complete_submission,
+    db_release_submission,
+    use_namespace,
+)
+from vidu import (
+    reference_to_video,
+    get_generation_status,
+    cancel_generation,
+    submission_rejected,
+)
+
+logger = logging.getLogger(__name__)
+
+WORKER_BATCH_SIZE = 20
+WORKER_THREADS = 8
+WORKER_IDLE_SLEEP_SECONDS = 1
+JOB_LEASE_SECONDS = 120
+JOB_POLL_SECONDS = 5
+JOB_MAX_SUBMIT_ATTEMPTS = 3
+JOB_MAX_TRACKING_SECONDS = 3600
+UNCONFIRMED_SUBMISSION = (
+    "Vidu didn't confirm the request in time. Check /memory before trying again."
+)
+
+
+class Worker:
+    """
+    Claims jobs from the queue and moves them through Vidu.
+
+    Queued jobs are submitted with `reference_to_video`; submitted jobs are
+    checked with `get_generation_status` until they finish. HTTP calls of one
+    batch run concurrently on a thread pool.
+    """
+
+    def __init__(self, api_key, mock=False, worker_id=None, threads=WORKER_THREADS):
+        """
+        Args:
+            api_key (str): The Vidu API key.
+            mock (bool): If True, use mock data instead of calling Vidu.
+            worker_id (str, optional): A unique ID for this worker's leases.
+            threads (int): Number of concurrent HTTP calls.
+        """
+        self.api_key = api_key
+        self.mock = mock
+        self.worker_id = worker_id or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="worker")
+
+    def run_once(self):
+        """
+        Claim and process one batch of due jobs.
+
+        Returns:
+            int: The number of jobs processed.
+        """
+        jobs = db_claim_jobs(self.worker_id, WORKER_BATCH_SIZE, JOB_LEASE_SECONDS)
+        for _ in self.executor.map(self.process, jobs):
+            pass
+        return len(jobs)
+
+    def run_forever(self, stop_event=None):
+        """
+        Process jobs until the stop event is set.
+
+        Args:
+            stop_event (multiprocessing.Event, optional): Set to stop the loop.
+        """
+        logger.info("Worker %s started", self.worker_id)
+        while not (stop_event and stop_event.is_set()):
+            try:
+                processed = self.run_once()
+            except Exception:
+                logger.exception("Worker %s failed to process a batch", self.worker_id)
+                processed = 0
+            if not processed:
+                time.sleep(WORKER_IDLE_SLEEP_SECONDS)
+        self.executor.shutdown()
+
+    def process(self, job):
+        """
+        Advance one leased job by one step.
+
+        Args:
+            job (dict): The claimed job.
+        """
+        with use_namespace(job.get("namespace") or ""):
+            if job["state"] == "queued":
+                self.submit(job)
+            else:
+                self.check(job)
+
+    def submit(self, job):
+        params = job["params"]
+        key = job.get("idempotency_key")
+        claimed, task_id = db_claim_submission(key) if key else (True, None)
+        if not claimed:
+            if task_id:
+                # An earlier attempt got its task after all; track that one
+                self._track(job, {"task_id": task_id})
+            else:
+                # A worker died while submitting; Vidu may have the task
+                self._release(job, state="failed", error=UNCONFIRMED_SUBMISSION)
+            return
+
+        try:
+            response = reference_to_video(
+                mock=self.mock,
+                api_key=self.api_key,
+                model=params["model"],
+                images=job["images"],
+                prompt=job["prompt"],
+                duration=params["duration"],
+                seed=params.get("seed"),
+                aspect_ratio=params["aspect_ratio"],
+                resolution=params["resolution"],
+            )
+        except requests.exceptions.RequestException as e:
+            logger.warning("Submitting job %s failed: %s", job["job_id"], e)
+            if key and not submission_rejected(e):
+                # Vidu may have accepted it, so submitting again could pay twice
+                self._release(job, state="failed", error=UNCONFIRMED_SUBMISSION)
+                return
+            if key:
+                db_release_submission(key)
+            if job["attempts"] >= JOB_MAX_SUBMIT_ATTEMPTS:
+                self._release(job, state="failed", error=str(e))
+            else:
+                # Back off before the next attempt
+                self._release(job, next_check=time.time() + 2 ** job["attempts"])
+            return
+
+        if not response.get("task_id"):
+            if key:
+                db_release_submission(key)
+            self._release(
+                job, state="failed", error="Failed to create video generation task."
+            )
+            return
+        if key:
+            db_complete_submission(key, response["task_id"])
+        self._track(job, response)
+
+    def _track(self, job, response):
+        params = job["params"]
+        task_id = response["task_id"]
+        db_add_memory(
+            user_id=job["user_id"],
+            group_id=job["group_id"],
+            video_url="",
+            task_id=task_id,
+            status="pending",
+            prompt=params.get("user_prompt"),
+            seed=response.get("seed"),
+            tier=params.get("tier"),
+            idempotency_key=job.get("idempotency_key"),
+        )
+        if not self._release(
+            job,
+            state="processing",
+            task_id=task_id,
+            next_check=time.time() + JOB_POLL_SECONDS,
+        ):
+            # The job was cancelled while it was being submitted
+            db_cancel_memory(job["user_id"], job["group_id"], task_id)
+            try:
+                cancel_generation(mock=self.mock, api_key=self.api_key, task_id=task_id)
+            except requests.exceptions.RequestException as e:
+                logger.warning("Cancelling task %s failed: %s", task_id, e)
+
+    def check(self, job):
+        task_id = job["task_id"]
+        try:
+            status_response = get_generation_status(
+                mock=self.mock, api_key=self.api_key, task_id=task_id
+            )
+        except requests.exceptions.RequestException as e:
+            logger.warning("Status check for task %s failed: %s", task_id, e)
+            status_response = {}
+
+        state = status_response.get("state")
+        if state == "success":
+            creations = status_response.get("creations", [])
+            if not creations:
+                db_update_status(job["user_id"], job["group_id"], task_id, "failed")
+                self._release(
+                    job, state="failed", error="No video URL found in the response."
+                )
+                return
+            video_url = creations[0].get("url")
+            db_complete_video(job["user_id"], job["group_id"], task_id, video_url)
+            self._release(job, state="success", video_url=video_url)
+        elif state == "failed":
+            db_update_status(job["user_id"], job["group_id"], task_id, "failed")
+            self._release(job, state="failed", error="Video generation failed.")
+        elif time.time() - job["created_at"] > JOB_MAX_TRACKING_SECONDS:
+            self._release(
+                job,
+                state="failed",
+                error="Video generation is taking too long. Use /memory <id> to check the status.",
+            )
+        else:
+            self._release(job, next_check=time.time() + JOB_POLL_SECONDS)
+
+    def _release(self, job, **fields):
+        if not db_release_job(job["job_id"], self.worker_id, **fields):
+            logger.warning(
+                "Worker %s lost the lease on job %s", self.worker_id, job["job_id"]
+            )
+            return False
+        reservation_id = job["params"].get("reservation_id")
+        if reservation_id and fields.get("state") in ("success", "failed"):
+            # The quota reserved by /imagine is now used or no longer needed
+            db_release_reservation(job["group_id"], reservation_id, slots=1)
+        return True
+
+
+def _run_worker_process(api_key, mock, stop_event):
+    # The parent process stops workers through the event on SIGINT/SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    Worker(api_key, mock=mock).run_forever(stop_event)
+
+
+def run_workers(api_key, mock=False, processes=1):
+    """
+    Run worker processes until interrupted.
+
+    Args:
+        api_key (str): The Vidu API key.
+        mock (bool): If True, use mock data instead of calling Vidu.
+        processes (int): Number of worker processes.
+    """
+    init_db()
+    stop_event = multiprocessing.Event()
+    workers = [
+        multiprocessing.Process(
+            target=_run_worker_process, args=(api_key, mock, stop_event)
+        )
+        for _ in range(processes)
+    ]
+    for process in workers:
+        process.start()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop_event.set())
+    for process in workers:
+        process.join()